@@ -0,0 +1,275 @@
+import asyncio
+from collections import deque
+from datetime import datetime
+from ibapi.contract import Contract
+from threading import Lock
+from time import monotonic
+
+from bar_buffer import BarBuffer
+
+
+class TWSRequestError(Exception):
+    """
+    Raised by AsyncTWS when TWS answers a request with an error. error_class is the class of tws_api.classify_error.
+    """
+    def __init__(self, message: str, error_class: str = 'error'):
+        super().__init__(message)
+        self.error_class = error_class
+
+
+class AsyncRequest:
+    """
+    Receiver of one request's callbacks, registered in core.reqId_hashmap in place of a ContractContainer method.
+
+    TWSCon calls it from the reader thread exactly like a ContractContainer (the registered callback, then
+    set_request_done / set_request_failed on its __self__). Received items are collected under a lock and handed to the
+    event loop in batches: one call_soon_threadsafe per batch instead of one per bar.
+    """
+    callbacks: dict[str, str] = {'ReqHistData': 'on_bar', 'ReqConDetails': 'on_contract', 'ReqExpStr': 'on_sec_def'}
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, reqId: int, reqType: str):
+        self.loop = loop
+        self.reqId = reqId
+        self.reqType = reqType
+        self.callback = getattr(self, self.callbacks[reqType])  # registered in core.reqId_hashmap
+        self.lock = Lock()
+        self.received: list = []  # items not yet handed to the loop [reader thread]
+        self.scheduled: bool = False
+
+        self.items: deque = deque()  # items handed to the loop [event loop]
+        self.done: bool = False
+        self.failed: bool = False
+        self.error_class: str | None = None
+        self.wakeup: asyncio.Event = asyncio.Event()
+
+    # reader thread
+    def on_bar(self, date: str, open_: float, high: float, low: float, close: float):
+        self.receive((date, open_, high, low, close))
+
+    def on_contract(self, conId: int, contract: Contract = None, **kwargs):
+        self.receive(contract)
+
+    def on_sec_def(self, expiries: list[str], strikes: list[float], **kwargs):
+        self.receive((expiries, strikes))
+
+    def receive(self, item):
+        with self.lock:
+            self.received.append(item)
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self.loop.call_soon_threadsafe(self.drain)
+
+    def set_request_failed(self, reqId: int, error_class: str = 'error', **kwargs):
+        self.error_class = error_class
+        self.failed = True
+
+    def set_request_done(self, reqId: int, **kwargs):
+        self.loop.call_soon_threadsafe(self.finish)
+
+    def set_error_flag(self, flag: bool = False, **kwargs):
+        pass
+
+    def set_historical_data_end(self, flag: bool = False, **kwargs):
+        pass
+
+    def get_reqType(self, reqId: int, **kwargs) -> str:
+        return self.reqType
+
+    # event loop
+    def drain(self):
+        with self.lock:
+            received, self.received, self.scheduled = self.received, [], False
+        self.items.extend(received)
+        self.wakeup.set()
+
+    def finish(self):
+        self.drain()
+        self.done = True
+
+    async def next_batch(self, deadline: float) -> bool:
+        """
+        Waits until items arrived or the request completed. Returns False once the request is done and all items are consumed.
+        Raises TimeoutError at the loop time deadline and TWSRequestError if TWS answered with an error.
+        """
+        while not self.items and not self.done:
+            self.wakeup.clear()
+            async with asyncio.timeout_at(deadline):
+                await self.wakeup.wait()
+        if self.failed:
+            raise TWSRequestError(f'Request {self.reqId} failed ({self.error_class}).', error_class=self.error_class)
+        return bool(self.items)
+
+
+class BarStream:
+    """
+    Async iterator over the bars (date, open, high, low, close) of one reqHistoricalData request, yielded as they arrive.
+    Awaiting collect() instead gathers them into a BarBuffer.
+
+    The request is released from core.reqId_hashmap when it completes, fails or times out. A consumer stopping early
+    has to close the stream (aclose, or iterate within async with), which cancels the request in TWS and releases it.
+    """
+    def __init__(self, engine: 'AsyncTWS', contract_container: 'ContractContainer', end: datetime, duration_str: str, timeout: float):
+        self.engine = engine
+        self.contract_container = contract_container
+        self.end = end
+        self.duration_str = duration_str
+        self.timeout = timeout
+        self.request: AsyncRequest | None = None
+        self.closed: bool = False
+
+    async def __aenter__(self) -> 'BarStream':
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    def __aiter__(self) -> 'BarStream':
+        return self
+
+    async def __anext__(self) -> tuple[str, float, float, float, float]:
+        if self.closed:
+            raise StopAsyncIteration
+        if self.request is None:
+            self.request, self.tws_con = self.engine.send_historical(self.contract_container, self.end, self.duration_str)
+            self.deadline = asyncio.get_running_loop().time() + self.timeout
+            self.sent = monotonic()
+
+        try:
+            if not await self.request.next_batch(self.deadline):
+                await self.aclose()
+                raise StopAsyncIteration
+        except TimeoutError:
+            await self.aclose(timed_out=True)
+            raise
+        except TWSRequestError:
+            await self.aclose()
+            raise
+
+        return self.request.items.popleft()
+
+    async def aclose(self, timed_out: bool = False, **kwargs):
+        """
+        Ends the stream: releases the request and, unless TWS already completed it, cancels it with cancelHistoricalData.
+        Bars still arriving for it are dropped by TWSCon. Safe to call more than once and before the request was sent.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.request is None:
+            return
+
+        completed = self.request.done
+        self.engine.release(self.request, secType=self.contract_container.get_secType(), sent=self.sent if completed else None,
+                            timed_out=timed_out)
+        if not completed and self.tws_con.isConnected():
+            self.tws_con.cancelHistoricalData(self.request.reqId)
+
+    async def collect(self) -> BarBuffer:
+        bars = BarBuffer(chunk=self.engine.core.bar_buffer_chunk)
+        async with self:
+            async for bar in self:
+                bars.append(*bar)
+        return bars
+
+
+class AsyncTWS:
+    """
+    asyncio client layer over the TWS connections of a TWSRouter.
+
+    Every request returns an awaitable resolved from the TWSCon callbacks, so thousands of logical requests can be open
+    on one event loop. Timeouts are exact loop deadlines instead of polling; a timed out historical data request is
+    cancelled with cancelHistoricalData. Requests are routed and numbered by the connection of their underlying,
+    so they share reqId spaces and callbacks with the threaded pipeline.
+    It is an optional API for scripts and tools: PipelineBuilder and PipelineHandler do not use it.
+
+    Usage:
+        engine = AsyncTWS(core=core, tws_con=router)
+        details = await engine.contract_details(stk, timeout=10)
+        async with engine.historical_data(opt, end=datetime.now(), duration_str='30 D') as bars:
+            async for date, open_, high, low, close in bars:
+                ...
+    """
+    def __init__(self, core=None, tws_con=None):
+        if None in (core, tws_con):
+            raise Exception('<AsyncTWS INIT> All parameters must be specified.')
+
+        self.core = core
+        self.tws_con = tws_con
+
+    def register(self, tws_con: 'TWSCon', reqType: str) -> AsyncRequest:
+        request = AsyncRequest(loop=asyncio.get_running_loop(), reqId=tws_con.next_reqId(historical=reqType == 'ReqHistData'), reqType=reqType)
+        self.core.reqId_hashmap.register(request.reqId, request.callback)
+        return request
+
+    def release(self, request: AsyncRequest, secType: str, sent: float = None, timed_out: bool = False):
+        self.core.reqId_hashmap.release(request.reqId)
+        if timed_out:
+            self.core.metrics.inc('request_timeouts', reqType=request.reqType, secType=secType)
+        elif sent is not None and not request.failed:
+            self.core.metrics.observe('request_seconds', monotonic() - sent, reqType=request.reqType, secType=secType)
+
+    async def collect(self, request: AsyncRequest, timeout: float, secType: str) -> list:
+        sent = monotonic()
+        deadline = asyncio.get_running_loop().time() + timeout
+        items = []
+        try:
+            while await request.next_batch(deadline):
+                items.extend(request.items)
+                request.items.clear()
+        except TimeoutError:
+            self.release(request, secType=secType, timed_out=True)
+            raise
+        except TWSRequestError:
+            self.release(request, secType=secType)
+            raise
+        self.release(request, secType=secType, sent=sent)
+        return items
+
+    async def contract_details(self, contract_container: 'ContractContainer', contract: Contract = None, timeout: float = None) -> list[Contract]:
+        """
+        reqContractDetails for the contract of a container, or for contract (e.g. ContractContainer.build_chain_contract) routed by the container.
+
+        Returns:
+            list[Contract]: The contracts of all received contract details.
+        """
+        tws_con = self.tws_con.route(contract_container)
+        request = self.register(tws_con, 'ReqConDetails')
+        tws_con.reqContractDetails(request.reqId, contract if contract is not None else contract_container.get_contract())
+        return await self.collect(request, timeout=timeout or self.core.contract_details_timeout,
+                                  secType=contract_container.get_secType())
+
+    async def sec_def_opt_params(self, contract_container: 'ContractContainer', timeout: float = None) -> tuple[list[str], list[float]]:
+        """
+        reqSecDefOptParams of a stock container with resolved conId.
+
+        Returns:
+            tuple[list[str], list[float]]: Expiries and strikes of all exchanges, sorted.
+        """
+        tws_con = self.tws_con.route(contract_container)
+        request = self.register(tws_con, 'ReqExpStr')
+        tws_con.reqSecDefOptParams(request.reqId, contract_container.get_symbol(), '', contract_container.get_secType(), contract_container.get_conId())
+        chains = await self.collect(request, timeout=timeout or self.core.sec_def_timeout, secType=contract_container.get_secType())
+        return sorted({x for expiries, _ in chains for x in expiries}), sorted({x for _, strikes in chains for x in strikes})
+
+    def send_historical(self, contract_container: 'ContractContainer', end: datetime, duration_str: str) -> tuple[AsyncRequest, 'TWSCon']:
+        tws_con = self.tws_con.route(contract_container)
+        request = self.register(tws_con, 'ReqHistData')
+        tws_con.reqHistoricalData(reqId=request.reqId,
+                                  contract=contract_container.get_contract(),
+                                  endDateTime=end.strftime("%Y%m%d-%H:%M:%S"),
+                                  durationStr=duration_str,
+                                  barSizeSetting=self.core.candle_length,
+                                  whatToShow="Bid_Ask",
+                                  useRTH=1,
+                                  formatDate=1,
+                                  keepUpToDate=False,
+                                  chartOptions=[])
+        return request, tws_con
+
+    def historical_data(self, contract_container: 'ContractContainer', end: datetime, duration_str: str, timeout: float = 300) -> BarStream:
+        """
+        reqHistoricalData of a container, sent on first iteration. Iterate the returned BarStream within async with to receive
+        the bars as they arrive, or await its collect() for a BarBuffer. Pacing is left to the caller (HistoricalPacer).
+        """
+        return BarStream(self, contract_container, end=end, duration_str=duration_str, timeout=timeout)
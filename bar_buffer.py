@@ -0,0 +1,117 @@
+from array import array
+from bisect import bisect_right
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+
+EPOCH = datetime(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+
+
+@lru_cache(maxsize=4096)
+def day_offset(day: str) -> int:
+    """
+    Seconds from EPOCH to the start of a '%Y%m%d' day. Cached, as all bars of a day share the prefix.
+    """
+    return (date(int(day[0:4]), int(day[4:6]), int(day[6:8])).toordinal() - EPOCH_ORDINAL) * 86400
+
+
+def bar_timestamp(bar_date: str) -> int:
+    """
+    Parses TWS bar dates of formatDate=1 into naive epoch seconds: '%Y%m%d %H:%M:%S', separated by one or two spaces
+    and optionally followed by a timezone (e.g. '20240105 09:30:00 US/Eastern'), or '%Y%m%d' for daily bars.
+    Naive like the datetimes stored in the database, so the timezone is ignored and no DST conversion takes place.
+    """
+    day, *time_of_day = bar_date.split()
+    seconds = day_offset(day)
+    if time_of_day:
+        hours, minutes, secs = time_of_day[0].split(':')
+        seconds += int(hours) * 3600 + int(minutes) * 60 + int(secs)
+    return seconds
+
+
+def to_datetime(timestamp: int) -> datetime:
+    return EPOCH + timedelta(seconds=timestamp)
+
+
+def to_timestamp(dt: datetime) -> int:
+    return (dt.toordinal() - EPOCH_ORDINAL) * 86400 + dt.hour * 3600 + dt.minute * 60 + dt.second
+
+
+class BarBuffer:
+    """
+    Columnar buffer of the bars received for one historical data request.
+
+    Timestamps (int64 epoch seconds) and open/high/low/close (float64) are held in typed arrays, which grow by
+    chunk bars at a time. A bar costs 40 bytes and no Python objects; datetimes are only created for the rows written.
+    """
+    __slots__ = ('chunk', 'n', 'ts', 'o', 'h', 'l', 'c')
+
+    def __init__(self, chunk: int = 512):
+        self.chunk = chunk
+        self.n: int = 0
+        self.ts = array('q')
+        self.o, self.h, self.l, self.c = array('d'), array('d'), array('d'), array('d')
+
+    def grow(self):
+        self.ts.extend(array('q', [0]) * self.chunk)
+        for column in (self.o, self.h, self.l, self.c):
+            column.extend(array('d', [0.]) * self.chunk)
+
+    def append(self, bar_date: str, open_: float, high: float, low: float, close: float):
+        n = self.n
+        if n == len(self.ts):
+            self.grow()
+        self.ts[n] = bar_timestamp(bar_date)
+        self.o[n], self.h[n], self.l[n], self.c[n] = open_, high, low, close
+        self.n = n + 1
+
+    def first(self) -> datetime | None:
+        return to_datetime(min(self.ts[:self.n])) if self.n else None
+
+    def last(self) -> datetime | None:
+        return to_datetime(max(self.ts[:self.n])) if self.n else None
+
+    def rows(self, prefix: tuple = (), last_stored: datetime = None, existing_dates: set[datetime] = None, **kwargs) -> list[tuple]:
+        """
+        Builds parameter rows (date, *prefix, h, l, o, c) of all bars, skipping bars already stored.
+
+        Bars after last_stored are always new. Bars up to last_stored are only kept if existing_dates is given
+        and does not contain them.
+        """
+        watermark = to_timestamp(last_stored) if last_stored else None
+        rows = []
+        for i in range(self.n):
+            ts = self.ts[i]
+            if watermark is not None and ts <= watermark:
+                if existing_dates is None:
+                    continue
+                dt = to_datetime(ts)
+                if dt in existing_dates:
+                    continue
+            else:
+                dt = to_datetime(ts)
+            rows.append((dt, *prefix, self.h[i], self.l[i], self.o[i], self.c[i]))
+        return rows
+
+    def sort_unique(self):
+        """
+        Sorts the bars by date and drops repeated dates, e.g. after the chunks of one split request were received
+        into this buffer in completion order, with the boundary bar of adjacent chunks delivered twice.
+        """
+        order = sorted(range(self.n), key=self.ts.__getitem__)
+        keep = [i for k, i in enumerate(order) if k == 0 or self.ts[i] != self.ts[order[k - 1]]]
+        self.ts = array('q', (self.ts[i] for i in keep))
+        self.o, self.h, self.l, self.c = (array('d', (column[i] for i in keep)) for column in (self.o, self.h, self.l, self.c))
+        self.n = len(keep)
+
+    def truncate(self, until: datetime):
+        """
+        Drops all bars after until. The buffer must be sorted (sort_unique).
+        """
+        self.n = bisect_right(self.ts, to_timestamp(until), 0, self.n)
+
+    def nbytes(self) -> int:
+        return sum(column.itemsize * len(column) for column in (self.ts, self.o, self.h, self.l, self.c))
+
+    def __len__(self) -> int:
+        return self.n
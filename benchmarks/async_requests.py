@@ -0,0 +1,77 @@
+"""
+Throughput of the asyncio request engine (AsyncTWS) against a simulated TWS (FakeTWSCon).
+
+Opens --requests concurrent historical data requests of synthetic option contracts on one event loop and streams their bars.
+With --timeout below --latency every request times out and is cancelled, which exercises the exact deadlines.
+
+Usage:
+    python -m benchmarks.async_requests --requests 2000 --latency 0.2 --connections 2
+"""
+from argparse import ArgumentParser
+import asyncio
+from datetime import datetime, timedelta
+import os
+from tempfile import TemporaryDirectory
+from time import monotonic
+
+os.environ.setdefault('HOST_IP', '127.0.0.1')
+os.environ.setdefault('API_PORT', '0')
+os.environ.setdefault('CLIENT_ID', '0')
+os.environ.setdefault('STK_LAST_UPDATE', '0')
+os.environ.setdefault('EXP_LAST_UPDATE', '0')
+
+from async_tws import AsyncTWS, TWSRequestError
+from benchmarks.fakes import FakeTWSCon
+from contract_container import ContractContainer
+from core import Core, tprint
+from tws_api import TWSRouter
+
+
+async def fetch(engine: AsyncTWS, contract: ContractContainer, days: int, timeout: float, results: dict[str, int]):
+    try:
+        bars = 0
+        async with engine.historical_data(contract, end=datetime.now(), duration_str=f'{days} D', timeout=timeout) as stream:
+            async for _ in stream:
+                bars += 1
+        results['bars'] += bars
+        results['completed'] += 1
+    except TimeoutError:
+        results['timeouts'] += 1
+    except TWSRequestError:
+        results['errors'] += 1
+
+
+async def run(args) -> dict:
+    core = Core()
+    core.client_ids = list(range(args.connections))
+    tws_con = TWSRouter(core=core, TWS=FakeTWSCon, latency=args.latency, error_rate=args.error_rate)
+    engine = AsyncTWS(core=core, tws_con=tws_con)
+
+    expiry = (datetime.today() + timedelta(days=30)).strftime('%Y%m%d')
+    contracts = [ContractContainer(core, symbol=f'S{i % 50}', secType='OPT', strike=float(100 + i // 50), right='C',
+                                   lastTradeDateOrContractMonth=expiry) for i in range(args.requests)]
+
+    results = {'bars': 0, 'completed': 0, 'timeouts': 0, 'errors': 0}
+    start = monotonic()
+    await asyncio.gather(*(fetch(engine, contract, args.days, args.timeout, results) for contract in contracts))
+    results['secs'] = monotonic() - start
+    results['open_reqIds'] = len(core.reqId_hashmap)
+    return results
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark the asyncio request engine against a simulated TWS.')
+    parser.add_argument('--requests', type=int, default=2000, help='concurrent historical data requests')
+    parser.add_argument('--days', type=int, default=5, help='duration of every request in days')
+    parser.add_argument('--latency', type=float, default=.2, help='seconds until TWS answers a request')
+    parser.add_argument('--timeout', type=float, default=30., help='seconds until a request is cancelled')
+    parser.add_argument('--error-rate', type=float, default=0., help='share of requests answered with an error')
+    parser.add_argument('--connections', type=int, default=1, help='simulated TWS connections')
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        result = asyncio.run(run(args))
+
+    tprint(f'Requests: {result['completed']} completed, {result['timeouts']} timed out, {result['errors']} failed in {result['secs']:.2f} secs')
+    tprint(f'Bars: {result['bars']:,}, {result['bars'] / result['secs']:,.0f} bars/sec; reqIds left registered: {result['open_reqIds']}')
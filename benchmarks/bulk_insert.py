@@ -0,0 +1,70 @@
+"""
+Compares rows/sec of the string built INSERT path with the parameterized bulk insert path.
+
+Writes synthetic option bars into a scratch table in tempdb of the configured SQL Server (.env).
+
+Usage:
+    python -m benchmarks.bulk_insert --rows 20000 --repeat 3
+"""
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from contract_container import ContractContainer
+from core import Core, tprint
+from database_broker import DatabaseBroker
+
+
+class BenchContainer(ContractContainer):
+    def get_database(self, **kwargs) -> str:
+        return 'tempdb'
+
+    def get_table(self, **kwargs) -> str:
+        return 'BENCH_OPT_01Jan30'
+
+
+def synthetic_rows(db: DatabaseBroker, contract: ContractContainer, n: int) -> list[tuple]:
+    prefix = db.row_prefix(contract_container=contract)
+    start = datetime(2020, 1, 1, 9, 30)
+    return [(start + timedelta(minutes=15 * i), *prefix, 1.5 + i % 7, 1.0, 1.25, 1.3) for i in range(n)]
+
+
+def run(rows_n: int, repeat: int):
+    core = Core()
+    contract = BenchContainer(core, symbol='BENCH', secType='OPT', strike=100., right='C', lastTradeDateOrContractMonth='20300101')
+    db = DatabaseBroker(core=core, CC=ContractContainer)
+
+    table = f'[{contract.get_database()}].[dbo].[{contract.get_table()}]'
+    db.write_price_data(query_string=f"IF OBJECT_ID('{contract.get_database()}.dbo.{contract.get_table()}') IS NOT NULL DROP TABLE {table};")
+    db.create_table(db_name=contract.get_database(), table_name=contract.get_table())
+    rows = synthetic_rows(db=db, contract=contract, n=rows_n)
+
+    def legacy():
+        for insert_query in db.build_insert_queries(contract_container=contract, rows=rows, max_lines=core.insert_query_max_lines):
+            db.write_price_data(query_string=insert_query)
+
+    def bulk():
+        db.bulk_insert_rows(contract_container=contract, rows=rows)
+
+    try:
+        for name, path in [('string INSERT', legacy), ('bulk insert', bulk)]:
+            timings = []
+            for _ in range(repeat):
+                db.write_price_data(query_string=f'TRUNCATE TABLE {table};')
+                start = perf_counter()
+                path()
+                timings.append(perf_counter() - start)
+            best = min(timings)
+            tprint(f'{name:>14}: {rows_n} rows, best of {repeat}: {best:.3f} secs, {rows_n / best:,.0f} rows/sec')
+    finally:
+        db.write_price_data(query_string=f'DROP TABLE {table};')
+        core.sql_pool.close_all()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark price data insert paths.')
+    parser.add_argument('--rows', type=int, default=20_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    run(rows_n=args.rows, repeat=args.repeat)
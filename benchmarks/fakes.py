@@ -0,0 +1,247 @@
+"""
+Stand-ins for TWS and SQL Server, so the pipeline can be measured without IB Gateway or a database.
+
+FakeTWSCon answers requests with synthetic callbacks from one dispatcher thread, like the EReader thread of the real client.
+MemoryBroker keeps per-contract watermarks, row counts and last closes in memory instead of price tables.
+"""
+from collections import deque
+from datetime import datetime, timedelta
+from functools import lru_cache
+from heapq import heappop, heappush
+from itertools import count
+import random
+from threading import Condition, Lock, Thread
+from time import monotonic
+from typing import Iterable
+
+from ibapi.common import BarData
+from ibapi.contract import Contract, ContractDetails
+from ibapi.wrapper import EWrapper
+
+from pacing import REQUEST_COSTS
+from storage_backend import StorageBackend
+from tws_api import TWSCon
+
+
+@lru_cache(maxsize=64)
+def bar_dates(end_day: str, days: int, bar_minutes: int = 15) -> tuple[str, ...]:
+    """
+    Regular trading hour bar dates ('%Y%m%d %H:%M:%S') of the days before end_day ('%Y%m%d'), oldest first. Cached per window.
+    """
+    end = datetime.strptime(end_day, '%Y%m%d')
+    dates = []
+    for day in range(days, 0, -1):
+        dt = end - timedelta(days=day)
+        if dt.weekday() > 4:
+            continue
+        t = dt.replace(hour=9, minute=30)
+        while t < dt.replace(hour=16):
+            dates.append(t.strftime('%Y%m%d %H:%M:%S'))
+            t += timedelta(minutes=bar_minutes)
+    return tuple(dates)
+
+
+class FakeTWSCon(TWSCon):
+    """
+    TWSCon replaying synthetic contractDetails, securityDefinitionOptionParameter and historicalData callbacks.
+
+    Every request is answered after latency seconds (+ bar_latency per bar for historical data).
+    error_rate is the share of requests answered with an error instead (200 for contract details, 162 for historical data).
+    With pacing_limit (max requests, seconds), historical data requests beyond max within any window of that many seconds
+    are answered with a 162 pacing violation, like TWS does. BID_ASK requests count twice (pacing.REQUEST_COSTS).
+    """
+    def __init__(self, core, client_id: int = None, latency: float = .05, bar_latency: float = 0., error_rate: float = 0., expiries: int = 4,
+                 strikes: int = 20, seed: int = 0, pacing_limit: tuple[int, float] = None):
+        EWrapper.__init__(self)
+
+        self.core = core
+        self.core.no_contract = False
+        self.client_id: int = client_id if client_id is not None else core.client_id
+        self.set_reqId_space(shard=0, shards=1)
+
+        self.latency = latency
+        self.bar_latency = bar_latency
+        self.error_rate = error_rate
+        self.n_expiries = expiries
+        self.n_strikes = strikes
+        self.random = random.Random(seed + self.client_id)
+        self.pacing_limit = pacing_limit
+        self.hist_sent: deque[float] = deque()  # monotonic times of accepted historical data requests
+
+        self.events: list[tuple[float, int, object, tuple]] = []
+        self.counter = count()
+        self.cv = Condition(Lock())
+
+        self.bars_sent: int = 0
+        self.requests: dict[str, int] = {'ReqConDetails': 0, 'ReqSecDef': 0, 'ReqHistData': 0}
+        self.errors: int = 0
+        self.pacing_violations: int = 0
+        self.request_latency: dict[int, float] = {}  # reqId: seconds from reqHistoricalData to historicalDataEnd
+
+        self.t = Thread(target=self.dispatch, daemon=True)
+        self.t.start()
+
+    def isConnected(self) -> bool:
+        return True
+
+    def connect(self, *args, **kwargs):
+        pass
+
+    def schedule(self, delay: float, callback, *args):
+        with self.cv:
+            heappush(self.events, (monotonic() + delay, next(self.counter), callback, args))
+            self.cv.notify()
+
+    def dispatch(self):
+        while True:
+            with self.cv:
+                while not self.events or self.events[0][0] > monotonic():
+                    self.cv.wait(timeout=self.events[0][0] - monotonic() if self.events else None)
+                _, _, callback, args = heappop(self.events)
+            callback(*args)
+
+    def failed(self) -> bool:
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+    def expiries(self) -> list[str]:
+        friday = datetime.today() + timedelta(days=(4 - datetime.today().weekday()) % 7 or 7)
+        return [(friday + timedelta(weeks=4 * i)).strftime('%Y%m%d') for i in range(self.n_expiries)]
+
+    def strikes(self, conId: int) -> list[float]:
+        spot = 50. + conId % 450
+        step = max(round(spot / 100), 1)
+        return [float(round(spot) + step * (i - self.n_strikes // 2)) for i in range(self.n_strikes)]
+
+    def reqContractDetails(self, reqId: int, contract: Contract):
+        self.requests['ReqConDetails'] += 1
+        if self.failed():
+            self.schedule(self.latency, self.error, reqId, 200, 'No security definition has been found for the request')
+            return
+
+        if contract.secType == 'STK':
+            details = ContractDetails()
+            details.contract = contract
+            details.contract.conId = sum(map(ord, contract.symbol)) * 7919
+            self.schedule(self.latency, self.contractDetails, reqId, details)
+        else:
+            conId = sum(map(ord, contract.symbol)) * 7919
+            for strike in self.strikes(conId):
+                details = ContractDetails()
+                details.contract = Contract()
+                details.contract.symbol, details.contract.secType = contract.symbol, 'OPT'
+                details.contract.lastTradeDateOrContractMonth, details.contract.strike = contract.lastTradeDateOrContractMonth, strike
+                self.schedule(self.latency, self.contractDetails, reqId, details)
+        self.schedule(self.latency, self.contractDetailsEnd, reqId)
+
+    def reqSecDefOptParams(self, reqId: int, underlyingSymbol: str, futFopExchange: str, underlyingSecType: str, underlyingConId: int):
+        self.requests['ReqSecDef'] += 1
+        if self.failed():
+            self.schedule(self.latency, self.error, reqId, 200, 'No security definition has been found for the request')
+            return
+
+        self.schedule(self.latency, self.securityDefinitionOptionParameter, reqId, 'SMART', underlyingConId, underlyingSymbol, '100',
+                      set(self.expiries()), set(self.strikes(underlyingConId)))
+        self.schedule(self.latency, self.securityDefinitionOptionParameterEnd, reqId)
+
+    def reqHistoricalData(self, reqId: int, contract: Contract, endDateTime: str, durationStr: str, barSizeSetting: str, whatToShow: str,
+                          useRTH: int, formatDate: int, keepUpToDate: bool, chartOptions: list):
+        self.requests['ReqHistData'] += 1
+        if self.pacing_limit is not None:
+            now = monotonic()
+            while self.hist_sent and now - self.hist_sent[0] >= self.pacing_limit[1]:
+                self.hist_sent.popleft()
+            cost = REQUEST_COSTS.get(whatToShow.upper(), 1)
+            if len(self.hist_sent) + cost > self.pacing_limit[0]:
+                self.pacing_violations += 1
+                self.schedule(self.latency, self.error, reqId, 162, 'Historical Market Data Service error message:Historical data request pacing violation')
+                return
+            self.hist_sent.extend([now] * cost)
+        if self.failed():
+            self.schedule(self.latency, self.error, reqId, 162, 'Historical Market Data Service error message:API historical data query cancelled')
+            return
+
+        amount, unit = durationStr.split()
+        dates = bar_dates(end_day=endDateTime[:8], days=int(amount) * {'D': 1, 'W': 7, 'M': 30, 'Y': 365}[unit])
+        self.schedule(self.latency + self.bar_latency * len(dates), self.replay_bars, reqId, dates, monotonic())
+
+    def replay_bars(self, reqId: int, dates: tuple[str, ...], sent: float):
+        price = 1. + reqId % 50
+        for date in dates:
+            bar = BarData()
+            bar.date, bar.open, bar.high, bar.low, bar.close = date, price, price * 1.01, price * .99, price
+            self.historicalData(reqId, bar)
+        self.bars_sent += len(dates)
+        self.request_latency[reqId] = monotonic() - sent
+        self.historicalDataEnd(reqId, '', '')
+
+    def cancelHistoricalData(self, reqId: int):
+        pass
+
+
+class MemoryBroker(StorageBackend):
+    """
+    StorageBackend keeping only what the pipeline reads back (watermarks, last closes) in memory.
+
+    No price rows are retained, so resident memory reflects the pipeline and not the stand-in.
+    Existing-date queries return nothing, the exact dedup mode is therefore not exercised.
+    """
+    def __init__(self, core=None, CC=None):
+        super().__init__(core=core, CC=CC)
+        self.lock = Lock()
+        self.last_dates: dict[tuple, datetime] = {}  # (database, table, strike, right): latest date
+        self.last_close: dict[str, float] = {}  # stock table: latest close
+        self.rows_written: int = 0
+        self.statements: int = 0
+
+    def fetch_all_table_names(self, return_data: bool = False, **kwargs):
+        return self.table_structure if return_data else None
+
+    def provision_tables(self, contract_containers: "Iterable[ContractContainer]", **kwargs) -> int:
+        missing = self.missing_tables(contract_containers=contract_containers)
+        for database, table in missing.keys():
+            self.table_structure.setdefault(database, set()).add(table)
+        self.statements += len(missing)
+        return len(missing)
+
+    def price_columns(self, secType: str) -> list[str]:
+        return ['date', 'h', 'l', 'o', 'c'] if secType == 'STK' else ['date', 'callput', 'strike', 'h', 'l', 'o', 'c']
+
+    def row_prefix(self, contract_container: "ContractContainer", **kwargs) -> tuple:
+        return () if contract_container.get_secType() == 'STK' else (contract_container.get_right(), contract_container.get_strike())
+
+    def get_table_watermarks(self, contract_container: "ContractContainer", **kwargs) -> list[tuple]:
+        table = (contract_container.get_database(), contract_container.get_table())
+        with self.lock:
+            return [(strike, right, dt) for (*t, strike, right), dt in self.last_dates.items() if tuple(t) == table]
+
+    def get_last_update(self, contract_container: "ContractContainer", **kwargs) -> datetime | None:
+        return self.last_dates.get(self.date_key(contract_container))
+
+    def get_last_price(self, stk_symbol: str, **kwargs) -> float | None:
+        return self.last_close.get(f'{stk_symbol.replace('.', '')}_STK')
+
+    def get_existing_dates(self, contract_container: "ContractContainer" = None, start: datetime = None, end: datetime = None, **kwargs) -> set[datetime]:
+        return set()
+
+    def write_price_rows(self, contract_container: "ContractContainer", rows: list[tuple], **kwargs) -> int:
+        if not rows:
+            return 0
+
+        key = self.date_key(contract_container)
+        last = max(rows, key=lambda x: x[0])
+        with self.lock:
+            self.rows_written += len(rows)
+            if key not in self.last_dates or self.last_dates[key] < last[0]:
+                self.last_dates[key] = last[0]
+            if contract_container.get_secType() == 'STK':
+                self.last_close[contract_container.get_table()] = last[-1]
+        return len(rows)
+
+    @staticmethod
+    def date_key(contract_container: "ContractContainer") -> tuple:
+        if contract_container.get_secType() == 'OPT':
+            return (contract_container.get_database(), contract_container.get_table(), float(contract_container.get_strike()), contract_container.get_right())
+        return (contract_container.get_database(), contract_container.get_table(), None, None)
@@ -0,0 +1,248 @@
+"""
+End-to-end throughput benchmark of the scraper pipeline against a simulated TWS (FakeTWSCon) and an in-memory database (MemoryBroker)
+or the local parquet store (--backend parquet).
+
+Runs startup_build_sequence, then lets pipeline_sorter, request_prices and write_to_database work until all option contracts
+are written or --duration is reached. Reports bars/sec, contracts/hour, per-stage latencies and peak RSS.
+Runs in a scratch directory, .env and the contract universe cache of the working directory are not touched.
+
+Usage:
+    python -m benchmarks.pipeline --symbols 5 --expiries 4 --strikes 20 --latency 0.05 --duration 120 --json run.json
+"""
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+import json
+import os
+from statistics import quantiles
+import sys
+from tempfile import TemporaryDirectory
+from threading import Lock
+from time import monotonic, sleep
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+os.environ.setdefault('HOST_IP', '127.0.0.1')
+os.environ.setdefault('API_PORT', '0')
+os.environ.setdefault('CLIENT_ID', '0')
+os.environ.setdefault('STK_LAST_UPDATE', '0')
+os.environ.setdefault('EXP_LAST_UPDATE', '0')
+
+from benchmarks.fakes import FakeTWSCon, MemoryBroker
+from contract_container import ContractContainer
+from core import Core, tprint
+from pipeline_builder import PipelineBuilder
+from pipeline_handler import PipelineHandler
+from storage_backend import backend_class
+from tws_api import TWSRouter
+
+
+def pacing_rule(value: str) -> tuple[int, float]:
+    max_requests, secs = value.split('/')
+    return int(max_requests), float(secs)
+
+
+def peak_rss_mb() -> float | None:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+class StageStats:
+    """
+    Thread-safe latency samples per pipeline stage.
+    """
+    def __init__(self):
+        self.samples: dict[str, list[float]] = {}
+        self.lock = Lock()
+
+    def record(self, stage: str, seconds: float):
+        with self.lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        summary = {}
+        with self.lock:
+            for stage, samples in self.samples.items():
+                cuts = quantiles(samples, n=20) if len(samples) > 1 else samples * 19
+                summary[stage] = {'n': len(samples), 'mean_ms': sum(samples) / len(samples) * 1e3, 'p50_ms': cuts[9] * 1e3,
+                                  'p95_ms': cuts[18] * 1e3, 'max_ms': max(samples) * 1e3}
+        return summary
+
+
+def instrument(core: Core, stats: StageStats) -> tuple[dict[str, int], type[PipelineHandler]]:
+    """
+    Wraps the stage boundaries with timers. Instance attributes shadow the pool methods, the pipeline code is unchanged.
+    Must run before the pipeline threads start, as they bind the pool methods when they first block on them.
+    Writes are measured by the returned PipelineHandler subclass, whose acknowledge sees every finished write.
+
+        sorter:      blocking time of pipeline_sorter's puts into the immediate pool (backpressure of request_prices)
+        queue_wait:  immediate pool -> taken by request_prices
+        request:     reqHistoricalData -> historicalDataEnd (simulated TWS latency + callback cost)
+        write:       per contract or streamed chunk (row build, insert), with --writers from submit to acknowledgement
+        first_write: immediate pool -> first bars of the contract written
+        end_to_end:  immediate pool -> written
+    """
+    counters = {'contracts': 0, 'rows': 0}
+    enqueued: dict[int, float] = {}
+    first_written: set[int] = set()
+
+    immediate_put = core.immediate_pool.put
+    def put(item, *args, **kwargs):
+        start = monotonic()
+        immediate_put(item, *args, **kwargs)
+        enqueued[id(item)] = monotonic()
+        stats.record('sorter', enqueued[id(item)] - start)
+    core.immediate_pool.put = put
+
+    immediate_get_nowait = core.immediate_pool.get_nowait
+    def get_nowait():
+        item = immediate_get_nowait()
+        if id(item) in enqueued:
+            stats.record('queue_wait', monotonic() - enqueued[id(item)])
+        return item
+    core.immediate_pool.get_nowait = get_nowait
+
+    class InstrumentedHandler(PipelineHandler):
+        def acknowledge(self, contract_instance, written, last_update, seconds, error=None, final=True):
+            stats.record('write', seconds)
+            counters['rows'] += written
+            if id(contract_instance) in enqueued and id(contract_instance) not in first_written:
+                first_written.add(id(contract_instance))
+                stats.record('first_write', monotonic() - enqueued[id(contract_instance)])
+            if final:
+                first_written.discard(id(contract_instance))
+                if id(contract_instance) in enqueued:
+                    stats.record('end_to_end', monotonic() - enqueued.pop(id(contract_instance)))
+                counters['contracts'] += 1
+            super().acknowledge(contract_instance, written, last_update, seconds, error, final)
+
+    return counters, InstrumentedHandler
+
+
+def run(args) -> dict:
+    cwd = os.getcwd()
+    with TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+
+        core = Core()
+        core.underlying_list = {'STK': core.underlying_list['STK'][:args.symbols]}
+        core.universe_cache_path = os.path.join(scratch, 'contract_universe.pkl')
+        core.exp_last_update = datetime.now()
+        core.stk_update_timer = core.exp_update_timer = datetime.now() + timedelta(days=365)
+        if args.backend != 'memory':
+            core.storage_backend = args.backend
+        core.parquet_root = os.path.join(scratch, 'price_data')
+        core.max_inflight_requests = args.max_inflight
+        core.client_ids = list(range(args.connections))
+        core.writer_processes = args.writers
+        core.hist_chunk_days = args.chunk_days or core.hist_chunk_days
+        core.stream_bars = args.stream
+        core.stream_chunk_bars = args.stream_chunk
+        if not args.ibkr_pacing:
+            core.hist_pacing_max_requests = core.hist_same_contract_max = 10 ** 9
+            core.hist_identical_cooldown = 0
+        if args.pacing:
+            core.hist_pacing_max_requests, core.hist_pacing_period = args.pacing
+
+        tws_con = TWSRouter(core=core, TWS=FakeTWSCon, latency=args.latency, bar_latency=args.bar_latency, error_rate=args.error_rate,
+                            expiries=args.expiries, strikes=args.strikes, seed=args.seed, pacing_limit=args.tws_pacing)
+        db = MemoryBroker(core=core, CC=ContractContainer) if args.backend == 'memory' else backend_class(core)(core=core, CC=ContractContainer)
+        core.db_broker = db
+        stats = StageStats()
+
+        counters, Handler = instrument(core=core, stats=stats)
+
+        start = monotonic()
+        builder = PipelineBuilder(core=core, tws_con=tws_con, CC=ContractContainer, DB=type(db))
+        handler = Handler(core=core, tws_con=tws_con, CC=ContractContainer, DB=type(db))
+
+        core.startup = True
+        builder.startup_build_sequence()
+        build_secs = monotonic() - start
+        build_rss = peak_rss_mb()
+        contracts_total = len(core.contract_pool['OPT']) + len(core.contract_pool['EXP'])  # STK waits for its daily timer
+        tprint(f'Startup build: {build_secs:.2f} secs, {contracts_total} contracts.')
+
+        pipeline_start = monotonic()
+        while monotonic() - pipeline_start < args.duration and counters['contracts'] < contracts_total:
+            sleep(.5)
+        pipeline_secs = monotonic() - pipeline_start
+        if handler.writers is not None:
+            handler.writers.close()
+        db.close()
+        os.chdir(cwd)
+
+    bars_sent = sum(con.bars_sent for con in tws_con)
+    requests = {reqType: sum(con.requests[reqType] for con in tws_con) for reqType in tws_con.connections[0].requests}
+    for con in tws_con:
+        for reqId, seconds in con.request_latency.items():
+            stats.record('request', seconds)
+
+    result = {
+        'args': vars(args),
+        'startup_build_secs': build_secs,
+        'pipeline_secs': pipeline_secs,
+        'contracts_total': contracts_total,
+        'contracts_written': counters['contracts'],
+        'contracts_per_hour': counters['contracts'] / pipeline_secs * 3600,
+        'bars_received': bars_sent,
+        'bars_per_sec': bars_sent / pipeline_secs,
+        'rows_written': counters['rows'],
+        'rows_per_sec': counters['rows'] / pipeline_secs,
+        'requests': requests,
+        'injected_errors': sum(con.errors for con in tws_con),
+        'pacing_violations': sum(con.pacing_violations for con in tws_con),
+        'reqIds': {'registered': core.reqId_hashmap.registered, 'released': core.reqId_hashmap.released, 'live': len(core.reqId_hashmap)},
+        'peak_rss_mb_after_build': build_rss,
+        'peak_rss_mb': peak_rss_mb(),
+        'stages': stats.summary(),
+        'metrics': core.metrics.snapshot(),
+    }
+    return result
+
+
+def report(result: dict):
+    tprint(f'Contracts: {result['contracts_written']}/{result['contracts_total']} in {result['pipeline_secs']:.1f} secs, '
+           f'{result['contracts_per_hour']:,.0f} contracts/hour')
+    tprint(f'Bars: {result['bars_received']:,} received, {result['bars_per_sec']:,.0f} bars/sec; '
+           f'rows: {result['rows_written']:,} written, {result['rows_per_sec']:,.0f} rows/sec')
+    tprint(f'Requests: {result['requests']}, injected errors: {result['injected_errors']}, pacing violations: {result['pacing_violations']}')
+    tprint(f'reqIds: {result['reqIds']['registered']:,} registered, {result['reqIds']['released']:,} released, {result['reqIds']['live']} live')
+    if result['peak_rss_mb'] is not None:
+        tprint(f'Peak RSS: {result['peak_rss_mb_after_build']:.1f} MB after startup build, {result['peak_rss_mb']:.1f} MB overall')
+    for stage, s in result['stages'].items():
+        tprint(f'{stage:>12}: n={s['n']:>7} mean={s['mean_ms']:9.2f} ms  p50={s['p50_ms']:9.2f} ms  p95={s['p95_ms']:9.2f} ms  max={s['max_ms']:9.2f} ms')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark the scraper pipeline against a simulated TWS and an in-memory database.')
+    parser.add_argument('--symbols', type=int, default=5, help='underlyings taken from Core.underlying_list')
+    parser.add_argument('--expiries', type=int, default=4, help='expiries per underlying')
+    parser.add_argument('--strikes', type=int, default=20, help='strikes per underlying')
+    parser.add_argument('--latency', type=float, default=.05, help='seconds until TWS answers a request')
+    parser.add_argument('--bar-latency', type=float, default=0., help='additional seconds per historical bar')
+    parser.add_argument('--error-rate', type=float, default=0., help='share of requests answered with an error')
+    parser.add_argument('--max-inflight', type=int, default=10, help='Core.max_inflight_requests per connection')
+    parser.add_argument('--connections', type=int, default=1, help='simulated TWS connections (Core.client_ids)')
+    parser.add_argument('--writers', type=int, default=0, help='writer processes (Core.writer_processes), 0 writes in the handler thread')
+    parser.add_argument('--chunk-days', type=int, help='Core.hist_chunk_days, max days per request (default: largest duration for the bar size)')
+    parser.add_argument('--stream', action='store_true', help='stream bars to the writer while requests are arriving (Core.stream_bars)')
+    parser.add_argument('--stream-chunk', type=int, default=5_000, help='Core.stream_chunk_bars')
+    parser.add_argument('--backend', choices=['memory', 'parquet'], default='memory', help='storage backend, memory is the in-memory stand-in')
+    parser.add_argument('--ibkr-pacing', action='store_true', help='keep the IBKR historical data pacing limits')
+    parser.add_argument('--pacing', type=pacing_rule, help='MAX/SECS, global pacing rule of the pipeline (Core.hist_pacing_max_requests/period)')
+    parser.add_argument('--tws-pacing', type=pacing_rule, help='MAX/SECS, pacing rule enforced by the simulated TWS with 162 pacing violations')
+    parser.add_argument('--duration', type=float, default=120., help='max seconds of the pipeline run after startup build')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='write the results to this file, e.g. to compare runs')
+    args = parser.parse_args()
+
+    result = run(args)
+    report(result)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(result, file, indent=2)
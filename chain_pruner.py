@@ -0,0 +1,66 @@
+from datetime import datetime
+
+from core import tprint
+
+
+class ChainPruner:
+    """
+    Prunes the expiry x strike cross product of an underlying before option contracts are built.
+
+    Filters (all configurable in Core):
+        - Days to expiry within [prune_min_dte, prune_max_dte]. Skipped for expired chains.
+        - Strikes within prune_moneyness_band of the underlying's last price, e.g. 0.5 keeps 50% - 150% of spot.
+        - Strikes actually listed for the expiry, if they were requested (prune_listed_strikes).
+
+    Counts built and pruned contracts, every pruned contract is a historical data request saved.
+    """
+    def __init__(self, core=None):
+        if core is None:
+            raise Exception('<ChainPruner INIT> All parameters must be specified.')
+
+        self.core = core
+
+        self.kept: int = 0
+        self.pruned: int = 0
+
+    def prune(self, stk: 'ContractContainer', expiries: list[str], last_price: float | None = None, expired: bool = False, **kwargs) -> dict[str, list[float]]:
+        """
+        Returns the strikes to build per expiry.
+
+        Args:
+            stk (ContractContainer): The stock ContractContainer holding strikes and listed strikes.
+            expiries (list[str]): Expiries to consider ('%Y%m%d').
+            last_price (float, optional): Last price of the underlying. Moneyness is not filtered if None.
+            expired (bool, optional): Chain of already expired options, skips the DTE filter. Defaults to False.
+
+        Returns:
+            dict[str, list[float]]: Strikes to build per remaining expiry.
+        """
+        today = datetime.today()
+        strikes = stk.get_strikes()
+
+        if last_price:
+            low, high = last_price * (1 - self.core.prune_moneyness_band), last_price * (1 + self.core.prune_moneyness_band)
+            strikes = [x for x in strikes if low <= x <= high]
+
+        chain = {}
+        for expiry in expiries:
+            if not expired:
+                dte = (datetime.strptime(expiry, '%Y%m%d') - today).days + 1
+                if not self.core.prune_min_dte <= dte <= self.core.prune_max_dte:
+                    self.pruned += len(stk.get_strikes()) * 2
+                    continue
+
+            listed = stk.get_listed_strikes(expiry)
+            expiry_strikes = [x for x in strikes if x in listed] if listed is not None else strikes
+
+            chain[expiry] = expiry_strikes
+            self.kept += len(expiry_strikes) * 2
+            self.pruned += (len(stk.get_strikes()) - len(expiry_strikes)) * 2
+
+        return chain
+
+    def report(self, **kwargs):
+        total = self.kept + self.pruned
+        pct = self.pruned / total * 100 if total else 0.
+        tprint(f'Chain pruning: {self.kept} contracts kept, {self.pruned} pruned ({pct:.1f}% of requests saved).')
@@ -0,0 +1,122 @@
+from queue import LifoQueue, Empty
+from threading import Lock
+from time import monotonic
+import pyodbc
+
+from core import tprint
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of persistent pyodbc connections.
+    One pool is shared by all DatabaseBroker instances of a Core (see ConnectionPool.shared).
+
+    Idle connections are health checked before reuse if they were idle longer than health_check_interval.
+    Broken connections are discarded and replaced by a fresh connection.
+    """
+    _shared_lock = Lock()
+
+    def __init__(self, connection_string: str = None, size: int = 4, health_check_interval: float = 60., acquire_timeout: float = 30.):
+        if connection_string is None:
+            raise Exception('<ConnectionPool INIT> All parameters must be specified.')
+
+        self.connection_string = connection_string
+        self.size = size
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+
+        self.idle: LifoQueue[tuple[pyodbc.Connection, float]] = LifoQueue()
+        self.opened: int = 0
+        self.lock = Lock()
+
+    @classmethod
+    def shared(cls, core) -> 'ConnectionPool':
+        """
+        Returns the pool stored on core, creating it on first use.
+        """
+        with cls._shared_lock:
+            if getattr(core, 'sql_pool', None) is None:
+                core.sql_pool = cls(connection_string=core.connection_string,
+                                    size=core.sql_pool_size,
+                                    health_check_interval=core.sql_health_check_interval,
+                                    acquire_timeout=core.sql_acquire_timeout)
+            return core.sql_pool
+
+    def acquire(self) -> pyodbc.Connection:
+        """
+        Hands out an idle connection, opens a new one while below size or blocks until one is released.
+
+        Raises:
+            TimeoutError: If no connection became available within acquire_timeout.
+
+        Returns:
+            pyodbc.Connection: A healthy connection.
+        """
+        try:
+            sql_con, last_used = self.idle.get_nowait()
+        except Empty:
+            with self.lock:
+                can_open = self.opened < self.size
+                if can_open:
+                    self.opened += 1
+            if can_open:
+                return self.connect()
+
+            try:
+                sql_con, last_used = self.idle.get(timeout=self.acquire_timeout)
+            except Empty:
+                raise TimeoutError(f'<ConnectionPool> No connection available within {self.acquire_timeout} seconds.')
+
+        if monotonic() - last_used >= self.health_check_interval and not self.is_healthy(sql_con):
+            self.close(sql_con)
+            return self.connect()
+
+        return sql_con
+
+    def release(self, sql_con: pyodbc.Connection, broken: bool = False):
+        """
+        Returns a connection to the pool. Broken connections are closed and their slot is freed.
+        """
+        if broken:
+            self.close(sql_con)
+            with self.lock:
+                self.opened -= 1
+        else:
+            self.idle.put((sql_con, monotonic()))
+
+    def connect(self) -> pyodbc.Connection:
+        try:
+            return pyodbc.connect(self.connection_string)
+        except pyodbc.Error:
+            with self.lock:
+                self.opened -= 1
+            raise
+
+    @staticmethod
+    def is_healthy(sql_con: pyodbc.Connection) -> bool:
+        try:
+            cursor = sql_con.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+            cursor.close()
+            return True
+        except pyodbc.Error:
+            tprint('Discarding broken SQL connection.')
+            return False
+
+    @staticmethod
+    def close(sql_con: pyodbc.Connection):
+        try:
+            sql_con.close()
+        except pyodbc.Error:
+            pass
+
+    def close_all(self):
+        while True:
+            try:
+                sql_con, _ = self.idle.get_nowait()
+            except Empty:
+                break
+            self.close(sql_con)
+            with self.lock:
+                self.opened -= 1
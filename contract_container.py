@@ -1,11 +1,39 @@
+from collections import deque
 from datetime import datetime
+from functools import lru_cache
 from ibapi.contract import Contract
-from database_broker import DatabaseBroker
+from bar_buffer import BarBuffer
+from storage_backend import StorageBackend, backend_class
+from threading import Event
+from time import monotonic
 from typing import NoReturn
 
 from core import tprint
 
+@lru_cache(maxsize=None)
+def option_series(symbol: str, expiry: str) -> tuple[datetime, str, str]:
+    """
+    Returns parsed expiry, database name and table name of an option series.
+    Cached, so all contracts of a series share one datetime and one set of name strings.
+    """
+    dt = datetime.strptime(expiry, '%Y%m%d')
+    return dt, f'Data_OPT_{dt.strftime('%b%y')}', f'{symbol.replace('.', '')}_OPT_{dt.strftime('%d%b%y')}'
+
+
 class ContractContainer:
+    """
+    Container to hold all related data of a IBAPI contract instance.
+
+    Uses __slots__ and allocates request state lazily, as one instance exists per option contract of the whole universe.
+    The ibapi Contract object is only built when a request is issued (get_contract) and released after it (release_contract).
+    """
+    __slots__ = ('core', 'symbol', 'secType', 'strike', 'right', 'expiry', 'conId', 'contract', 'price_data',
+                 'child_container', 'strikes', 'expiries', 'listed_strikes', 'error_flag', 'historical_data_end', 'request_events',
+                 'failed_requests', 'stream_since', 'stream_chunks', 'streamed_until')
+
+    callback_reqTypes: dict[str, str] = {'set_price_data': 'ReqHistData', 'set_conId': 'ReqConDetails',
+                                         'set_strexp': 'ReqExpStr', 'set_listed_strike': 'ReqOptChain'}  # inverse of set_reqId_assign
+
     def __init__(self, core, **kwargs):
         self.core = core
 
@@ -15,102 +43,217 @@ class ContractContainer:
         if not stk_cond and not opt_cond: # TODO: Change condition
             raise Exception('DataContainer: Invalid input to create security contract.')
 
-        self.price_data = {}
-        self.conId = None
-
-        self.child_container: list['ContractContainer'] = []
+        self.symbol: str = kwargs['symbol']
+        self.secType: str = kwargs['secType']
+        self.strike: float | None = kwargs.get('strike') if self.secType == 'OPT' else None
+        self.right: str | None = kwargs.get('right') if self.secType == 'OPT' else None
+        self.expiry: str | None = kwargs.get('lastTradeDateOrContractMonth') if self.secType == 'OPT' else None
 
-        self.build_contract(**kwargs)
-
-        self.strikes, self.expiries = [], []
+        self.contract: Contract | None = None
+        self.price_data: BarBuffer | None = None
+        self.conId = None
 
-        self.last_update = None
+        if self.secType == 'STK':
+            self.child_container: list['ContractContainer'] = []
+            self.strikes, self.expiries = [], []
+            self.listed_strikes: dict[str, set[float]] = {}
+        else:
+            self.child_container, self.strikes, self.expiries, self.listed_strikes = None, None, None, None
 
         self.error_flag = False
         self.historical_data_end = False
 
-        self.db = DatabaseBroker(self.core, self)
+        self.request_events: dict[int, Event] | None = None
+        self.failed_requests: dict[int, str] | None = None  # reqId: error class (tws_api.classify_error)
+        self.stream_since: float | None = None  # monotonic arrival of the first bar not yet flushed [core.stream_bars]
+        self.stream_chunks: deque[BarBuffer] | None = None  # chunks sealed by the TWS reader thread, not yet handed to the writer
+        self.streamed_until: datetime | None = None  # latest bar handed to the writer by flush_price_data
 
     def __str__(self) -> str:
-        match self.contract.secType:
+        match self.secType:
             case 'STK':
-                return f'<Data Container Instance> {self.contract.symbol} STK.'
+                return f'<Data Container Instance> {self.symbol} STK.'
             case 'OPT':
-                dt_s: str = datetime.strptime(self.contract.lastTradeDateOrContractMonth, "%Y%m%d").strftime("%d%b%y")
-                return f'<Data Container Instance> {self.contract.symbol} {self.contract.strike}{self.contract.right} {dt_s} OPT.'
+                dt_s: str = self.get_expiry(output_str_format='%d%b%y')
+                return f'<Data Container Instance> {self.symbol} {self.strike}{self.right} {dt_s} OPT.'
+
+    @property
+    def db(self) -> StorageBackend:
+        if self.core.db_broker is None:
+            backend_class(self.core).shared(self.core, CC=ContractContainer)
+        return self.core.db_broker
+
+    def build_contract(self, **kwargs) -> Contract:
+        contract: Contract = Contract()
+        contract.symbol = self.core.symbol_aliases.get(self.symbol, self.symbol)
+        contract.secType = self.secType
+        contract.exchange = 'SMART'
+        contract.currency = 'USD'
+
+        if self.secType == 'OPT':
+            contract.strike = self.strike
+            contract.right = self.right
+            contract.lastTradeDateOrContractMonth = self.expiry
+
+        return contract
+
+    def build_chain_contract(self, expiry: str, **kwargs) -> Contract:
+        """
+        Builds a partial OPT contract of this underlying for one expiry. reqContractDetails on it returns every listed strike.
+        """
+        if self.secType != 'STK':
+            raise Exception(f'Option chain contracts only available for contract instances of secType STK. Requested {self.symbol} of type {self.secType}.')
 
-    def build_contract(self, **kwargs):
-        self.contract: Contract = Contract()
-        self.contract.symbol = kwargs['symbol']
-        self.contract.secType = kwargs['secType']
-        self.contract.exchange = 'SMART'
-        self.contract.currency = 'USD'
+        contract: Contract = Contract()
+        contract.symbol = self.core.symbol_aliases.get(self.symbol, self.symbol)
+        contract.secType = 'OPT'
+        contract.exchange = 'SMART'
+        contract.currency = 'USD'
+        contract.lastTradeDateOrContractMonth = expiry
 
-        if kwargs['secType'] == 'OPT':
-            self.contract.strike = kwargs['strike'] if 'strike' in kwargs.keys() else None
-            self.contract.right = kwargs['right'] if 'right' in kwargs.keys() else None
-            self.contract.lastTradeDateOrContractMonth = kwargs['lastTradeDateOrContractMonth'] if 'lastTradeDateOrContractMonth' in kwargs.keys() else None
+        return contract
 
-    def get_last_price(self) -> float:
-        return self.price_data[list(self.price_data.keys())[-1]][0]
+    def get_spec(self, **kwargs) -> dict:
+        """
+        Returns the keyword arguments recreating this contract, e.g. in a writer process.
+        """
+        if self.secType == 'OPT':
+            return {'symbol': self.symbol, 'secType': self.secType, 'strike': self.strike, 'right': self.right,
+                    'lastTradeDateOrContractMonth': self.expiry}
+        return {'symbol': self.symbol, 'secType': self.secType}
 
-    def get_price_data(self) -> dict[datetime, list]:
-        return self.price_data
+    def get_price_data(self) -> BarBuffer:
+        return self.price_data if self.price_data is not None else BarBuffer(chunk=0)
 
-    def set_price_data(self, prices: dict[datetime, list]):
-        self.price_data[list(prices.keys())[0]] = list(prices.values())[0]
-        #print('Received: ', self.price_data)
+    def set_price_data(self, date: str, open_: float, high: float, low: float, close: float):
+        """
+        Appends one received bar to the columnar BarBuffer of the running request.
+        With core.stream_bars, the buffer is sealed as a chunk once it holds core.stream_chunk_bars bars
+        or its first bar arrived core.stream_flush_interval seconds ago.
+        """
+        if self.price_data is None:
+            self.price_data = BarBuffer(chunk=self.core.bar_buffer_chunk)
+            if self.core.stream_bars:
+                self.stream_since = monotonic()
+        self.price_data.append(date, open_, high, low, close)
+
+        if self.stream_since is not None and (len(self.price_data) >= self.core.stream_chunk_bars
+                                              or monotonic() - self.stream_since >= self.core.stream_flush_interval):
+            self.seal_price_data()
+
+    def seal_price_data(self, **kwargs):
+        """
+        Detaches the bars received so far as one streamed chunk, the next bar starts a new buffer.
+        Runs in the TWS reader thread, so it only queues the chunk to self.stream_chunks and wakes the request thread,
+        which hands it to the writer (flush_price_data). A full writable pool never holds back the connection's callbacks.
+        """
+        if self.stream_chunks is None:
+            self.stream_chunks = deque()
+        self.stream_chunks.append(self.price_data)
+        self.price_data, self.stream_since = None, None
+        self.core.request_signal.set()
+
+    def flush_price_data(self, final: bool = False, **kwargs):
+        """
+        Hands the sealed chunks to the writable pool, in the order they were received. Runs in the request thread.
+
+        Each chunk is written after the stored watermark and after the bars of earlier chunks (streamed_until),
+        so bars repeated by a retried request are not written twice.
+
+        Args:
+            final (bool, optional): Also hands over the bars received since the last chunk, as last chunk of the contract.
+                                    Its acknowledgement commits the watermark (PipelineHandler.acknowledge). Defaults to False.
+
+        :output: self.core.writable_pool :appending (contract, bars, last stored bar, final)
+        """
+        chunks = []
+        while self.stream_chunks:
+            chunks.append((self.stream_chunks.popleft(), False))
+        if final:
+            chunks.append((self.get_price_data(), True))
+            self.price_data, self.stream_since = None, None
+
+        for price_data, last in chunks:
+            last_stored = self.get_last_update()
+            if self.streamed_until is not None and (last_stored is None or self.streamed_until > last_stored):
+                last_stored = self.streamed_until
+            if price_data:
+                self.streamed_until = price_data.last() if last_stored is None else max(last_stored, price_data.last())
+
+            self.core.metrics.inc('bars_received', len(price_data), secType=self.secType)
+            if not last:
+                self.core.metrics.inc('stream_chunks', secType=self.secType)
+            self.core.writable_pool.put((self, price_data, last_stored, last))
+
+    def has_stream_chunks(self, **kwargs) -> bool:
+        return bool(self.stream_chunks)
+
+    def has_streamed(self, **kwargs) -> bool:
+        return self.streamed_until is not None or bool(self.stream_chunks)
+
+    def release_price_data(self, **kwargs):
+        """
+        Drops the bar buffer once it is written, so received bars do not stay resident for the contract's lifetime.
+        """
+        self.price_data, self.stream_since, self.stream_chunks = None, None, None
 
     def check_conId(self) -> bool:
-        if self.contract.secType == 'STK' and self.conId is None:
+        if self.secType == 'STK' and self.conId is None:
             return False
         return True
 
     def get_conId(self) -> int:
         return self.conId
 
-    def set_conId(self, conId: int):
+    def set_conId(self, conId: int, **kwargs):
         self.conId = conId
 
     def get_contract(self) -> Contract:
+        if self.contract is None:
+            self.contract = self.build_contract()
         return self.contract
 
+    def release_contract(self, force: bool = False, **kwargs):
+        if self.secType == 'OPT' or force:
+            self.contract = None
+
     def get_secType(self) -> str:
-        return self.contract.secType
+        return self.secType
 
     def get_right(self) -> str:
-        return self.contract.right
+        return self.right
 
     def get_strike(self) -> int | float:
-        if self.contract.secType == 'STK':
-            raise Exception(f'Strike only available for contract instances of secType OPT. Requested {self.contract.symbol} of type {self.contract.secType}.')
-        return self.contract.strike
+        if self.secType == 'STK':
+            raise Exception(f'Strike only available for contract instances of secType OPT. Requested {self.symbol} of type {self.secType}.')
+        return self.strike
 
     def get_symbol(self) -> str:
-        return self.contract.symbol
+        return self.symbol
 
     def get_expiries(self, ** kwargs) -> list[int]:
-        if self.contract.secType != 'STK':
-            raise Exception(f'Expiry lists only available for contract instances of secType STK. Requested {self.contract.symbol} of type {self.contract.secType}.')
+        if self.secType != 'STK':
+            raise Exception(f'Expiry lists only available for contract instances of secType STK. Requested {self.symbol} of type {self.secType}.')
         elif not self.expiries:
-            #tprint(f'No expiry data available for {self.contract.symbol}.')
+            #tprint(f'No expiry data available for {self.symbol}.')
             return []
         else:
             return self.expiries
 
     def get_expiry(self, dt_object: bool = False, output_str_format: str = '%Y%m%d', ** kwargs) -> datetime | str | None:
-        if self.contract.secType != 'OPT':
-            raise Exception(f'Expiry date only available for contract instances of secType OPT. Requested {self.contract.symbol} of type {self.contract.secType}.')
+        if self.secType != 'OPT':
+            raise Exception(f'Expiry date only available for contract instances of secType OPT. Requested {self.symbol} of type {self.secType}.')
 
-        dt = datetime.strptime(self.contract.lastTradeDateOrContractMonth, '%Y%m%d')
         if dt_object:
-            return dt
+            return option_series(self.symbol, self.expiry)[0]
+        elif output_str_format == '%Y%m%d':
+            return self.expiry
         else:
-            return dt.strftime(output_str_format)
+            return option_series(self.symbol, self.expiry)[0].strftime(output_str_format)
 
     def get_strikes(self) -> list:
-        if self.contract.secType != 'STK':
-            raise Exception(f'Expiry dates only available for contract instances of secType STK. Requested {self.contract.symbol} of type {self.contract.secType}.')
+        if self.secType != 'STK':
+            raise Exception(f'Expiry dates only available for contract instances of secType STK. Requested {self.symbol} of type {self.secType}.')
 
         if not self.strikes:
             return []
@@ -123,7 +266,22 @@ class ContractContainer:
         for x in strikes:
             if x not in self.strikes: self.strikes.append(x)
 
-    def set_reqId_assign(self, reqId: int, reqType: str, ** kwargs):
+    def get_listed_strikes(self, expiry: str, **kwargs) -> set[float] | None:
+        """
+        Returns the strikes listed for one expiry, None if they were not requested.
+        """
+        if self.secType != 'STK':
+            raise Exception(f'Listed strikes only available for contract instances of secType STK. Requested {self.symbol} of type {self.secType}.')
+        return self.listed_strikes.get(expiry)
+
+    def set_listed_strike(self, conId: int, contract: Contract, **kwargs):
+        self.listed_strikes.setdefault(contract.lastTradeDateOrContractMonth, set()).add(contract.strike)
+
+    def set_listed_strikes(self, listed_strikes: dict[str, list[float]], **kwargs):
+        for expiry, strikes in listed_strikes.items():
+            self.listed_strikes.setdefault(expiry, set()).update(strikes)
+
+    def set_reqId_assign(self, reqId: int, reqType: str, append: bool = False, ** kwargs):
         """
         Assigns a request ID to a specific request type.
 
@@ -133,46 +291,150 @@ class ContractContainer:
                 Supported methods:  ReqHistData -> self.set_price_data
                                     ReqConDetails -> self.set_conId
                                     ReqExpStr -> self.set_strexp
+                                    ReqOptChain -> self.set_listed_strike
+            append (bool, optional): ReqHistData only. Keeps the received bars and flags of the running request,
+                                     for further chunks of one split request. Defaults to False.
         Raises:
             AttributeError: If the reqType is not one of the valid options.
 
         Returns:
             None
         """
+        if self.request_events is None:
+            self.request_events = {}
+        self.request_events[reqId] = Event()
+
         match reqType:
             case 'ReqHistData':
-                self.core.reqId_hashmap[reqId] = self.set_price_data
+                if not append:
+                    self.error_flag = False
+                    self.historical_data_end = False
+                    self.price_data = None
+                    self.stream_since, self.stream_chunks, self.streamed_until = None, None, None
+                self.core.reqId_hashmap.register(reqId, self.set_price_data)
             case 'ReqConDetails':
-                self.core.reqId_hashmap[reqId] = self.set_conId
+                self.core.reqId_hashmap.register(reqId, self.set_conId)
             case 'ReqExpStr':
-                self.core.reqId_hashmap[reqId] = self.set_strexp
+                self.core.reqId_hashmap.register(reqId, self.set_strexp)
+            case 'ReqOptChain':
+                self.core.reqId_hashmap.register(reqId, self.set_listed_strike)
             case _:
-                raise AttributeError('Invalid reqType. Valid options: ReqHistData, ReqConDetails, ReqExpStr')
+                raise AttributeError('Invalid reqType. Valid options: ReqHistData, ReqConDetails, ReqExpStr, ReqOptChain')
+
+    def get_reqType(self, reqId: int, **kwargs) -> str | None:
+        """
+        Returns the reqType a request ID was assigned with by set_reqId_assign, None if it is not assigned.
+        """
+        callback = self.core.reqId_hashmap.get(reqId)
+        return self.callback_reqTypes.get(callback.__name__) if callback is not None else None
+
+    def set_request_done(self, reqId: int, **kwargs):
+        """
+        Signals completion of a request, either by its end callback or by an error.
+        Wakes threads blocking in wait_request and the request window in PipelineHandler.
+        """
+        if self.request_events and reqId in self.request_events:
+            self.request_events[reqId].set()
+        self.core.request_signal.set()
+
+    def is_request_done(self, reqId: int, **kwargs) -> bool:
+        return bool(self.request_events) and reqId in self.request_events and self.request_events[reqId].is_set()
+
+    def set_request_failed(self, reqId: int, error_class: str = 'error', **kwargs):
+        """
+        Marks a single request as failed. Unlike the error flag, this tells apart the chunks of a split request.
+        """
+        if self.failed_requests is None:
+            self.failed_requests = {}
+        self.failed_requests[reqId] = error_class
+
+    def is_request_failed(self, reqId: int, **kwargs) -> bool:
+        return bool(self.failed_requests) and reqId in self.failed_requests
+
+    def get_request_error(self, reqId: int, **kwargs) -> str | None:
+        return self.failed_requests.get(reqId) if self.failed_requests else None
+
+    def wait_request(self, reqId: int, timeout: float = None, **kwargs) -> bool:
+        """
+        Blocks until the request is signalled as done or the timeout is reached.
+
+        Args:
+            reqId (int): The request ID to wait for.
+            timeout (float, optional): Seconds to wait at most. Defaults to None (no timeout).
+
+        Returns:
+            bool: True if the request completed, False on timeout.
+        """
+        event = self.request_events.get(reqId) if self.request_events else None
+        done = event.wait(timeout=timeout) if event else True
+        self.release_request(reqId)
+        return done
+
+    def release_request(self, reqId: int, **kwargs):
+        """
+        Drops the state of a retired request, including its core.reqId_hashmap entry if it timed out before TWS completed it.
+        """
+        self.core.reqId_hashmap.release(reqId)
+        if self.request_events:
+            self.request_events.pop(reqId, None)
+            if not self.request_events:
+                self.request_events = None
+        if self.failed_requests:
+            self.failed_requests.pop(reqId, None)
+            if not self.failed_requests:
+                self.failed_requests = None
 
     def register_derivative_child(self, child: 'ContractContainer', ** kwargs):
         self.child_container.append(child)
 
     def get_last_update(self, response: bool = True, ** kwargs) -> datetime | NoReturn:
-        if not self.last_update:
-            self.last_update = self.db.get_last_update(contract_container=self)
+        """
+        Returns the latest stored bar of this contract from the shared WatermarkIndex.
+        On first access to a table all watermarks of that table are loaded with one grouped query.
+        """
+        if not self.core.watermarks.is_loaded(self):
+            self.core.watermarks.load(self, rows=self.db.get_table_watermarks(contract_container=self))
         if response:
-            return self.last_update
+            return self.core.watermarks.get(self)
+
+    def get_next_due(self, **kwargs) -> datetime | None:
+        """
+        Computes when this option is due for its next price refresh.
+
+        The contract is due once (now - last_update) >= max(opt_refresh_ratio * (expiry - now), opt_min_refresh),
+        solved for now. Never updated contracts are due immediately.
+
+        Returns:
+            datetime | None: The due time, None if no refresh is due before expiry (left to the EXP pool).
+        """
+        expiry = self.get_expiry(dt_object=True)
+        if expiry <= datetime.now():
+            return None
+
+        last_update = self.get_last_update()
+        if not last_update:
+            return datetime.now()
+
+        ratio = self.core.opt_refresh_ratio
+        due = max(last_update + self.core.opt_min_refresh, last_update + (expiry - last_update) * (ratio / (1 + ratio)))
+
+        return due if due < expiry else None
 
     def get_database(self, ** kwargs) -> str:
-        match self.contract.secType:
+        match self.secType:
             case 'STK':
                 return f'Data_STK'
             case 'OPT':
-                return f'Data_OPT_{datetime.strptime(self.contract.lastTradeDateOrContractMonth, '%Y%m%d').strftime('%b%y')}'
+                return option_series(self.symbol, self.expiry)[1]
             case _:
                 raise KeyError('Security type not supported. Valid secTypes: STK, OPT')
 
     def get_table(self, **kwargs) -> str:
-        match self.contract.secType:
+        match self.secType:
             case 'STK':
-                return f'{self.contract.symbol.replace(".", "")}_STK'
+                return f'{self.symbol.replace(".", "")}_STK'
             case 'OPT':
-                return f'{self.contract.symbol}_OPT_{datetime.strptime(self.contract.lastTradeDateOrContractMonth, '%Y%m%d').strftime("%d%b%y")}'
+                return option_series(self.symbol, self.expiry)[2]
             case _:
                 raise KeyError('Security type not supported. Valid secTypes: STK, OPT')
 
@@ -180,7 +442,7 @@ class ContractContainer:
         return self.error_flag
 
     def set_error_flag(self, flag: bool = False, **kwargs):
-        #print(f'Error flag set for {self.contract.symbol}.')
+        #print(f'Error flag set for {self.symbol}.')
         self.error_flag = flag
 
     def get_last_price(self, **kwargs) -> float:
@@ -1,6 +1,12 @@
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import os
+from threading import Event
+
+from metrics import Metrics
+from pools import ContractQueue, DueTimeScheduler
+from request_registry import RequestRegistry
+from watermark_index import WatermarkIndex
 
 
 class Core:
@@ -10,6 +16,9 @@ class Core:
         self.host_ip: str = os.getenv('HOST_IP')
         self.api_port: int = int(os.getenv('API_PORT'))
         self.client_id: int = int(os.getenv('CLIENT_ID'))
+        self.client_ids: list[int] = [int(x) for x in os.getenv('CLIENT_IDS', str(self.client_id)).split(',')]  # one TWS connection per client ID, e.g. CLIENT_IDS=1,2,3
+        self.reconnect_delay: float = 5.  # seconds between attempts to reconnect a lost TWS connection, doubled per failed attempt ...
+        self.reconnect_max_delay: float = 120.  # ... up to this many seconds
 
         # Microsoft SQL Server Credentials
         self.sql_server: str = os.getenv('SQL_SERVER')
@@ -17,30 +26,114 @@ class Core:
         self.sql_password: str = os.getenv('SQL_PASSWORD')
         self.connection_string: str = f'DRIVER={{ODBC Driver 17 for SQL Server}};SERVER={self.sql_server};UID={self.sql_user};PWD={self.sql_password}'
 
+        self.storage_backend: str = 'sql'  # 'sql': SQL Server (DatabaseBroker) | 'parquet': local columnar files (ParquetBroker, requires pyarrow)
+        self.table_structure: dict[str, set[str]] = {}  # table catalog {database: {tables}}, loaded once per run
+        self.db_broker = None  # StorageBackend shared by all ContractContainer instances, created on first use
+
+        self.sql_pool = None  # shared ConnectionPool, created by the first DatabaseBroker
+        self.sql_pool_size: int = 4  # max open connections
+        self.sql_health_check_interval: int = 60  # seconds a connection may idle before it is checked on reuse
+        self.sql_acquire_timeout: int = 30  # seconds to wait for a free connection
+        self.ddl_batch_size: int = 200  # CREATE TABLE statements per batch when provisioning tables
+        self.sql_schema_mode: str = 'legacy'  # 'legacy': identifier, callput, strike per option row | 'compact': contract_key into the contract dimension table
+        self.sql_index_tables: bool = True  # clustered index on new legacy tables, compact tables always have a clustered primary key
+        self.sql_page_compression: bool = False  # PAGE compression of new tables (SQL Server 2016 SP1+)
+        self.sql_contract_table: str = 'Contracts'  # contract dimension table in every option database [compact schema]
+
+        self.parquet_root: str = 'price_data'  # root directory of the parquet store: <root>/<database>/<table>/part-*.parquet
+        self.parquet_compression: str = 'zstd'
+        self.parquet_flush_rows: int = 250_000  # buffered rows of a table before they are written as one part file
+        self.parquet_flush_interval: int = 300  # seconds after which all buffered rows are written
+
         self.stk_last_update: datetime = datetime.fromtimestamp(float(os.getenv('STK_LAST_UPDATE')))
         self.exp_last_update: datetime = datetime.fromtimestamp(float(os.getenv('EXP_LAST_UPDATE')))
 
-        self.reqId_hashmap: dict = {}
+        self.reqId_hashmap: RequestRegistry = RequestRegistry()  # callbacks of the open requests, released once a request completes
         self.reqId_1: int = 1
         self.reqId_2: int = 100_000_000
 
+        self.request_signal: Event = Event()  # set by TWSCon callbacks whenever a request completes
+        self.request_signal_timeout: float = 1.  # max seconds the request window sleeps without a signal
+        self.universe_cache_path: str = 'contract_universe.pkl'  # on-disk cache of conIds, expiries and strikes per underlying
+        self.universe_cache_ttl: timedelta = timedelta(days=7)  # cached underlyings older than this are refreshed from TWS
+        self.contract_details_timeout: int = 10  # seconds to wait for reqContractDetails
+        self.sec_def_timeout: int = 5  # seconds to wait for reqSecDefOptParams
+        self.discovery_max_inflight: int = 50  # concurrent contract details / sec-def requests during chain discovery
+        self.discovery_retries: int = 2  # retries per failed or timed out discovery request
+        self.api_message_rate: int = 40  # max API messages per second sent during discovery (TWS limit: 50)
+        self.symbol_aliases: dict[str, str] = {}  # symbol -> TWS spelling, e.g. 'BRK.B' -> 'BRK B'. Filled on retry
+
+        self.watermarks: WatermarkIndex = WatermarkIndex()  # latest stored bar per contract
+
         self.underlying_list: dict[str, str] = self.underlyings()
 
-        self.contract_pool: dict[str, list[object]] = {
+        self.randomize_opts = True  # random order among equally due OPT contracts
+
+        self.contract_pool: dict[str, list[object] | ContractQueue | DueTimeScheduler] = {
                                                         'STK': [],
-                                                        'OPT': [],
-                                                        'EXP': []}
+                                                        'OPT': DueTimeScheduler(randomize=self.randomize_opts),
+                                                        'EXP': ContractQueue()}
+
+        # OPT refresh rule: due once (now - last_update) >= max(opt_refresh_ratio * (expiry - now), opt_min_refresh)
+        self.opt_refresh_ratio: float = .5
+        self.opt_min_refresh: timedelta = timedelta(days=30)
 
-        self.immediate_pool: list = []
         self.ip_length: int = 10
+        self.immediate_pool: ContractQueue = ContractQueue(maxsize=self.ip_length, signal=self.request_signal)
+
+        self.wp_length: int = 50
+        self.writable_pool: ContractQueue = ContractQueue(maxsize=self.wp_length)
 
-        self. writable_pool: list = []
+        # Pipeline metrics, exported by metrics.start(core) through a pull endpoint and/or a snapshot file
+        self.metrics: Metrics = Metrics()
+        self.metrics.register_gauge('pool_depth', self.pool_depths)
+        self.metrics.register_gauge('reqIds_live', self.reqId_hashmap.live)
+        self.metrics_host: str = '127.0.0.1'
+        self.metrics_port: int | None = None  # e.g. 9108 serves /metrics (Prometheus text format) and /metrics.json
+        self.metrics_snapshot_path: str | None = 'metrics.json'  # rewritten every metrics_snapshot_interval seconds, None disables
+        self.metrics_snapshot_interval: int = 30
 
         self.candle_length: str = '15 mins'  # candle length in minutes to build history. Legal units: 1 secs, 5 secs, 10 secs, 15 secs, 30 secs, 1 min, 2 mins, 3 mins, 5 mins, 10 mins, 15 mins, 20 mins, 30 mins, 1 hour, 2 hours, 3 hours, 4 hours, 8 hours, 1 day, 1W, 1M
 
         self.timeout_breaker: dict[int, int] = {4: 20, 8: 40, 26: 120, 52: 180, 9999: 300}
 
-        self.insert_query_max_lines: int = 995
+        # Historical data request window and IBKR pacing limits
+        self.max_inflight_requests: int = 10  # outstanding reqHistoricalData requests at once
+        self.hist_chunk_days: int | None = None  # max days per reqHistoricalData, longer gaps are split into chunks requested in parallel. None: hist_max_days
+        self.hist_max_days: dict[str, int] = {'1 min': 30, '2 mins': 30, '3 mins': 30, '5 mins': 365, '10 mins': 365, '15 mins': 365,
+                                              '20 mins': 365, '30 mins': 365, '1 hour': 365, '2 hours': 365, '3 hours': 365, '4 hours': 365,
+                                              '8 hours': 365, '1 day': 3650, '1W': 3650, '1M': 3650}  # largest duration TWS allows per bar size in days, second bars: 1
+        self.hist_pacing_max_requests: int = 60  # requests ...
+        self.hist_pacing_period: int = 600  # ... within this many seconds
+        self.hist_identical_cooldown: int = 15  # seconds before an identical request may be repeated
+        self.hist_same_contract_max: int = 6  # requests for the same contract ...
+        self.hist_same_contract_period: int = 2  # ... within this many seconds
+        self.hist_pacing_burst: int = 5  # requests sent at once before the global rate applies, which is (max requests - burst) per period
+        self.hist_backoff_factor: float = .5  # rate multiplier per pacing violation reported by TWS ...
+        self.hist_min_rate_factor: float = .1  # ... down to this share of the configured rate
+        self.hist_recovery_step: float = .05  # share of the rate regained per request completed without violation
+        self.hist_penalty_wait: int = 30  # seconds a connection pauses after a pacing violation, doubled per consecutive violation ...
+        self.hist_penalty_max: int = 600  # ... up to this many seconds
+        self.hist_max_attempts: int = 4  # sends of a request window before a timeout or retryable error drops it
+        self.hist_retry_delay: float = 5.  # seconds before the first retry, doubled per attempt and jittered by +-50%
+        self.hist_failed_reschedule: timedelta = timedelta(hours=1)  # OPT contracts without any received bars are due again after this
+
+        self.dedup_exact_check: bool = False  # additionally query stored dates overlapping the received bars, else dedup by watermark only
+        self.bulk_insert: bool = True  # parameterized fast_executemany inserts, else string built INSERT queries
+        self.insert_query_max_lines: int = 995  # rows per string built INSERT query
+        self.bar_buffer_chunk: int = 512  # bars a BarBuffer grows by at a time
+        self.writer_processes: int = 0  # writer processes, partitioned by table. 0 writes in the PipelineHandler thread
+        self.writer_queue_length: int = 20  # queued contracts per writer process
+        self.stream_bars: bool = False  # write the bars of a contract in chunks while its requests are arriving, its windows are then requested one at a time
+        self.stream_chunk_bars: int = 5_000  # bars per streamed chunk ...
+        self.stream_flush_interval: float = 10.  # ... or seconds since the first bar of the chunk arrived
+
+        # Option chain pruning before contracts are built
+        self.prune_chains: bool = True
+        self.prune_moneyness_band: float = .5  # keep strikes within +-50% of the underlying's last price
+        self.prune_min_dte: int = 0  # keep expiries with at least this many days to expiry ...
+        self.prune_max_dte: int = 730  # ... and at most this many
+        self.prune_listed_strikes: bool = False  # request listed strikes per expiry (one reqContractDetails per expiry, cached)
 
         self.expired_opt_days = 2  # within this many days, an option is considered expired (inclusive)
 
@@ -53,8 +146,6 @@ class Core:
         self.timer_exclude_days: list[int] = [5, 6]
         self.startup = True
 
-        self.randomize_opts = True
-
 
     def underlyings(self) -> dict[str, list[str]]:
         underlyings: dict = {'STK': ['USO', 'SPY', 'QQQ', 'IWM', 'GLD', 'TLT', 'IEF', 'LQD',
@@ -113,6 +204,19 @@ class Core:
                                           'AAL', 'ETSY', 'BIO']}
         return underlyings
 
+    def pool_depths(self) -> dict[str, int]:
+        return {'STK': len(self.contract_pool['STK']),
+                'OPT': len(self.contract_pool['OPT']),
+                'EXP': len(self.contract_pool['EXP']),
+                'immediate': len(self.immediate_pool),
+                'writable': len(self.writable_pool)}
+
+    def settings(self) -> dict:
+        """
+        Returns the scalar settings (str, int, float, bool, None, datetime, timedelta), e.g. to configure the Core of a writer process.
+        """
+        return {k: v for k, v in vars(self).items() if v is None or isinstance(v, (str, int, float, bool, datetime, timedelta))}
+
     def set_TWSCon(self, TWSCon):
         self.TWSCon = TWSCon
         print(123)
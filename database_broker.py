@@ -1,126 +1,171 @@
 from datetime import datetime
-from ibapi.contract import Contract
+from functools import wraps
 import pyodbc
+from threading import Lock, RLock
+from time import monotonic
+from typing import Iterable
 
+from connection_pool import ConnectionPool
+from core import tprint
+from storage_backend import StorageBackend
 
-class DatabaseBroker():
+
+class DatabaseBroker(StorageBackend):
     """
-    Container to hold all related data of a IBAPI contract instance.
+    StorageBackend for Microsoft SQL Server over ODBC.
     Written for T-SQL.
     """
+    _catalog_lock = RLock()
+    _key_lock = Lock()
+
     def __init__(self, core=None, CC=None):
-        if None in (core, CC):
-            raise Exception('<DatabaseBroker INIT> All parameters must be specified.')
+        super().__init__(core=core, CC=CC)
         self.connection_string = core.connection_string
+        self.pool: ConnectionPool = ConnectionPool.shared(core)
 
-        self.table_structure = {}
+        self.contract_keys: dict[tuple, int] = {}  # (database, symbol, expiry, strike, right): contract_key [compact schema]
+        self.loaded_series: set[tuple[str, str]] = set()  # (database, table) whose contract keys are cached
 
         self.sql_ignore = ['master', 'tempdb', 'model', 'msdb']
 
-        self.ContractContainer = CC
-        pass
 
     def sql_query(func) -> object:
-        def con_wrapper(self, *args, **kwargs):
-            sql_con: pyodbc.Connection = pyodbc.connect(self.connection_string)
-            #print(f'Con opened for {func.__name__}')
-
-            cursor: pyodbc.Cursor = sql_con.cursor()
-            #print('Cursor opened')
-            # print('Args', args)
-            # print('Kwargs', kwargs)
-            result = func(self, cursor = cursor, conn = sql_con, *args, **kwargs) or {}
-
-            if isinstance(result, dict) and 'commit' in result.keys():
-                sql_con.commit()
-
-            cursor.close()
-            #print('Cursor closed')
-            sql_con.close()
-            #print('Con closed')
+        """
+        Provides cursor and connection from the shared ConnectionPool to the wrapped method.
 
-            return result['data'] if isinstance(result, dict) and 'commit' in result.keys() else None
+        Connections which fail with a connection level error are discarded and the call is retried once on a fresh connection,
+        as long as the failure happened before the commit.
+        The duration of every call, including the wait for a connection, is recorded per method in core.metrics (db_seconds).
+        """
+        @wraps(func)
+        def con_wrapper(self, *args, **kwargs):
+            start = monotonic()
+            try:
+                for attempt in range(2):
+                    sql_con: pyodbc.Connection = self.pool.acquire()
+                    cursor: pyodbc.Cursor = sql_con.cursor()
+                    committing = False
+                    try:
+                        result = func(self, cursor = cursor, conn = sql_con, *args, **kwargs) or {}
+
+                        if isinstance(result, dict) and 'commit' in result.keys():
+                            committing = True
+                            sql_con.commit()
+
+                        cursor.close()
+                        self.pool.release(sql_con)
+
+                        return result['data'] if isinstance(result, dict) and 'commit' in result.keys() else None
+
+                    except (pyodbc.OperationalError, pyodbc.InterfaceError):
+                        self.pool.release(sql_con, broken=True)
+                        if attempt or committing:
+                            raise
+                        tprint(f'SQL connection lost in {func.__name__}. Reconnecting.')
+
+                    except Exception:
+                        try:
+                            sql_con.rollback()
+                            cursor.close()
+                            self.pool.release(sql_con)
+                        except pyodbc.Error:
+                            self.pool.release(sql_con, broken=True)
+                        raise
+            except Exception:
+                self.core.metrics.inc('db_errors', method=func.__name__)
+                raise
+            finally:
+                self.core.metrics.observe('db_seconds', monotonic() - start, method=func.__name__)
 
         return con_wrapper
 
     @sql_query
-    def fetch_all_table_names(self, cursor: pyodbc.Cursor, db_name: str = None, return_data: bool = False, **kwargs) -> dict[str: None | dict[str, list[str]], str: bool]:
+    def fetch_all_table_names(self, cursor: pyodbc.Cursor, db_name: str = None, return_data: bool = False, **kwargs) -> dict[str: None | dict[str, set[str]], str: bool]:
         """
             Fetches the names of all tables in the database.
 
             This method queries the database for the names of all tables in all databases,
-            excluding the databases listed in `self.sql_ignore`. The results are returned
-            as a dictionary where the keys are the database names and the values are lists
+            excluding the databases listed in `self.sql_ignore`. All databases are read with a single
+            UNION ALL query over their sys.tables. The results are stored in the shared catalog
+            self.table_structure, where the keys are the database names and the values are sets
             of table names.
 
             Args:
                 cursor (object): The database cursor. [Provided by wrapper]
-                db_name (str, optional): The name of the database. Defaults to None.
+                db_name (str, optional): The name of the database. Defaults to None (all databases).
 
             Returns:
                 dict: A dictionary containing not data a flag indicating if the operation needs to be committed.
             """
 
-        query = 'SELECT name FROM sys.databases'
-        cursor.execute(query)
         if db_name is None:
+            query = 'SELECT name FROM sys.databases'
+            cursor.execute(query)
             database_names = [x[0] for x in cursor.fetchall() if x[0] not in self.sql_ignore]
         else:
             database_names = [db_name]
 
-        for db in database_names:
-            query = f'USE [{db}]'
-            cursor.execute(query)
-            query = f'SELECT name FROM sys.tables'
+        catalog = {db: set() for db in database_names}
+        if database_names:
+            query = ' UNION ALL '.join(f"SELECT N'{db}', name FROM [{db}].sys.tables" for db in database_names)
             cursor.execute(query)
+            for db, table in cursor.fetchall():
+                catalog[db].add(table)
 
-            self.table_structure[db] = [x[0] for x in cursor.fetchall()]
+        with self._catalog_lock:
+            self.table_structure.update(catalog)
 
         if return_data:
             return {'data': self.table_structure, 'commit': False}
         else:
             return {'data': None, 'commit': False}
 
-    @sql_query
-    def check_table_exists(self, cursor: pyodbc.Cursor, contract_container: "ContractContainer", create_missing: bool = True, **kwargs) -> dict[str: None, str: bool]:
+    def provision_tables(self, contract_containers: "Iterable[ContractContainer]", **kwargs) -> int:
         """
-         Check if a database and a table exists for a given contract.
+        Creates all missing databases and tables for the given contracts.
 
-         Args:
-             cursor (pyodbc.Cursor): The database cursor. [Provided by wrapper]
-             contract (Contract): The contract object.
-             create_missing (bool, optional): Whether to create the table if it doesn't exist. Defaults to True.
+        Missing databases are created in one autocommit batch (CREATE DATABASE is not allowed in a transaction),
+        all missing tables in one transaction of batched CREATE TABLE statements. The catalog is updated afterwards,
+        so later existence checks are dictionary lookups.
 
-         Returns:
-             dict: A dictionary containing the latest update and a flag indicating if the operation needs to be committed.
-         """
+        Args:
+            contract_containers (Iterable[ContractContainer]): Contracts whose tables must exist.
 
-        if self.table_structure == {}:
+        Returns:
+            int: Number of created tables.
+        """
+        if not self.table_structure:
             self.fetch_all_table_names()
 
-        contract = contract_container.get_contract()
-        match contract.secType:
-            case 'STK':
-                database_name = 'Data_STK'
-                table_name = f'{contract.symbol.replace('.', '')}_STK'
-            case 'OPT':
-                database_name = f'Data_OPT_{datetime.strptime(contract.lastTradeDateOrContractMonth, '%Y%m%d').strftime('%b%y')}'
-                table_name = f'{contract.symbol.replace('.', '')}_OPT_{datetime.strptime(contract.lastTradeDateOrContractMonth, '%Y%m%d').strftime('%d%b%y')}'
-            case _:
-                raise KeyError(f'Security type {contract.secType} not supported.')
+        with self._catalog_lock:
+            missing = self.missing_tables(contract_containers=contract_containers)
+            if not missing:
+                return 0
 
-        if create_missing:
-            if database_name not in self.table_structure.keys():
-                print(f'Create database {database_name}')
-                self.create_database(db_name=database_name)
-                self.fetch_all_table_names(database=database_name)
+            new_databases = sorted({db for db, _ in missing.keys() if db not in self.table_structure})
+            if new_databases:
+                tprint(f'Create databases {", ".join(new_databases)}')
+                self.create_databases(db_names=new_databases)
+                for db in new_databases:
+                    self.table_structure[db] = set()
 
-            if table_name not in self.table_structure[database_name]:
-                print(f'Create table {table_name}')
-                self.create_table(db_name=database_name, table_name=table_name)
-                self.fetch_all_table_names(database=database_name)
+            statements = []
+            if self.core.sql_schema_mode == 'compact':
+                for db in sorted({db for (db, _), secType in missing.items() if secType == 'OPT'}):
+                    if self.core.sql_contract_table not in self.table_structure[db]:
+                        statements.append(self.dimension_ddl(db_name=db))
+                        missing[(db, self.core.sql_contract_table)] = 'DIM'
 
-        return {'data': None, 'commit': False}
+            tprint(f'Create {len(missing)} tables')
+            statements += [self.table_ddl(db_name=db, table_name=table, secType=secType) for (db, table), secType in missing.items() if secType != 'DIM']
+            self.create_tables(statements=statements)
+            for db, table in missing.keys():
+                self.table_structure[db].add(table)
+
+        return len(missing)
+
+    def close(self, **kwargs):
+        self.pool.close_all()
 
     @sql_query
     def get_last_update(self, cursor: pyodbc.Cursor, contract_container: "ContractContainer", **kwargs) -> dict[str: datetime, str: bool]:
@@ -139,39 +184,78 @@ class DatabaseBroker():
             dict: A dictionary containing the latest update and a flag indicating if the operation was committed.
         """
 
-        contract = contract_container.get_contract()
         database = contract_container.get_database()
         table = contract_container.get_table()
-        match contract.secType:
+        contract_filter = self.contract_filter(cursor=cursor, contract_container=contract_container)
+        if contract_filter is None:
+            return {'data': None, 'commit': False}
+        conditions, params = contract_filter
+
+        query = f"""
+                SELECT MAX(date)
+                FROM [{database}].[dbo].[{table}]
+                {'WHERE ' + ' AND '.join(conditions) if conditions else ''};
+                """
+
+        cursor.execute(query, *params)
+        last_update = cursor.fetchone()
+        last_update = last_update[0] if last_update is not None else None
+
+        return {'data': last_update, 'commit': False}
+
+    @sql_query
+    def get_table_watermarks(self, cursor: pyodbc.Cursor, contract_container: "ContractContainer", **kwargs) -> dict[str: list[tuple], str: bool]:
+        """
+        Fetches the latest update of every contract stored in the table of the given contract.
+
+        Args:
+            cursor (pyodbc.Cursor): The database cursor. [Provided by wrapper]
+            contract_container (ContractContainer): Any contract of the table.
+
+        Returns:
+            dict: A dictionary containing (strike, callput, last_update) rows and a flag indicating if the operation was committed.
+                  Strike and callput are None for STK tables.
+        """
+        database = contract_container.get_database()
+        table = contract_container.get_table()
+        match contract_container.get_secType():
             case 'STK':
                 query = f"""
-                        SELECT MAX(date)
+                        SELECT NULL, NULL, MAX(date)
                         FROM [{database}].[dbo].[{table}]
                         """
+            case 'OPT' if self.core.sql_schema_mode == 'compact':
+                query = f"""
+                        SELECT d.strike, d.callput, w.last_update
+                        FROM (
+                            SELECT contract_key, MAX(date) AS last_update
+                            FROM [{database}].[dbo].[{table}]
+                            GROUP BY contract_key
+                            ) w
+                        JOIN [{database}].[dbo].[{self.core.sql_contract_table}] d ON d.contract_key = w.contract_key;
+                        """
             case 'OPT':
                 query = f"""
-                        SELECT MAX(date)
+                        SELECT strike, callput, MAX(date)
                         FROM [{database}].[dbo].[{table}]
-                        WHERE strike = {contract.strike}
-                        AND callput = '{contract.right}';
+                        GROUP BY strike, callput;
                         """
             case _:
                 raise KeyError('Security type not supported. Valid secTypes: STK, OPT')
 
         cursor.execute(query)
-        last_update = cursor.fetchone()
-        last_update = last_update[0] if last_update is not None else None
+        watermarks = [tuple(x) for x in cursor.fetchall()]
 
-        return {'data': last_update, 'commit': False}
+        return {'data': watermarks, 'commit': False}
 
     @sql_query
     def get_last_price(self, cursor: pyodbc.Cursor, stk_symbol: str, **kwargs) -> dict[str: float | None:, str: bool ] :
         query = f"""
                 SELECT c
-                FROM [Data_STK].[dbo].[{f'{stk_symbol}_STK'}]
+                FROM [Data_STK].[dbo].[{f'{stk_symbol.replace('.', '')}_STK'}]
                 WHERE date = (
                     SELECT max(date)
-                    FROM [Data_STK].[dbo].[{f'{stk_symbol}_STK'}]
+                    FROM [Data_STK].[dbo].[{f'{stk_symbol.replace('.', '')}_STK'}]
                     );
                 """
         cursor.execute(query)
@@ -183,49 +267,111 @@ class DatabaseBroker():
 
     @sql_query
     def create_database(self, cursor: pyodbc.Cursor, conn: pyodbc.Connection, db_name: str, **kwargs):
+        return self.create_databases.__wrapped__(self, cursor=cursor, conn=conn, db_names=[db_name])
 
+    @sql_query
+    def create_databases(self, cursor: pyodbc.Cursor, conn: pyodbc.Connection, db_names: list[str], **kwargs):
         conn.autocommit = True
-        query = f'CREATE DATABASE {db_name}'
-        cursor.execute(query)
-        conn.autocommit = False
+        try:
+            query = ' '.join(f'CREATE DATABASE [{db_name}];' for db_name in db_names)
+            cursor.execute(query)
+        finally:
+            conn.autocommit = False
 
         return {'data': True, 'commit': True}
 
     @sql_query
     def create_table(self, cursor: pyodbc.Cursor, db_name: str, table_name: str, **kwargs) -> dict[str: None, str: bool]:
+        secType = 'STK' if table_name.count('_') == 1 else 'OPT'
+        if secType == 'OPT' and self.core.sql_schema_mode == 'compact':
+            cursor.execute(f"IF OBJECT_ID('{db_name}.dbo.{self.core.sql_contract_table}') IS NULL {self.dimension_ddl(db_name=db_name)}")
+        cursor.execute(self.table_ddl(db_name=db_name, table_name=table_name, secType=secType))
 
-        match table_name.count('_'):
-            case 1: # STK
-                query = f'USE [{db_name}]'
-                cursor.execute(query)
+        return {'data': None, 'commit': True}
+
+    @sql_query
+    def create_tables(self, cursor: pyodbc.Cursor, statements: list[str], **kwargs) -> dict[str: None, str: bool]:
+        """
+        Executes CREATE TABLE statements in batches of self.core.ddl_batch_size within one transaction.
+        """
+        for i in range(0, len(statements), self.core.ddl_batch_size):
+            cursor.execute('\n'.join(statements[i:i + self.core.ddl_batch_size]))
+
+        return {'data': None, 'commit': True}
+
+    def table_ddl(self, db_name: str, table_name: str, secType: str, **kwargs) -> str:
+        """
+        Returns the DDL of a price table in the configured schema mode.
 
-                table_name = f'{table_name.replace('.', '')}_STK'
-                query = """CREATE TABLE {table_name} (
-                                    date DATETIME,
+        legacy: identifier, callput and strike per option row, clustered index on (strike, callput, date) if self.core.sql_index_tables.
+        compact: integer contract_key into the contract dimension table, clustered primary key on (contract_key, date).
+                 Duplicate bars are dropped by the key (IGNORE_DUP_KEY) instead of failing the insert.
+        Tables are PAGE compressed if self.core.sql_page_compression.
+        """
+        compression = 'DATA_COMPRESSION = PAGE' if self.core.sql_page_compression else ''
+        compact = self.core.sql_schema_mode == 'compact'
+
+        match secType:
+            case 'STK':
+                columns = """date DATETIME NOT NULL,
                                     h FLOAT,
                                     l FLOAT,
                                     o FLOAT,
-                                    c FLOAT);
-                            """.format(table_name=table_name)
-            case 2: # OPT
-                query = f'USE [{db_name}]'
-                cursor.execute(query)
-                query = """CREATE TABLE {table_name} (
-                                    date DATETIME,
+                                    c FLOAT"""
+                key = 'date'
+            case 'OPT' if compact:
+                columns = """contract_key INT NOT NULL,
+                                    date DATETIME NOT NULL,
+                                    h FLOAT,
+                                    l FLOAT,
+                                    o FLOAT,
+                                    c FLOAT"""
+                key = 'contract_key, date'
+            case 'OPT':
+                columns = """date DATETIME,
                                     identifier VARCHAR(50),
                                     callput VARCHAR(1),
                                     strike FLOAT,
                                     h FLOAT,
                                     l FLOAT,
                                     o FLOAT,
-                                    c FLOAT);
-                            """.format(table_name=table_name)
+                                    c FLOAT"""
+                key = 'strike, callput, date'
             case _:
                 raise KeyError('Security type not supported. Valid secTypes: STK, OPT')
-        #print('Create table query: ', query)
-        cursor.execute(query)
 
-        return {'data': None, 'commit': True}
+        if compact:
+            options = ', '.join(filter(None, ['IGNORE_DUP_KEY = ON', compression]))
+            return f"""CREATE TABLE [{db_name}].[dbo].[{table_name}] (
+                                    {columns},
+                                    CONSTRAINT [PK_{table_name}] PRIMARY KEY CLUSTERED ({key}) WITH ({options}));
+                            """
+
+        if self.core.sql_index_tables:
+            return f"""CREATE TABLE [{db_name}].[dbo].[{table_name}] (
+                                    {columns});
+                            CREATE CLUSTERED INDEX [CIX_{table_name}] ON [{db_name}].[dbo].[{table_name}] ({key}){f' WITH ({compression})' if compression else ''};
+                            """
+
+        return f"""CREATE TABLE [{db_name}].[dbo].[{table_name}] (
+                                    {columns}){f' WITH ({compression})' if compression else ''};
+                            """
+
+    def dimension_ddl(self, db_name: str, **kwargs) -> str:
+        """
+        Returns the DDL of the contract dimension table of an option database [compact schema].
+        One row per option contract, its contract_key is stored with every price row instead of identifier, callput and strike.
+        """
+        table_name = self.core.sql_contract_table
+        return f"""CREATE TABLE [{db_name}].[dbo].[{table_name}] (
+                                    contract_key INT IDENTITY(1, 1) NOT NULL,
+                                    symbol VARCHAR(10) NOT NULL,
+                                    expiry DATE NOT NULL,
+                                    strike FLOAT NOT NULL,
+                                    callput CHAR(1) NOT NULL,
+                                    CONSTRAINT [PK_{table_name}] PRIMARY KEY CLUSTERED (contract_key),
+                                    CONSTRAINT [UQ_{table_name}] UNIQUE (symbol, expiry, strike, callput));
+                            """
 
     @sql_query
     def write_price_data(self, cursor, query_string: str, **kwargs) -> dict[str: None, str: bool]:
@@ -234,31 +380,235 @@ class DatabaseBroker():
 
             return {'data': None, 'commit': True}
 
+    def write_price_rows(self, contract_container: "ContractContainer", rows: list[tuple], **kwargs) -> int:
+        """
+        Writes price rows of a contract, bulk inserted (self.core.bulk_insert) or as string built INSERT queries.
+        """
+        if not rows:
+            return 0
+
+        if self.core.bulk_insert:
+            return self.bulk_insert_rows(contract_container=contract_container, rows=rows)
+
+        if self.missing_contract_key(contract_container=contract_container, rows=rows):
+            rows = self.set_contract_key(rows=rows, contract_key=self.add_contract_key(contract_container=contract_container))
+
+        for insert_query in self.build_insert_queries(contract_container=contract_container, rows=rows, max_lines=self.core.insert_query_max_lines):
+            self.write_price_data(query_string=insert_query)
+        return len(rows)
+
     @sql_query
-    def get_existing_dates(self, cursor, contract_container: "ContractContainer" = None, **kwargs) -> dict[str: set[datetime], str: bool]:
+    def bulk_insert_rows(self, cursor: pyodbc.Cursor, contract_container: "ContractContainer", rows: list[tuple], **kwargs) -> dict[str: int, str: bool]:
+        """
+        Bulk inserts price rows of a contract with bound parameters.
 
-        contract = contract_container.get_contract()
-        database = contract_container.get_database()
-        table = contract_container.get_table()
-        match contract.secType:
-            case 'STK':
-                #
-                query = f"""
-                    SELECT DISTINCT date
-                    FROM [{database}].[dbo].[{table}]
-                    ORDER BY date DESC;
+        Uses pyodbc fast_executemany, so all rows are sent as one parameter array instead of ad-hoc INSERT statements.
+        A single prepared statement is reused by SQL Server for every contract table of the same layout.
+        An option contract not yet in the dimension table [compact schema] is added in the same transaction as its rows.
+
+        Args:
+            cursor (pyodbc.Cursor): The database cursor. [Provided by wrapper]
+            contract_container (ContractContainer): The contract the rows belong to.
+            rows (list[tuple]): Rows ordered as returned by price_columns.
+
+        Returns:
+            dict: A dictionary containing the number of written rows and a flag indicating if the operation needs to be committed.
+        """
+        if not rows:
+            return {'data': 0, 'commit': False}
+
+        if self.missing_contract_key(contract_container=contract_container, rows=rows):
+            contract_key = self.add_contract_key.__wrapped__(self, cursor=cursor, contract_container=contract_container)['data']
+            rows = self.set_contract_key(rows=rows, contract_key=contract_key)
+
+        columns = self.price_columns(contract_container.get_secType())
+        query = f"""
+                INSERT INTO [{contract_container.get_database()}].[dbo].[{contract_container.get_table()}] ({', '.join(columns)})
+                VALUES ({', '.join('?' for _ in columns)});
                 """
+        cursor.fast_executemany = True
+        cursor.executemany(query, rows)
+
+        return {'data': len(rows), 'commit': True}
+
+    def build_insert_queries(self, contract_container: "ContractContainer", rows: list[tuple], max_lines: int, **kwargs) -> list[str]:
+        """
+        Builds string based INSERT statements of at most max_lines rows each for write_price_data.
+        Legacy path, used by write_price_rows if Core.bulk_insert is disabled.
+        """
+        columns = self.price_columns(contract_container.get_secType())
+        iq_header = f"""
+                    INSERT INTO [{contract_container.get_database()}].[dbo].[{contract_container.get_table()}] ({', '.join(columns)})
+                    VALUES
+                    """
+
+        iq_rows = []
+        for row in rows:
+            iq_rows.append('(' + ', '.join(f"'{x}'" if isinstance(x, (str, datetime)) else str(x) for x in row) + ')')
+
+        return [iq_header + ','.join(iq_rows[i:i + max_lines]) + ';' for i in range(0, len(iq_rows), max_lines)]
+
+    def price_columns(self, secType: str) -> list[str]:
+        match secType:
+            case 'STK':
+                return ['date', 'h', 'l', 'o', 'c']
+            case 'OPT' if self.core.sql_schema_mode == 'compact':
+                return ['date', 'contract_key', 'h', 'l', 'o', 'c']
             case 'OPT':
-                query = f"""
-                    SELECT DISTINCT date
-                    FROM [{database}].[dbo].[{table}]
-                    WHERE strike = {contract.strike}
-                    AND callput = '{contract.right}';
-                """
+                return ['date', 'identifier', 'callput', 'strike', 'h', 'l', 'o', 'c']
             case _:
                 raise KeyError('Security type not supported. Valid secTypes: STK, OPT')
 
-        cursor.execute(query)
+    def row_prefix(self, contract_container: "ContractContainer", **kwargs) -> tuple:
+        """
+        Returns the contract columns written between date and the prices of every row, see price_columns.
+        The contract key [compact schema] is None for a contract not yet in the dimension table, write_price_rows adds it.
+        """
+        match contract_container.get_secType():
+            case 'STK':
+                return ()
+            case 'OPT' if self.core.sql_schema_mode == 'compact':
+                return (self.get_contract_key(contract_container=contract_container),)
+            case 'OPT':
+                security_identifier = f'{contract_container.get_symbol()}_{contract_container.get_strike()}_{contract_container.get_right()}_{contract_container.get_expiry(output_str_format='%d%b%y')}'
+                return (security_identifier, contract_container.get_right(), contract_container.get_strike())
+            case _:
+                raise KeyError('Security type not supported. Valid secTypes: STK, OPT')
+
+    def contract_filter(self, cursor: pyodbc.Cursor, contract_container: "ContractContainer", **kwargs) -> tuple[list[str], list] | None:
+        """
+        Returns the WHERE conditions and parameters selecting the rows of a contract within its table.
+        None if the contract has no rows, as it is not in the dimension table [compact schema].
+        """
+        match contract_container.get_secType():
+            case 'STK':
+                return [], []
+            case 'OPT' if self.core.sql_schema_mode == 'compact':
+                contract_key = self.get_contract_key(contract_container=contract_container, cursor=cursor)
+                return (['contract_key = ?'], [contract_key]) if contract_key is not None else None
+            case 'OPT':
+                return ['strike = ?', 'callput = ?'], [float(contract_container.get_strike()), contract_container.get_right()]
+            case _:
+                raise KeyError('Security type not supported. Valid secTypes: STK, OPT')
+
+    @staticmethod
+    def contract_key_index(contract_container: "ContractContainer") -> tuple:
+        return (contract_container.get_database(), contract_container.get_symbol().replace('.', ''), contract_container.get_expiry(),
+                float(contract_container.get_strike()), contract_container.get_right())
+
+    def get_contract_key(self, contract_container: "ContractContainer", cursor: pyodbc.Cursor = None, **kwargs) -> int | None:
+        """
+        Returns the dimension key of an option contract [compact schema], None if it is not in the dimension table.
+
+        Keys are cached per broker. On a miss all keys of the contract's series are loaded with one query, a contract
+        still missing is looked up on its own, as another writer may have added it since. Lookups never insert:
+        contracts are added to the dimension table together with their first rows (write_price_rows).
+
+        Args:
+            contract_container (ContractContainer): The option contract.
+            cursor (pyodbc.Cursor, optional): Cursor of a running query to reuse. Defaults to None (own connection).
+        """
+        index = self.contract_key_index(contract_container)
+        contract_key = self.contract_keys.get(index)
+        if contract_key is not None:
+            return contract_key
+
+        with self._key_lock:
+            if index not in self.contract_keys:
+                if cursor is None:
+                    self.resolve_contract_key(contract_container=contract_container)
+                else:
+                    self.resolve_contract_key.__wrapped__(self, cursor=cursor, contract_container=contract_container)
+            return self.contract_keys.get(index)
+
+    @sql_query
+    def resolve_contract_key(self, cursor: pyodbc.Cursor, contract_container: "ContractContainer", **kwargs) -> dict[str: int | None, str: bool]:
+        database, symbol, expiry, strike, right = self.contract_key_index(contract_container)
+        dimension = f'[{database}].[dbo].[{self.core.sql_contract_table}]'
+        expiry = datetime.strptime(expiry, '%Y%m%d').date()
+
+        series = (database, contract_container.get_table())
+        if series not in self.loaded_series:
+            cursor.execute(f'SELECT contract_key, strike, callput FROM {dimension} WHERE symbol = ? AND expiry = ?;', symbol, expiry)
+            for contract_key, series_strike, series_right in cursor.fetchall():
+                self.contract_keys[(database, symbol, contract_container.get_expiry(), float(series_strike), series_right)] = contract_key
+            self.loaded_series.add(series)
+
+        index = self.contract_key_index(contract_container)
+        if index not in self.contract_keys:
+            cursor.execute(f'SELECT contract_key FROM {dimension} WHERE symbol = ? AND expiry = ? AND strike = ? AND callput = ?;',
+                           symbol, expiry, strike, right)
+            contract_key = cursor.fetchone()
+            if contract_key is not None:
+                self.contract_keys[index] = contract_key[0]
+
+        return {'data': self.contract_keys.get(index), 'commit': False}
+
+    def missing_contract_key(self, contract_container: "ContractContainer", rows: list[tuple], **kwargs) -> bool:
+        """
+        Returns True if the rows of an option contract were built without contract key [compact schema], see row_prefix.
+        """
+        return bool(rows) and contract_container.get_secType() == 'OPT' and self.core.sql_schema_mode == 'compact' and rows[0][1] is None
+
+    @staticmethod
+    def set_contract_key(rows: list[tuple], contract_key: int) -> list[tuple]:
+        return [(row[0], contract_key, *row[2:]) for row in rows]
+
+    @sql_query
+    def add_contract_key(self, cursor: pyodbc.Cursor, contract_container: "ContractContainer", **kwargs) -> dict[str: int, str: bool]:
+        """
+        Inserts an option contract into the dimension table of its database unless it exists and returns its key [compact schema].
+        Only called on the write path: bulk_insert_rows runs it within the transaction of the contract's first rows.
+        The key is not cached here, as the transaction may still roll back; get_contract_key finds it once committed.
+        """
+        database, symbol, expiry, strike, right = self.contract_key_index(contract_container)
+        dimension = f'[{database}].[dbo].[{self.core.sql_contract_table}]'
+        query = f"""
+                SET NOCOUNT ON;
+                DECLARE @symbol VARCHAR(10) = ?, @expiry DATE = ?, @strike FLOAT = ?, @callput CHAR(1) = ?;
+                IF NOT EXISTS (SELECT 1 FROM {dimension} WHERE symbol = @symbol AND expiry = @expiry AND strike = @strike AND callput = @callput)
+                    INSERT INTO {dimension} (symbol, expiry, strike, callput) VALUES (@symbol, @expiry, @strike, @callput);
+                SELECT contract_key FROM {dimension} WHERE symbol = @symbol AND expiry = @expiry AND strike = @strike AND callput = @callput;
+                """
+        cursor.execute(query, symbol, datetime.strptime(expiry, '%Y%m%d').date(), strike, right)
+
+        return {'data': cursor.fetchone()[0], 'commit': True}
+
+    @sql_query
+    def get_existing_dates(self, cursor, contract_container: "ContractContainer" = None, start: datetime = None, end: datetime = None, **kwargs) -> dict[str: set[datetime], str: bool]:
+        """
+        Fetches the stored dates of a contract, optionally limited to the window [start, end].
+
+        Args:
+            cursor (pyodbc.Cursor): The database cursor. [Provided by wrapper]
+            contract_container (ContractContainer): The contract object.
+            start (datetime, optional): Earliest date to fetch. Defaults to None (unbounded).
+            end (datetime, optional): Latest date to fetch. Defaults to None (unbounded).
+
+        Returns:
+            dict: A dictionary containing the set of stored dates and a flag indicating if the operation was committed.
+        """
+        database = contract_container.get_database()
+        table = contract_container.get_table()
+        contract_filter = self.contract_filter(cursor=cursor, contract_container=contract_container)
+        if contract_filter is None:
+            return {'data': set(), 'commit': False}
+        conditions, params = contract_filter
+
+        if start is not None:
+            conditions.append('date >= ?')
+            params.append(start)
+        if end is not None:
+            conditions.append('date <= ?')
+            params.append(end)
+
+        query = f"""
+            SELECT DISTINCT date
+            FROM [{database}].[dbo].[{table}]
+            {'WHERE ' + ' AND '.join(conditions) if conditions else ''};
+        """
+
+        cursor.execute(query, *params)
         existing_dates = set(x[0] for x in cursor.fetchall())
 
         return {'data': existing_dates, 'commit': False}
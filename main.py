@@ -1,19 +1,20 @@
 from contract_container import ContractContainer
 from core import Core
-from database_broker import DatabaseBroker
 from pipeline_builder import PipelineBuilder
 from pipeline_handler import PipelineHandler
-from tws_api import TWSCon
+from storage_backend import backend_class
+from tws_api import TWSRouter
 
 
 if __name__ == '__main__':
     def main():
         core = Core()
+        core.metrics.start(core=core)
 
-        tws_con = TWSCon(core)
+        tws_con = TWSRouter(core=core)
 
-        pl_builder = PipelineBuilder(core=core, tws_con=tws_con, CC=ContractContainer, DB=DatabaseBroker)
-        pl_handler = PipelineHandler(core=core, tws_con=tws_con, CC=ContractContainer, DB=DatabaseBroker)
+        pl_builder = PipelineBuilder(core=core, tws_con=tws_con, CC=ContractContainer, DB=backend_class(core))
+        pl_handler = PipelineHandler(core=core, tws_con=tws_con, CC=ContractContainer, DB=backend_class(core))
 
         pl_builder.startup_build_sequence()
 
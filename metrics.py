@@ -0,0 +1,195 @@
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+from threading import Lock, Thread
+from time import monotonic, sleep
+from typing import Callable
+
+LATENCY_BUCKETS: tuple[float, ...] = (.005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60., 120., 300.)
+
+
+class Histogram:
+    """
+    Non-cumulative bucket counts of observed values. Buckets are upper bounds, values above the last one are counted in +Inf.
+    """
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts: list[int] = [0] * (len(buckets) + 1)
+        self.sum: float = 0.
+        self.count: int = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float | None:
+        """
+        Upper bound of the bucket holding the q-quantile, None if nothing was observed.
+        """
+        if not self.count:
+            return None
+        rank, seen = q * self.count, 0
+        for bound, n in zip(self.buckets + (float('inf'),), self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    """
+    Thread-safe counters, histograms and gauges of the pipeline.
+
+    Counters and histograms are recorded per event (request, contract, query), never per bar, so the hot paths only pay
+    one dict update under a lock. Gauges are callbacks evaluated on export, e.g. the pool depths of core.pool_depths.
+
+    Exported through a pull endpoint (core.metrics_port: /metrics in Prometheus text format, /metrics.json)
+    and/or a periodically rewritten snapshot file (core.metrics_snapshot_path) including per-second counter rates.
+    """
+    def __init__(self):
+        self.core = None  # set by start, provides the exporter settings
+        self.counters: dict[tuple[str, tuple], float] = defaultdict(float)
+        self.histograms: dict[tuple[str, tuple], Histogram] = {}
+        self.gauges: dict[str, Callable[[], dict[str, float]]] = {}
+        self.lock = Lock()
+
+        self.started: float = monotonic()
+        self.last_snapshots: dict[str, tuple[float, dict[tuple[str, tuple], float]]] = {}  # exporter: (monotonic time, counters) of its previous snapshot
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def register_gauge(self, name: str, callback: Callable[[], dict[str, float]], **kwargs):
+        """
+        Registers a gauge evaluated on export. callback returns {label value: gauge value}.
+        """
+        self.gauges[name] = callback
+
+    @staticmethod
+    def label_str(labels: tuple) -> str:
+        return ','.join(f'{k}={v}' for k, v in labels)
+
+    def snapshot(self, exporter: str = 'default', **kwargs) -> dict:
+        """
+        Returns all metrics as a JSON serializable dict. Counter rates are per second since the previous snapshot
+        of the same exporter, so the /metrics.json endpoint and the snapshot file do not shorten each other's interval.
+        """
+        now = monotonic()
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (list(h.counts), h.sum, h.count, h.quantile(.5), h.quantile(.95), h.buckets) for key, h in self.histograms.items()}
+            last_time, last_counters = self.last_snapshots.get(exporter, (self.started, {}))
+            self.last_snapshots[exporter] = (now, counters)
+
+        elapsed = max(now - last_time, 1e-9)
+
+        return {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'uptime_secs': round(now - self.started, 1),
+            'counters': {f'{name}{{{self.label_str(labels)}}}': value for (name, labels), value in sorted(counters.items())},
+            'rates_per_sec': {f'{name}{{{self.label_str(labels)}}}': round((value - last_counters.get((name, labels), 0.)) / elapsed, 3)
+                              for (name, labels), value in sorted(counters.items())},
+            'histograms': {f'{name}{{{self.label_str(labels)}}}': {'count': count, 'sum': round(total, 6), 'p50_le': p50, 'p95_le': p95,
+                                                                  'buckets': dict(zip([str(x) for x in buckets] + ['+Inf'], counts))}
+                           for (name, labels), (counts, total, count, p50, p95, buckets) in sorted(histograms.items())},
+            'gauges': {name: callback() for name, callback in self.gauges.items()},
+        }
+
+    def render_prometheus(self, **kwargs) -> str:
+        def fmt(labels: tuple, **extra) -> str:
+            items = list(labels) + list(extra.items())
+            return '{' + ','.join(f'{k}="{v}"' for k, v in items) + '}' if items else ''
+
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(h.counts), h.sum, h.count, h.buckets)) for key, h in self.histograms.items())
+
+        for name in sorted({name for (name, _), _ in counters}):
+            lines.append(f'# TYPE scraper_{name} counter')
+            lines += [f'scraper_{name}{fmt(labels)} {value}' for (n, labels), value in counters if n == name]
+
+        for name in sorted({name for (name, _), _ in histograms}):
+            lines.append(f'# TYPE scraper_{name} histogram')
+            for (n, labels), (counts, total, count, buckets) in histograms:
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, c in zip([str(x) for x in buckets] + ['+Inf'], counts):
+                    cumulative += c
+                    lines.append(f'scraper_{name}_bucket{fmt(labels, le=bound)} {cumulative}')
+                lines.append(f'scraper_{name}_sum{fmt(labels)} {total}')
+                lines.append(f'scraper_{name}_count{fmt(labels)} {count}')
+
+        for name, callback in self.gauges.items():
+            lines.append(f'# TYPE scraper_{name} gauge')
+            lines += [f'scraper_{name}{{key="{key}"}} {value}' for key, value in callback().items()]
+
+        return '\n'.join(lines) + '\n'
+
+    def start(self, core=None, **kwargs):
+        """
+        Starts the exporters configured in core as daemon threads.
+        """
+        from core import tprint  # core creates the Metrics instance, so imported on use
+
+        if core is None:
+            raise Exception('<Metrics START> All parameters must be specified.')
+        self.core = core
+
+        if self.core.metrics_port is not None:
+            metrics = self
+
+            class MetricsHandler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    match self.path:
+                        case '/metrics':
+                            body, content_type = metrics.render_prometheus().encode(), 'text/plain; version=0.0.4'
+                        case '/metrics.json':
+                            body, content_type = json.dumps(metrics.snapshot(exporter='http'), indent=2).encode(), 'application/json'
+                        case _:
+                            self.send_error(404)
+                            return
+                    self.send_response(200)
+                    self.send_header('Content-Type', content_type)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            server = ThreadingHTTPServer((self.core.metrics_host, self.core.metrics_port), MetricsHandler)
+            Thread(target=server.serve_forever, daemon=True).start()
+            tprint(f'Metrics endpoint: http://{self.core.metrics_host}:{self.core.metrics_port}/metrics')
+
+        if self.core.metrics_snapshot_path is not None:
+            Thread(target=self.snapshot_loop, daemon=True).start()
+
+    def snapshot_loop(self):
+        from core import tprint
+
+        while True:
+            sleep(self.core.metrics_snapshot_interval)
+            try:
+                tmp_path = f'{self.core.metrics_snapshot_path}.tmp'
+                with open(tmp_path, 'w') as file:
+                    json.dump(self.snapshot(exporter='file'), file, indent=2)
+                os.replace(tmp_path, self.core.metrics_snapshot_path)
+            except OSError as err:
+                tprint(f'Metrics snapshot failed: {err}')
@@ -0,0 +1,167 @@
+from math import ceil
+from threading import Lock
+from time import monotonic
+
+REQUEST_COSTS: dict[str, int] = {'BID_ASK': 2}  # whatToShow types counted more than once against the pacing limits
+
+
+class TokenBucket:
+    """
+    Bucket of up to capacity tokens, refilled at rate tokens per second.
+
+    A rule "max requests within period seconds" is met in every sliding window if capacity + rate * period <= max,
+    so a bucket trades burst size (capacity) against sustained rate ((max - capacity) / period).
+    A request costing more tokens than the capacity waits for a full bucket and leaves it in debt.
+    """
+    __slots__ = ('capacity', 'rate', 'tokens', 'stamp')
+
+    def __init__(self, capacity: float, rate: float, now: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.stamp = now
+
+    @classmethod
+    def for_rule(cls, max_requests: int, period: float, burst: int, now: float) -> 'TokenBucket':
+        burst = max(min(burst, max_requests - 1), 1)
+        return cls(capacity=burst, rate=max(max_requests - burst, 1) / period, now=now)
+
+    def refill(self, now: float, factor: float = 1.):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate * factor)
+        self.stamp = now
+
+    def wait_time(self, now: float, factor: float = 1., cost: float = 1.) -> float:
+        self.refill(now=now, factor=factor)
+        needed = min(cost, self.capacity)
+        if self.tokens >= needed:
+            return 0.
+        return (needed - self.tokens) / (self.rate * factor) if self.rate else float('inf')
+
+    def take(self, now: float, factor: float = 1., cost: float = 1.):
+        self.refill(now=now, factor=factor)
+        self.tokens -= cost
+
+    def full(self) -> bool:
+        return self.tokens >= self.capacity
+
+
+class HistoricalPacer:
+    """
+    Keeps historical data requests within the IBKR pacing limits of one connection.
+
+    Rules enforced (all configurable in Core):
+        - No identical historical data request within hist_identical_cooldown seconds.
+        - No more than hist_same_contract_max requests for the same contract within hist_same_contract_period seconds.
+        - No more than hist_pacing_max_requests requests within any hist_pacing_period seconds.
+
+    The two rate rules are token buckets sized by TokenBucket.for_rule: the global bucket bursts up to hist_pacing_burst
+    requests, each contract up to half of hist_same_contract_max. The refill rate is adaptive: every pacing violation
+    reported by TWS (penalize) multiplies it by hist_backoff_factor and pauses the connection for hist_penalty_wait seconds,
+    doubled per consecutive violation. Every request completed without one (succeed) regains hist_recovery_step of the rate.
+    Requests take their cost in tokens from both buckets, as IBKR counts e.g. BID_ASK requests twice (REQUEST_COSTS).
+    """
+    def __init__(self, core=None):
+        if core is None:
+            raise Exception('<HistoricalPacer INIT> All parameters must be specified.')
+
+        self.core = core
+
+        self.bucket: TokenBucket = TokenBucket.for_rule(max_requests=core.hist_pacing_max_requests, period=core.hist_pacing_period,
+                                                        burst=core.hist_pacing_burst, now=monotonic())
+        self.identical: dict[tuple, float] = {}
+        self.per_contract: dict[tuple, TokenBucket] = {}
+
+        self.rate_factor: float = 1.  # share of the configured refill rates currently used
+        self.violations: int = 0  # consecutive pacing violations
+        self.penalty_until: float = 0.  # monotonic time until which no request is sent
+        self.penalized_at: float = -float('inf')  # monotonic time of the last backoff
+
+        self.lock = Lock()
+
+    def wait_time(self, request_key: tuple, contract_key: tuple, cost: int = 1, **kwargs) -> float:
+        """
+        Returns the number of seconds to wait until a request with the given keys may be sent.
+
+        Args:
+            request_key (tuple): Identifies identical requests (contract, end time, duration, bar size, type).
+            contract_key (tuple): Identifies the contract the request is made for.
+            cost (int, optional): Requests the request counts as against the pacing limits (REQUEST_COSTS). Defaults to 1.
+
+        Returns:
+            float: 0 if the request may be sent right away, else seconds to wait.
+        """
+        with self.lock:
+            now = monotonic()
+            self.expire(now=now)
+
+            waits = [0., self.penalty_until - now, self.bucket.wait_time(now=now, factor=self.rate_factor, cost=cost)]
+
+            if request_key in self.identical:
+                waits.append(self.identical[request_key] + self.core.hist_identical_cooldown - now)
+
+            contract_bucket = self.per_contract.get(contract_key)
+            if contract_bucket is not None:
+                waits.append(contract_bucket.wait_time(now=now, factor=self.rate_factor, cost=cost))
+
+            return max(waits)
+
+    def register(self, request_key: tuple, contract_key: tuple, cost: int = 1, **kwargs):
+        with self.lock:
+            now = monotonic()
+            self.bucket.take(now=now, factor=self.rate_factor, cost=cost)
+            self.identical[request_key] = now
+            if contract_key not in self.per_contract:
+                self.per_contract[contract_key] = TokenBucket.for_rule(max_requests=self.core.hist_same_contract_max,
+                                                                       period=self.core.hist_same_contract_period,
+                                                                       burst=ceil(self.core.hist_same_contract_max / 2), now=now)
+            self.per_contract[contract_key].take(now=now, factor=self.rate_factor, cost=cost)
+
+    def penalize(self, sent: float, **kwargs) -> float:
+        """
+        Backs off after a pacing violation: lowers the refill rates and pauses the connection.
+        Violations of requests sent before the last backoff belong to the same burst and are not counted again.
+
+        Args:
+            sent (float): Monotonic send time of the violating request.
+
+        Returns:
+            float: Seconds of the pause, 0 if the violation was already accounted for.
+        """
+        with self.lock:
+            now = monotonic()
+            if sent < self.penalized_at:
+                return 0.
+            self.penalized_at = now
+            self.bucket.refill(now=now, factor=self.rate_factor)
+            self.rate_factor = max(self.rate_factor * self.core.hist_backoff_factor, self.core.hist_min_rate_factor)
+            self.bucket.tokens = min(self.bucket.tokens, 0.)
+
+            pause = min(self.core.hist_penalty_wait * 2 ** self.violations, self.core.hist_penalty_max)
+            self.violations += 1
+            self.penalty_until = max(self.penalty_until, now + pause)
+            return pause
+
+    def succeed(self, sent: float, **kwargs):
+        """
+        Recovers the refill rates after a request sent since the last backoff completed without pacing violation.
+
+        Args:
+            sent (float): Monotonic send time of the completed request.
+        """
+        with self.lock:
+            if sent < self.penalized_at:
+                return
+            if self.rate_factor < 1.:
+                self.bucket.refill(now=monotonic(), factor=self.rate_factor)
+                self.rate_factor = min(self.rate_factor + self.core.hist_recovery_step, 1.)
+            self.violations = 0
+
+    def expire(self, now: float, **kwargs):
+        for key in [k for k, t in self.identical.items() if now - t >= self.core.hist_identical_cooldown]:
+            del self.identical[key]
+
+        for key in list(self.per_contract.keys()):
+            contract_bucket = self.per_contract[key]
+            contract_bucket.refill(now=now, factor=self.rate_factor)
+            if contract_bucket.full():
+                del self.per_contract[key]
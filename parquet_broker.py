@@ -0,0 +1,206 @@
+import atexit
+from datetime import datetime
+import os
+from threading import RLock
+from time import monotonic
+from typing import Iterable
+from uuid import uuid4
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:  # optional dependency, only required for Core.storage_backend = 'parquet'
+    pa = pc = pq = None
+
+from core import tprint
+from storage_backend import StorageBackend
+
+
+class ParquetBroker(StorageBackend):
+    """
+    StorageBackend writing append-only, compressed Parquet files. Needs neither ODBC nor a database server.
+
+    Layout: <parquet_root>/<database>/<table>/part-<timestamp>-<id>.parquet, i.e. partitioned by symbol and option expiry.
+    A table directory is read in bulk with pyarrow.parquet.read_table(<table directory>).
+
+    Rows are buffered per table as Arrow tables and written as one part file once self.core.parquet_flush_rows are buffered,
+    after self.core.parquet_flush_interval seconds or on exit. Reads of a table flush its buffer first.
+    Rows still buffered at a crash are lost; as their watermarks are not stored either, they are requested again after a restart.
+    """
+    def __init__(self, core=None, CC=None):
+        super().__init__(core=core, CC=CC)
+        if pa is None:
+            raise ImportError("pyarrow is required for Core.storage_backend = 'parquet' (pip install pyarrow).")
+
+        self.root: str = core.parquet_root
+        self.schemas = {'STK': pa.schema([('date', pa.timestamp('s')), ('h', pa.float64()), ('l', pa.float64()),
+                                          ('o', pa.float64()), ('c', pa.float64())]),
+                        'OPT': pa.schema([('date', pa.timestamp('s')), ('callput', pa.string()), ('strike', pa.float64()),
+                                          ('h', pa.float64()), ('l', pa.float64()), ('o', pa.float64()), ('c', pa.float64())])}
+
+        self.buffers: dict[tuple[str, str], list['pa.Table']] = {}
+        self.buffered_rows: dict[tuple[str, str], int] = {}
+        self.lock = RLock()
+        self.last_flush: float = monotonic()
+
+        os.makedirs(self.root, exist_ok=True)
+        atexit.register(self.flush)
+
+    def table_path(self, database: str, table: str) -> str:
+        return os.path.join(self.root, database, table)
+
+    def fetch_all_table_names(self, return_data: bool = False, **kwargs) -> dict[str, set[str]] | None:
+        catalog = {}
+        for database in os.listdir(self.root):
+            database_path = os.path.join(self.root, database)
+            if os.path.isdir(database_path):
+                catalog[database] = {x for x in os.listdir(database_path) if os.path.isdir(os.path.join(database_path, x))}
+
+        with self.lock:
+            self.table_structure.update(catalog)
+
+        return self.table_structure if return_data else None
+
+    def provision_tables(self, contract_containers: "Iterable[ContractContainer]", **kwargs) -> int:
+        with self.lock:
+            missing = self.missing_tables(contract_containers=contract_containers)
+            for database, table in missing.keys():
+                os.makedirs(self.table_path(database, table), exist_ok=True)
+                self.table_structure.setdefault(database, set()).add(table)
+
+        if missing:
+            tprint(f'Create {len(missing)} tables')
+        return len(missing)
+
+    def price_columns(self, secType: str) -> list[str]:
+        match secType:
+            case 'STK' | 'OPT':
+                return self.schemas[secType].names
+            case _:
+                raise KeyError('Security type not supported. Valid secTypes: STK, OPT')
+
+    def row_prefix(self, contract_container: "ContractContainer", **kwargs) -> tuple:
+        match contract_container.get_secType():
+            case 'STK':
+                return ()
+            case 'OPT':
+                return (contract_container.get_right(), float(contract_container.get_strike()))
+            case _:
+                raise KeyError('Security type not supported. Valid secTypes: STK, OPT')
+
+    def write_price_rows(self, contract_container: "ContractContainer", rows: list[tuple], **kwargs) -> int:
+        """
+        Buffers price rows of a contract as an Arrow table, flushed as part file of the contract's table.
+        """
+        if not rows:
+            return 0
+
+        schema = self.schemas[contract_container.get_secType()]
+        table = pa.Table.from_arrays([pa.array(column, type=field.type) for column, field in zip(zip(*rows), schema)], schema=schema)
+        key = (contract_container.get_database(), contract_container.get_table())
+
+        with self.lock:
+            self.buffers.setdefault(key, []).append(table)
+            self.buffered_rows[key] = self.buffered_rows.get(key, 0) + len(rows)
+
+            if self.buffered_rows[key] >= self.core.parquet_flush_rows:
+                self.flush_table(key)
+            if monotonic() - self.last_flush >= self.core.parquet_flush_interval:
+                self.flush()
+
+        return len(rows)
+
+    def flush_table(self, key: tuple[str, str], **kwargs):
+        """
+        Writes the buffered rows of a table as one new part file. Written under a hidden name and renamed,
+        so readers never see a partial file.
+        """
+        with self.lock:
+            tables = self.buffers.pop(key, None)
+            self.buffered_rows.pop(key, None)
+            if not tables:
+                return
+
+            path = self.table_path(*key)
+            os.makedirs(path, exist_ok=True)
+            name = f'part-{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid4().hex[:8]}.parquet'
+            pq.write_table(pa.concat_tables(tables), os.path.join(path, f'.{name}'), compression=self.core.parquet_compression)
+            os.replace(os.path.join(path, f'.{name}'), os.path.join(path, name))
+
+    def flush(self, **kwargs):
+        with self.lock:
+            for key in list(self.buffers.keys()):
+                self.flush_table(key)
+            self.last_flush = monotonic()
+
+    def compact_table(self, database: str, table: str, **kwargs) -> int:
+        """
+        Merges all part files of a table into one, sorted by date. Meant for offline maintenance of tables with many small parts.
+
+        Returns:
+            int: Number of merged part files.
+        """
+        with self.lock:
+            self.flush_table((database, table))
+            path = self.table_path(database, table)
+            parts = [x for x in os.listdir(path) if x.endswith('.parquet') and not x.startswith('.')]
+            if len(parts) < 2:
+                return 0
+
+            merged = pq.read_table(path).sort_by('date')
+            name = f'part-{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid4().hex[:8]}.parquet'
+            pq.write_table(merged, os.path.join(path, f'.{name}'), compression=self.core.parquet_compression)
+            os.replace(os.path.join(path, f'.{name}'), os.path.join(path, name))
+            for part in parts:
+                os.remove(os.path.join(path, part))
+
+        return len(parts)
+
+    def read_table(self, database: str, table: str, columns: list[str], filters: list[tuple] = None, **kwargs) -> 'pa.Table | None':
+        self.flush_table((database, table))
+
+        path = self.table_path(database, table)
+        if not os.path.isdir(path) or not any(x.endswith('.parquet') and not x.startswith('.') for x in os.listdir(path)):
+            return None
+        return pq.read_table(path, columns=columns, filters=filters or None)
+
+    def contract_filters(self, contract_container: "ContractContainer", **kwargs) -> list[tuple]:
+        if contract_container.get_secType() == 'OPT':
+            return [('strike', '=', float(contract_container.get_strike())), ('callput', '=', contract_container.get_right())]
+        return []
+
+    def get_last_update(self, contract_container: "ContractContainer", **kwargs) -> datetime | None:
+        table = self.read_table(contract_container.get_database(), contract_container.get_table(), columns=['date'],
+                                filters=self.contract_filters(contract_container))
+        return pc.max(table['date']).as_py() if table is not None and table.num_rows else None
+
+    def get_table_watermarks(self, contract_container: "ContractContainer", **kwargs) -> list[tuple]:
+        match contract_container.get_secType():
+            case 'STK':
+                table = self.read_table(contract_container.get_database(), contract_container.get_table(), columns=['date'])
+                return [(None, None, pc.max(table['date']).as_py())] if table is not None and table.num_rows else []
+            case 'OPT':
+                table = self.read_table(contract_container.get_database(), contract_container.get_table(), columns=['strike', 'callput', 'date'])
+                if table is None:
+                    return []
+                grouped = table.group_by(['strike', 'callput']).aggregate([('date', 'max')])
+                return list(zip(grouped['strike'].to_pylist(), grouped['callput'].to_pylist(), grouped['date_max'].to_pylist()))
+            case _:
+                raise KeyError('Security type not supported. Valid secTypes: STK, OPT')
+
+    def get_last_price(self, stk_symbol: str, **kwargs) -> float | None:
+        table = self.read_table('Data_STK', f'{stk_symbol.replace('.', '')}_STK', columns=['date', 'c'])
+        if table is None or not table.num_rows:
+            return None
+        return table.sort_by([('date', 'descending')])['c'][0].as_py()
+
+    def get_existing_dates(self, contract_container: "ContractContainer" = None, start: datetime = None, end: datetime = None, **kwargs) -> set[datetime]:
+        filters = self.contract_filters(contract_container)
+        if start is not None:
+            filters.append(('date', '>=', start))
+        if end is not None:
+            filters.append(('date', '<=', end))
+
+        table = self.read_table(contract_container.get_database(), contract_container.get_table(), columns=['date'], filters=filters)
+        return set(table['date'].to_pylist()) if table is not None else set()
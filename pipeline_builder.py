@@ -1,15 +1,14 @@
-from collections import defaultdict
+from collections import defaultdict, deque
 from datetime import datetime, time, timedelta
 from dotenv import load_dotenv, set_key
 from itertools import batched
-import pickle
-import pyodbc
-import random
 from time import sleep
 from threading import Thread
 
+from chain_pruner import ChainPruner
 from contract_container import ContractContainer
 from core import tprint
+from universe_cache import UniverseCache
 
 
 class PipelineBuilder:
@@ -21,7 +20,9 @@ class PipelineBuilder:
         self.tws_con = tws_con
         self.ContractContainer = CC
 
-        self.db = DB(core=self.core, CC=self.ContractContainer)
+        self.db = DB.shared(core=self.core, CC=self.ContractContainer)
+
+        self.pruner = ChainPruner(core=self.core)
 
         self.stk_sorter_pointer: int = 0
 
@@ -39,16 +40,16 @@ class PipelineBuilder:
         """
         if not self.debug_load:
             self.build_stk_contracts()
+            self.db.provision_tables(contract_containers=self.core.contract_pool['STK'])
 
             tprint('Building option contracts...')
             for stk in self.core.contract_pool['STK']:
                 self.core.contract_pool['OPT'].extend(self.build_opt_contracts(stk=stk))
-
-            if self.core.randomize_opts:
-                random.shuffle(self.core.contract_pool['OPT'])
-                tprint(f'OPT contracts randomized.')
+            self.db.provision_tables(contract_containers=self.core.contract_pool['OPT'])
 
             tprint('Building option contracts ended.')
+            if self.core.prune_chains:
+                self.pruner.report()
 
         current_time = datetime.now().time()
         last_scheduled_update =self.core.exp_update_timer - timedelta(days=1)
@@ -58,6 +59,8 @@ class PipelineBuilder:
             tprint('Generating expired option list skipped because they are up2date.')
         self.option_exp_max_length = len(self.core.contract_pool['EXP'])
 
+        self.load_watermarks()
+
         for list_type in ['STK', 'OPT', 'EXP']:
             tprint(f'{list_type} length:{len(self.core.contract_pool[list_type])}')
 
@@ -68,8 +71,9 @@ class PipelineBuilder:
             Builds stock ContractContainer objects by iterating over the symbols in the underlying list
             and creating a contract container for each symbol.
 
-            Requests conId for each object.
-            Conditionally on the conId provided both available option expiries and strikes are saved in the object.
+            Symbols with a fresh entry in the on-disk UniverseCache are built from it.
+            All other symbols are resolved concurrently by discover_chains (conId, then option expiries and strikes)
+            and written back to the cache.
 
             All stock ContractContainer objects are put into self.core.contract_pool['STK']
 
@@ -78,37 +82,161 @@ class PipelineBuilder:
 
             """
         tprint('Building stock contracts...')
-        for symbol in self.core.underlying_list['STK']:
+        cache = UniverseCache(path=self.core.universe_cache_path, ttl=self.core.universe_cache_ttl)
+        cache.load()
 
+        stks, stale = [], []
+        for symbol in self.core.underlying_list['STK']:
             stk = self.ContractContainer(self.core, symbol=symbol, secType='STK')
-            # TODO: Check correct symbol for B shares like BRK.B
+            stks.append(stk)
+
+            entry = cache.get(symbol)
+            if entry is not None:
+                if entry.get('alias'):
+                    self.core.symbol_aliases[symbol] = entry['alias']
+                stk.set_conId(entry['conId'])
+                stk.set_strexp(expiries=entry['expiries'], strikes=entry['strikes'])
+                stk.set_listed_strikes(listed_strikes=entry.get('listed_strikes') or {})
+            else:
+                stale.append(stk)
 
-            stk.set_reqId_assign(self.core.reqId_1, reqType='ReqConDetails')
-            self.tws_con.reqContractDetails(self.core.reqId_1, stk.get_contract())
-            self.core.reqId_1 += 1
+        resolved = self.discover_chains(stks=stale) if stale else []
+        cacheable = resolved
+        if self.core.prune_chains and self.core.prune_listed_strikes and resolved:
+            tprint('Requesting listed strikes per expiry...')
+            cacheable = self.discover_listed_strikes(stks=resolved)
 
-            while not stk.get_error_flag() and not stk.get_conId():
-                pass
+        # Only complete chains are cached, a failed or partial one is requested again on the next start instead of for the whole TTL.
+        for stk in cacheable:
+            cache.put(stk.get_symbol(), conId=stk.get_conId(), expiries=stk.get_expiries(), strikes=stk.get_strikes(),
+                      alias=self.core.symbol_aliases.get(stk.get_symbol()), listed_strikes=stk.listed_strikes)
+        if cacheable:
+            cache.save()
 
-            if stk.check_conId():
-                stk.set_reqId_assign(self.core.reqId_1, reqType='ReqExpStr')
-                self.tws_con.reqSecDefOptParams(self.core.reqId_1, stk.get_symbol(), '', stk.get_secType(), stk.get_conId())
-                self.core.reqId_1 += 1
-
-                self.core.contract_pool['STK'].append(stk)
-                time_breaker = datetime.now() + timedelta(seconds=5)
-                while not stk.get_expiries() and not stk.get_strikes() and datetime.now() < time_breaker:
-                    sleep(.1)
-                    pass
+        self.core.contract_pool['STK'].extend(stk for stk in stks if stk.check_conId())
 
         self.stk_sorter_pointer = len(self.core.contract_pool['STK'])
 
-        tprint('Building stock contracts ended.')
+        tprint(f'Building stock contracts ended. From cache: {len(stks) - len(stale)}, refreshed: {len(resolved)}, failed: {len(stale) - len(resolved)}.')
+
+    def discover_chains(self, stks: list['ContractContainer']) -> list['ContractContainer']:
+        """
+        Resolves conIds and option chains of many stock contracts concurrently (see run_discovery).
+        A resolved conId immediately issues the sec-def request of that symbol.
+
+        Args:
+            stks (list[ContractContainer]): Stock contracts to resolve.
+
+        Returns:
+            list[ContractContainer]: The stock contracts whose conId and option chain were resolved.
+        """
+        return [stk for stk, _ in self.run_discovery(jobs=[(stk, 'ReqConDetails', None) for stk in stks])]
+
+    def discover_listed_strikes(self, stks: list['ContractContainer']) -> list['ContractContainer']:
+        """
+        Requests the listed strikes of every expiry within the DTE window for the given stock contracts (see run_discovery).
+
+        Args:
+            stks (list[ContractContainer]): Stock contracts with resolved option chains.
+
+        Returns:
+            list[ContractContainer]: The stock contracts whose listed strikes were all resolved.
+        """
+        today = datetime.today()
+        jobs = []
+        for stk in stks:
+            for expiry in stk.get_expiries():
+                if self.core.prune_min_dte <= (datetime.strptime(expiry, '%Y%m%d') - today).days + 1 <= self.core.prune_max_dte:
+                    jobs.append((stk, 'ReqOptChain', expiry))
+
+        done = defaultdict(int)
+        for stk, _ in self.run_discovery(jobs=jobs):
+            done[id(stk)] += 1
+
+        return [stk for stk in stks if done[id(stk)] == sum(1 for job in jobs if job[0] is stk)]
+
+    def run_discovery(self, jobs: list[tuple['ContractContainer', str, str | None]]) -> list[tuple['ContractContainer', str | None]]:
+        """
+        Runs contract details / sec-def requests of many stock contracts concurrently.
+
+        Up to self.core.discovery_max_inflight requests are in flight, sent over the connection of each underlying
+        no faster than self.core.api_message_rate per connection.
+        Completions are matched by reqId. Failed or timed out requests are retried up to self.core.discovery_retries times
+        without blocking the others. Symbols with a dot (BRK.B) are retried with the TWS spelling (BRK B), registered in
+        self.core.symbol_aliases.
+
+        Args:
+            jobs (list[tuple]): (stock contract, reqType, expiry) with reqType ReqConDetails, ReqExpStr or ReqOptChain.
+                                Expiry is only used by ReqOptChain.
+
+        Returns:
+            list[tuple[ContractContainer, str | None]]: (stock contract, expiry) of every completed ReqExpStr / ReqOptChain job.
+        """
+        pending: deque[tuple['ContractContainer', str, str | None, int]] = deque((stk, reqType, expiry, 0) for stk, reqType, expiry in jobs)
+        in_flight: dict[int, tuple['ContractContainer', str, str | None, int, datetime]] = {}
+        resolved = []
+
+        while pending or in_flight:
+            self.core.request_signal.clear()
+
+            while pending and len(in_flight) < self.core.discovery_max_inflight:
+                stk, reqType, expiry, attempt = pending.popleft()
+
+                tws_con = self.tws_con.route(stk)
+                reqId = tws_con.next_reqId()
+                stk.set_reqId_assign(reqId, reqType=reqType)
+                match reqType:
+                    case 'ReqConDetails':
+                        stk.set_error_flag(flag=False)
+                        tws_con.reqContractDetails(reqId, stk.get_contract())
+                        timeout = self.core.contract_details_timeout
+                    case 'ReqExpStr':
+                        tws_con.reqSecDefOptParams(reqId, stk.get_contract().symbol, '', stk.get_secType(), stk.get_conId())
+                        timeout = self.core.sec_def_timeout
+                    case 'ReqOptChain':
+                        tws_con.reqContractDetails(reqId, stk.build_chain_contract(expiry=expiry))
+                        timeout = self.core.contract_details_timeout
+
+                in_flight[reqId] = (stk, reqType, expiry, attempt, datetime.now() + timedelta(seconds=timeout))
+                sleep(1 / (self.core.api_message_rate * len(self.tws_con)))  # the message rate limit applies per connection
+
+            for reqId, (stk, reqType, expiry, attempt, time_breaker) in list(in_flight.items()):
+                done = stk.is_request_done(reqId)
+                if not done and datetime.now() < time_breaker:
+                    continue
+                if not done:
+                    self.core.metrics.inc('request_timeouts', reqType=reqType, secType=stk.get_secType())
+
+                succeeded = done and not stk.is_request_failed(reqId)  # errors complete a request as well, release_request clears the flag
+                del in_flight[reqId]
+                stk.release_request(reqId)
+
+                if reqType == 'ReqConDetails' and succeeded and stk.get_conId():
+                    pending.append((stk, 'ReqExpStr', None, 0))
+                elif reqType == 'ReqExpStr' and succeeded and stk.get_expiries() and stk.get_strikes():
+                    resolved.append((stk, expiry))
+                elif reqType == 'ReqOptChain' and succeeded and stk.get_listed_strikes(expiry):
+                    resolved.append((stk, expiry))
+                elif attempt < self.core.discovery_retries:
+                    if reqType == 'ReqConDetails' and '.' in stk.get_symbol():
+                        self.core.symbol_aliases[stk.get_symbol()] = stk.get_symbol().replace('.', ' ')
+                        stk.release_contract(force=True)
+                    pending.append((stk, reqType, expiry, attempt + 1))
+                else:
+                    tprint(f'{reqType} for {stk.get_symbol()} {expiry or ""} failed after {attempt + 1} attempts.')
+
+            if in_flight:
+                timeout = min([self.core.request_signal_timeout] + [(t - datetime.now()).total_seconds() for *_, t in in_flight.values()])
+                self.core.request_signal.wait(timeout=max(timeout, 0.))
+
+        return resolved
 
     def build_opt_contracts(self, stk: 'ContractContainer', expiry: str = None) -> list['ContractContainer']:
         """
         Builds a list of ContractContainer objects representing options contracts from a stock ContractContainer object.
         If provided either uses specific expiry or alternatively loops through all in the stock ContractContainer object archived existing expiries.
+        If self.core.prune_chains is set, the expiry x strike cross product is pruned by the ChainPruner first.
+        Tables are not created here, the caller provisions them for the whole build in one batch (DatabaseBroker.provision_tables).
 
         Args:
             stk (ContractContainer): The stock ContractContainer.
@@ -124,20 +252,40 @@ class PipelineBuilder:
         else:
             expiries = stk.get_expiries()
 
-        for expiry in expiries:
-            opt = None
-            for strike in stk.get_strikes():
+        if self.core.prune_chains:
+            self.db.check_table_exists(contract_container=stk, create_missing=True)
+            chain = self.pruner.prune(stk=stk, expiries=expiries, last_price=stk.get_last_price(), expired=expiry is not None)
+        else:
+            chain = {x: stk.get_strikes() for x in expiries}
+
+        for expiry, strikes in chain.items():
+            for strike in strikes:
                 for right in ['C', 'P']:
                     opt = self.ContractContainer(self.core, symbol=stk.get_symbol(), secType='OPT', strike=strike, right=right, lastTradeDateOrContractMonth=expiry)
                     opt_contracts.append(opt)
                     stk.register_derivative_child(opt)
-            if opt:
-                self.db.check_table_exists(contract_container=opt)
-            else:
-                tprint(f'Could not check for table existence for {stk.get_symbol()} OPT on {expiry}.')
 
         return opt_contracts
 
+    def load_watermarks(self):
+        """
+        Loads the last update watermarks of all tables in the contract pools into self.core.watermarks.
+        Runs one grouped query per table, so the sorter decides without per contract database round trips.
+
+        :input: self.core.contract_pool
+        :output: self.core.watermarks :filling
+        """
+        tprint('Loading last update watermarks...')
+        tables = {}
+        for list_type in ['STK', 'OPT', 'EXP']:
+            for contract in self.core.contract_pool[list_type]:
+                tables.setdefault((contract.get_database(), contract.get_table()), contract)
+
+        for contract in tables.values():
+            contract.get_last_update(response=False)
+
+        tprint(f'Loading last update watermarks ended. Tables: {len(tables)}, contracts: {len(self.core.watermarks.watermarks)}')
+
     def get_exp_options(self):
         """
         Retrieves expired option contracts from the database.
@@ -157,7 +305,9 @@ class PipelineBuilder:
 
         expired_tables = {}
         for database in databases:
-            for table in table_structure[database]:
+            for table in table_structure.get(database, ()):
+                if table == self.core.sql_contract_table:
+                    continue
                 if datetime.strptime(table.split('_')[2], '%d%b%y').date() in expiries:
                     expired_tables[table] = None
 
@@ -175,33 +325,14 @@ class PipelineBuilder:
                 for i, contract_batch in enumerate(batched(opt_contracts, n=2)):
                     exp_order[i].extend(contract_batch)
                     for c in contract_batch:
-                        if c in self.core.contract_pool['OPT']:
-                            self.core.contract_pool['OPT'].remove(c)
+                        self.core.contract_pool['OPT'].remove(c)
 
         for key in exp_order.keys():
-            for contract in exp_order[key]:
-                self.core.contract_pool['EXP'].append(contract)
+            self.core.contract_pool['EXP'].extend(exp_order[key])
+        self.db.provision_tables(contract_containers=self.core.contract_pool['EXP'])
 
         tprint('Getting expired option contracts ended.')
 
-    def bit_to_insert(self): # TODO: Implement logical load vs rebuild logic
-
-        print('Loading contract data')
-        with open('option_contracts.pkl', 'rb') as file:
-            contracts = pickle.load(file)
-
-        print('Contract length:', len(contracts))
-        from time import perf_counter
-        start_time = perf_counter()
-
-        for i, contract in enumerate(contracts):
-            try:
-                if i % 100 == 0 and i != 0:
-                    perf = perf_counter() - start_time
-                    print(f'{perf} Secs. Count: {i}')
-            except pyodbc.ProgrammingError:
-                continue
-
     def pipeline_sorter(self):
         """
         Continuously monitors the contract pools and immediate pool,
@@ -209,14 +340,19 @@ class PipelineBuilder:
 
         Contract pools hold all newly created contracts. EXP and OPT sub-pools are popped after processing, while STK is in an endless but delayed loop
         STK and OPT contract pools double-check if SQL databases tables exist. Else they are created.
-        EXP and OPT contract pools check if all data up to expiry is already archived. Additionally OPT checks for necessity to request data, else it's rescheduled to the end of the pool.
+        EXP contract pool checks if all data up to expiry is already archived.
+        OPT is a DueTimeScheduler: a contract's next due time is computed once (ContractContainer.get_next_due) and
+        contracts not yet due are rescheduled in the heap instead of being re-evaluated.
 
         Very last there is a time-based scheduler to trigger EXP and STK contracts when appropriate. Eg. working days after trading hours
 
         This function runs indefinitely until the program is stopped.
 
+        Puts into the bounded immediate pool block while it is full, so the sorter only runs ahead of request_prices by self.core.ip_length contracts.
+        Every decision (queued, rescheduled, dropped, archived) is counted per pool in self.core.metrics.
+
         :input self.core.contract_pool :popping | Reordering | Index-Loop
-        :output elf.core.immediate_pool : appending
+        :output self.core.immediate_pool : appending
 
         """
         while True:
@@ -224,63 +360,63 @@ class PipelineBuilder:
                 sleep(1)
                 pass
 
-            while len(self.core.immediate_pool) < self.core.ip_length:
-
-                if len(self.core.contract_pool['EXP']) > 0:
-
-                    last_update = self.db.get_last_update(contract_container=self.core.contract_pool['EXP'][0], response=True)
-                    expiry = self.core.contract_pool['EXP'][0].get_expiry(dt_object=True)
-
-                    if (last_update and last_update < expiry + timedelta(hours=21, minutes=45)) or not last_update: # TODO add timezones for global application
-                        #tprint('Adding from EXP.')
-                        self.db.check_table_exists(contract_container=self.core.contract_pool['EXP'][0], create_missing=True)
-                        self.core.immediate_pool.append(self.core.contract_pool['EXP'].pop(0))
-                    else:
-                        self.core.contract_pool['EXP'].pop(0)
-
-                    if len(self.core.contract_pool['EXP']) % 1000 == 0:
-                        pct_done = ((self.option_exp_max_length - len(self.core.contract_pool['EXP'])) / self.option_exp_max_length) * 100
-                        contracts_done = self.option_exp_max_length - len(self.core.contract_pool['EXP'])
-                        tprint(f'Expired options progress: {pct_done:.2f}%. Contracts done: {contracts_done}')
-
-                    if not self.core.contract_pool['EXP'] or len(self.core.contract_pool['EXP']) == 0:
-                        self.core.exp_last_update = datetime.now().timestamp()
-                        set_key(dotenv_path='.env', key_to_set='EXP_LAST_UPDATE', value_to_set=str(self.core.exp_last_update))
-
-                elif len(self.core.contract_pool['STK'][self.stk_sorter_pointer:]) > 0:
-                    #tprint('Adding from STK.')
-                    self.db.check_table_exists(contract_container=self.core.contract_pool['STK'][self.stk_sorter_pointer], create_missing=True)
-                    self.core.immediate_pool.append(self.core.contract_pool['STK'][self.stk_sorter_pointer])
-                    #self.core.immediate_pool.append(self.core.contract_pool['STK'].pop(0))
-                    self.stk_sorter_pointer += 1
-
-                    if self.stk_sorter_pointer >= len(self.core.contract_pool['STK']):
-                        self.core.stk_last_update = datetime.now().timestamp()
-                        set_key(dotenv_path='.env', key_to_set='STK_LAST_UPDATE', value_to_set=str(self.core.stk_last_update))
-
-                elif self.core.contract_pool['OPT'] and len(self.core.contract_pool['OPT']) > 0:
-                    self.db.check_table_exists(contract_container=self.core.contract_pool['OPT'][0], create_missing=True)
-                    #tprint(f'OPT check')
-                    last_update = self.db.get_last_update(contract_container=self.core.contract_pool['OPT'][0], response=True)
-                    expiry = self.core.contract_pool['OPT'][0].get_expiry(dt_object=True)
-
-                    if expiry > datetime.now():
-                        if last_update and not (datetime.now() - last_update) < max(0.5 * (expiry - datetime.now()), timedelta(days=30)):
-                            #tprint('Adding from OPT1.')
-                            self.core.immediate_pool.append(self.core.contract_pool['OPT'].pop(0))
-                        elif last_update and last_update < expiry + timedelta(hours=21, minutes=45):
-                            #tprint('Adding from OPT2.')
-                            self.core.contract_pool['OPT'].pop(0)
-                        elif not last_update:
-                            #tprint('Adding from OPT3.')
-                            self.core.immediate_pool.append(self.core.contract_pool['OPT'].pop(0))
-                        else:
-                            #tprint('Adding from OPT4.')
-                            self.core.contract_pool['OPT'] = self.core.contract_pool['OPT'][1:].append(self.core.contract_pool['OPT'][0])
+            if len(self.core.contract_pool['EXP']) > 0:
+                contract = self.core.contract_pool['EXP'].get()
+
+                last_update = contract.get_last_update()
+                expiry = contract.get_expiry(dt_object=True)
+
+                if (last_update and last_update < expiry + timedelta(hours=21, minutes=45)) or not last_update: # TODO add timezones for global application
+                    #tprint('Adding from EXP.')
+                    self.db.check_table_exists(contract_container=contract, create_missing=True)
+                    self.core.immediate_pool.put(contract)
+                    self.core.metrics.inc('sorter_decisions', pool='EXP', decision='queued')
+                else:
+                    self.core.metrics.inc('sorter_decisions', pool='EXP', decision='archived')
+
+                if len(self.core.contract_pool['EXP']) % 1000 == 0:
+                    pct_done = ((self.option_exp_max_length - len(self.core.contract_pool['EXP'])) / self.option_exp_max_length) * 100
+                    contracts_done = self.option_exp_max_length - len(self.core.contract_pool['EXP'])
+                    tprint(f'Expired options progress: {pct_done:.2f}%. Contracts done: {contracts_done}')
+
+                if len(self.core.contract_pool['EXP']) == 0:
+                    self.core.exp_last_update = datetime.now().timestamp()
+                    set_key(dotenv_path='.env', key_to_set='EXP_LAST_UPDATE', value_to_set=str(self.core.exp_last_update))
+
+            elif len(self.core.contract_pool['STK'][self.stk_sorter_pointer:]) > 0:
+                #tprint('Adding from STK.')
+                self.db.check_table_exists(contract_container=self.core.contract_pool['STK'][self.stk_sorter_pointer], create_missing=True)
+                self.core.immediate_pool.put(self.core.contract_pool['STK'][self.stk_sorter_pointer])
+                self.core.metrics.inc('sorter_decisions', pool='STK', decision='queued')
+                self.stk_sorter_pointer += 1
+
+                if self.stk_sorter_pointer >= len(self.core.contract_pool['STK']):
+                    self.core.stk_last_update = datetime.now().timestamp()
+                    set_key(dotenv_path='.env', key_to_set='STK_LAST_UPDATE', value_to_set=str(self.core.stk_last_update))
+
+            elif len(self.core.contract_pool['OPT']) > 0:
+                now = datetime.now()
+                popped = self.core.contract_pool['OPT'].pop_due(now=now.timestamp())
+
+                if popped is None:
+                    next_due = self.core.contract_pool['OPT'].next_due()
+                    sleep(min(max(next_due - now.timestamp(), 0.), 1.) if next_due is not None else .1)
+                else:
+                    contract, scored = popped
+                    self.db.check_table_exists(contract_container=contract, create_missing=True)
+
+                    due = contract.get_next_due() if not scored else now
+                    if due is None:
+                        #tprint('Dropping from OPT, no refresh due before expiry.')
+                        self.core.metrics.inc('sorter_decisions', pool='OPT', decision='dropped')
+                    elif due > now:
+                        self.core.contract_pool['OPT'].schedule(contract, due=due.timestamp())
+                        self.core.metrics.inc('sorter_decisions', pool='OPT', decision='rescheduled')
                     else:
-                        #tprint('Adding from OPT5.')
-                        self.core.contract_pool['OPT'] = self.core.contract_pool['OPT'][1:] + [self.core.contract_pool['OPT'][0]]
+                        self.core.immediate_pool.put(contract)
+                        self.core.metrics.inc('sorter_decisions', pool='OPT', decision='queued')
 
+            else:
                 sleep(.1)
 
             if datetime.now().weekday() not in self.core.timer_exclude_days:
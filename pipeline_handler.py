@@ -1,11 +1,17 @@
+from collections import deque
 from datetime import datetime, timedelta
-from math import floor, ceil
+from heapq import heappop, heappush
+from itertools import count
+from math import ceil
+from queue import Empty
+import random
 from threading import Thread
-from time import sleep
+from time import monotonic, sleep
 
 from core import tprint
-
-import traceback
+from pacing import REQUEST_COSTS, HistoricalPacer
+from tws_api import RETRYABLE_ERRORS
+from writer_pool import WriterPool, store_price_data
 
 class PipelineHandler:
     def __init__(self, core =None, tws_con=None, CC=None, DB=None):
@@ -17,6 +23,18 @@ class PipelineHandler:
         self.ContractContainer = CC
         self.db = DB
 
+        self.pacers: dict['TWSCon', HistoricalPacer] = {tws_con: HistoricalPacer(core=self.core) for tws_con in self.tws_con}  # pacing budget per connection
+        self.in_flight: dict[int, tuple['ContractContainer', datetime, int, int, 'TWSCon', datetime, float]] = {}  # reqId: (contract, window end, days, attempt, connection, timeout, monotonic send time)
+        self.in_flight_count: dict['TWSCon', int] = {tws_con: 0 for tws_con in self.tws_con}
+        self.open_contracts: dict['ContractContainer', list] = {}  # contract: [open chunks, sent or planned requests, start of the oldest failed window, first request sent, windows not yet queued]
+        # planned chunks and due retries not yet sent per connection, held back by its window or pacing: (contract, end, days, attempt)
+        self.held_requests: dict['TWSCon', deque[tuple['ContractContainer', datetime, int, int]]] = {tws_con: deque() for tws_con in self.tws_con}
+        self.retries: list[tuple[float, int, 'TWSCon', 'ContractContainer', datetime, int, int]] = []  # heap of (monotonic due time, seq, connection, contract, window end, days, attempt)
+        self.retry_seq = count()
+        self.writers: WriterPool | None = None  # writer processes, started by write_to_database if self.core.writer_processes is set
+        self.streamed: dict['ContractContainer', list] = {}  # contract: [latest bar written by its streamed chunks, a chunk failed]
+        self.core.metrics.register_gauge('requests_in_flight', lambda: {str(tws_con.client_id): n for tws_con, n in self.in_flight_count.items()})
+
         self.t1 = Thread(target=self.request_prices, daemon=True).start()
         self.t2 = Thread(target=self.write_to_database, daemon=True).start()
 
@@ -27,160 +45,359 @@ class PipelineHandler:
 
             This method retrieves the contracts from the immediate pool and requests
             their historical price data using the TWS API's reqHistoricalData method.
-            Request parameters are determined by present data, e.g. last_update time.
-            The method waits until the data is available or a timeout is reached.
-            The retrieved data is added to the writable pool.
+            Request windows are sized to the range missing since the stored watermark (plan_requests). Gaps longer than
+            self.core.hist_chunk_days (default: the largest duration TWS allows for the bar size) are split into chunks, which are in flight in parallel and merged once all retired (finish_chunk).
+            Contracts are sent over the connection of their underlying (TWSRouter.route). Per connection up to
+            self.core.max_inflight_requests requests are kept in flight, keyed by reqId, and each connection has its own HistoricalPacer.
+            Between passes the method blocks on self.core.request_signal, which TWSCon callbacks and puts into the immediate pool set.
+            In-flight requests are retired once data is complete, an error is flagged or a timeout is reached (retire_requests).
+            Windows which timed out or failed with a retryable error are sent again from self.retries, ahead of new contracts.
+            The retrieved data is added to the writable pool. With self.core.stream_bars, the windows of a contract are sent one at a time,
+            oldest first, so the chunks streamed while bars arrive continue the stored bars. The TWS reader thread only seals
+            the chunks (ContractContainer.seal_price_data), they are handed to the writable pool here.
 
             :input: self.core.immediate_pool :popping
             :output: self.core.writable_pool :appending
             """
-        # print("Request_prices called from:")
-        # for line in traceback.format_stack()[:-1]:
-        #     print(line.strip())
+        while True:
+            self.core.request_signal.clear()
+            self.connection_handler()
+            self.retire_requests()
+            if self.core.stream_bars:
+                for contract_instance in self.open_contracts:
+                    if contract_instance.has_stream_chunks():
+                        contract_instance.flush_price_data()
+
+            while self.retries and self.retries[0][0] <= monotonic():
+                _, _, tws_con, *request = heappop(self.retries)
+                self.held_requests[tws_con].appendleft(tuple(request))
+
+            while len(self.open_contracts) < self.core.max_inflight_requests * len(self.tws_con):
+                try:
+                    contract_instance = self.core.immediate_pool.get_nowait()
+                except Empty:
+                    break
+                if contract_instance in self.open_contracts:
+                    continue  # queued again while its request is still running
+                windows = self.plan_requests(contract_instance=contract_instance)
+                self.open_contracts[contract_instance] = [len(windows), len(windows), None, False, []]
+                if self.core.stream_bars:
+                    self.open_contracts[contract_instance][4], windows = windows[:-1], windows[-1:]  # oldest first, queued by finish_chunk
+                self.held_requests[self.tws_con.route(contract_instance)].extend((contract_instance, end, days, 0) for end, days in windows)
+
+            waits = [self.core.request_signal_timeout]
+            for tws_con, held in self.held_requests.items():
+                while held and self.in_flight_count[tws_con] < self.core.max_inflight_requests:
+                    contract_instance, end, days, attempt = held[0]
+                    if wait := self.send_request(tws_con=tws_con, contract_instance=contract_instance, end=end, days=days, attempt=attempt):
+                        waits.append(wait)
+                        break
+                    held.popleft()
 
-        while not self.core.immediate_pool:
-            sleep(10)
+            timeout = min(waits + [(t - datetime.now()).total_seconds() for *_, t, _ in self.in_flight.values()]
+                          + ([self.retries[0][0] - monotonic()] if self.retries else []))
+            self.core.request_signal.wait(timeout=max(timeout, 0.))
 
-        while True:
-            try:
-                contract_instance = self.core.immediate_pool[0]
-                last_update = contract_instance.get_last_update()
-                last_update = last_update if last_update else datetime(year=datetime.today().year - 2, month=1, day=1)
+    def plan_requests(self, contract_instance: 'ContractContainer', **kwargs) -> list[tuple[datetime, int]]:
+        """
+        Sizes the requests of a contract to the range missing since its stored watermark.
 
-                duration = max(floor((datetime.now() - last_update) / timedelta(days=7) + 1), 1)
+        The range (watermark, now] is covered in whole days, newest first, by windows of at most self.core.hist_chunk_days,
+        or if unset the largest duration TWS allows for self.core.candle_length (self.core.hist_max_days).
+        Contracts without stored data start at January 1st two years back.
 
-                if duration > 52:
-                    duration_str = f'{ceil(duration / 52)} Y'
-                elif duration <= 52:
-                    duration_str = f'{duration} W'
-                else:
-                    raise Exception(f'Invalid duration: {duration}')
-
-                #tprint(f'Requesting prices for {contract_instance.get_symbol()} with last update {last_update} and duration {durationStr}')
-                contract_instance.set_reqId_assign(self.core.reqId_2, reqType='ReqHistData')
-                query_time = datetime.today().strftime("%Y%m%d-%H:%M:%S")
-                self.tws_con.reqHistoricalData( reqId=self.core.reqId_2,
-                                                contract=contract_instance.get_contract(),
-                                                endDateTime=query_time,
-                                                durationStr=duration_str,
-                                                barSizeSetting=self.core.candle_length,
-                                                whatToShow="Bid_Ask",
-                                                useRTH=1,
-                                                formatDate=1,
-                                                keepUpToDate=False,
-                                                chartOptions=[])
-                self.core.reqId_2 += 1
-
-                timeout_secs = 60
-                for k in self.core.timeout_breaker.keys():
-                    if duration <= k: timeout_secs = self.core.timeout_breaker[k]
-                time_breaker = datetime.now() + timedelta(seconds=timeout_secs)
-
-                while not contract_instance.get_error_flag() and not contract_instance.get_historical_data_end() and datetime.now() < time_breaker:
-                    if datetime.now() >= time_breaker and self.tws_con.isConnected():
-                        # TODO: reschedule contract a couple of positions later
-                        sleep(.1)
-                        break
-                    self.connection_handler()
-                    pass
+        Args:
+            contract_instance (ContractContainer): The contract to request price data for.
+
+        Returns:
+            list[tuple[datetime, int]]: (endDateTime, duration in days) per request.
+        """
+        now = datetime.now()
+        last_update = contract_instance.get_last_update()
+        last_update = last_update if last_update else datetime(year=datetime.today().year - 2, month=1, day=1)
+
+        gap_days = max(ceil((now - last_update) / timedelta(days=1)), 1)
+
+        chunk_days = self.core.hist_chunk_days or self.core.hist_max_days.get(self.core.candle_length, 1)
+
+        windows = []
+        end = now
+        while gap_days > 0:
+            days = min(gap_days, chunk_days)
+            windows.append((end, days))
+            end -= timedelta(days=days)
+            gap_days -= days
+
+        return windows
+
+    @staticmethod
+    def duration_str(days: int, **kwargs) -> str:
+        """
+        Returns the TWS durationStr of a window in the largest unit covering it exactly: years of 365 days, weeks or days.
+        Months are not used, as a TWS month can be shorter than 30 days and would leave a gap to the next window.
+        """
+        if days % 365 == 0:
+            return f'{days // 365} Y'
+        if days % 7 == 0:
+            return f'{days // 7} W'
+        return f'{days} D'
+
+    def send_request(self, tws_con: 'TWSCon', contract_instance: 'ContractContainer', end: datetime, days: int, attempt: int = 0, **kwargs) -> float:
+        """
+        Sends a reqHistoricalData request for one window of a contract if the pacing limits of the connection allow it.
+        All requests of a contract after its first one are received into the same buffer.
+
+        Args:
+            tws_con (TWSCon): The connection of the contract's underlying.
+            contract_instance (ContractContainer): The contract to request price data for.
+            end (datetime): endDateTime of the window.
+            days (int): Duration of the window in days.
+            attempt (int, optional): Number of earlier sends of this window.
+
+        Returns:
+            float: 0 if the request was sent, else seconds to wait for pacing.
+        """
+        duration_str = self.duration_str(days=days)
+        query_time = end.strftime("%Y%m%d-%H:%M:%S")
+
+        contract_key = (contract_instance.get_table(), contract_instance.get_right() if contract_instance.get_secType() == 'OPT' else None,
+                        contract_instance.get_strike() if contract_instance.get_secType() == 'OPT' else None)
+        request_key = (contract_key, query_time, duration_str, self.core.candle_length, 'Bid_Ask')
+        cost = REQUEST_COSTS.get('BID_ASK', 1)
+        wait = self.pacers[tws_con].wait_time(request_key=request_key, contract_key=contract_key, cost=cost)
+        if wait > 0:
+            return wait
+
+        #tprint(f'Requesting prices for {contract_instance.get_symbol()} until {query_time} and duration {duration_str}')
+        reqId = tws_con.next_reqId(historical=True)
+
+        state = self.open_contracts[contract_instance]
+        contract_instance.set_reqId_assign(reqId, reqType='ReqHistData', append=state[3])
+        state[3] = True
+        tws_con.reqHistoricalData( reqId=reqId,
+                                        contract=contract_instance.get_contract(),
+                                        endDateTime=query_time,
+                                        durationStr=duration_str,
+                                        barSizeSetting=self.core.candle_length,
+                                        whatToShow="Bid_Ask",
+                                        useRTH=1,
+                                        formatDate=1,
+                                        keepUpToDate=False,
+                                        chartOptions=[])
+        self.pacers[tws_con].register(request_key=request_key, contract_key=contract_key, cost=cost)
+
+        duration = ceil(days / 7)
+        timeout_secs = 60
+        for k in self.core.timeout_breaker.keys():
+            if duration <= k: timeout_secs = self.core.timeout_breaker[k]
+
+        self.in_flight[reqId] = (contract_instance, end, days, attempt, tws_con, datetime.now() + timedelta(seconds=timeout_secs), monotonic())
+        self.in_flight_count[tws_con] += 1
+
+        return 0.
+
+    def retire_requests(self):
+        """
+        Retires all in-flight requests which received historicalDataEnd, an error or ran into their timeout.
+        Round trips and timeouts are recorded in self.core.metrics, error codes are counted by TWSCon.error.
+
+        Pacing violations back off the pacer of the connection, completed requests let it recover.
+        Timeouts and retryable errors (tws_api.RETRYABLE_ERRORS) are queued to self.retries, after hist_retry_delay
+        doubled per attempt and jittered, until the window was sent hist_max_attempts times.
+        Other errors and exhausted windows retire the chunk as failed.
+
+        :input: self.in_flight :deleting
+        :output: self.retries :pushing | self.finish_chunk
+        """
+        for reqId, (contract_instance, end, days, attempt, tws_con, time_breaker, sent) in list(self.in_flight.items()):
+            if contract_instance.is_request_done(reqId):
+                error_class = contract_instance.get_request_error(reqId)
+                if error_class is None:
+                    self.core.metrics.observe('request_seconds', monotonic() - sent, reqType='ReqHistData', secType=contract_instance.get_secType())
+            elif datetime.now() >= time_breaker:
+                self.core.metrics.inc('request_timeouts', reqType='ReqHistData', secType=contract_instance.get_secType())
+                if tws_con.isConnected():
+                    tws_con.cancelHistoricalData(reqId)
+                error_class = 'timeout'
+            else:
+                continue
+
+            contract_instance.release_request(reqId)
+            del self.in_flight[reqId]
+            self.in_flight_count[tws_con] -= 1
+
+            if error_class is None:
+                self.pacers[tws_con].succeed(sent=sent)
+            elif error_class == 'pacing':
+                pause = self.pacers[tws_con].penalize(sent=sent)
+                if pause:
+                    tprint(f'Pacing violation on client ID {tws_con.client_id}, pausing requests for {pause:.0f} secs.')
+
+            if (error_class == 'timeout' or error_class in RETRYABLE_ERRORS) and attempt + 1 < self.core.hist_max_attempts:
+                delay = self.core.hist_retry_delay * 2 ** attempt * random.uniform(.5, 1.5)
+                heappush(self.retries, (monotonic() + delay, next(self.retry_seq), tws_con, contract_instance, end, days, attempt + 1))
+                if self.core.stream_bars:
+                    contract_instance.get_price_data().truncate(until=end - timedelta(days=days))  # bars of the window are received again
+                self.open_contracts[contract_instance][1] += 1
+                self.core.metrics.inc('request_retries', secType=contract_instance.get_secType(), error_class=error_class)
+                continue
+
+            self.finish_chunk(contract_instance=contract_instance, failed_since=end - timedelta(days=days) if error_class is not None else None)
+
+    def finish_chunk(self, contract_instance: 'ContractContainer', failed_since: datetime = None, **kwargs):
+        """
+        Accounts one retired chunk of a contract. Once all chunks are retired, the merged bars are passed on to the writable pool.
 
-                if contract_instance.get_historical_data_end():
-                    self.core.writable_pool.append(contract_instance)
+        Stored data has to stay contiguous from the watermark, so if chunks failed, only the bars up to the start of the
+        oldest failed window are kept. The next request of the contract then starts there. Nothing is kept if the oldest chunk failed;
+        OPT contracts are then due again after self.core.hist_failed_reschedule.
+        Streamed contracts (self.core.stream_bars) queue their next window here; after a failed one the newer windows are dropped
+        and the bars streamed so far are committed.
 
-                self.core.immediate_pool.pop(0)
+        Args:
+            contract_instance (ContractContainer): The contract of the retired chunk.
+            failed_since (datetime, optional): Start of the chunk's window if it failed (error or retries exhausted).
 
-            except IndexError:
-                while len(self.core.immediate_pool) == 0:
-                    sleep(.1)
+        :input: self.open_contracts :deleting
+        :output: self.held_requests :appending | self.core.writable_pool :appending
+        """
+        state = self.open_contracts[contract_instance]  # [open chunks, sent or planned requests, start of the oldest failed window, first request sent, windows not yet queued]
+        state[0] -= 1
+        if failed_since is not None:
+            state[2] = failed_since if state[2] is None else min(state[2], failed_since)
+            state[0] -= len(state[4])
+            state[4].clear()
+        elif state[4]:
+            end, days = state[4].pop()
+            self.held_requests[self.tws_con.route(contract_instance)].append((contract_instance, end, days, 0))
+        if state[0]:
+            return
+        del self.open_contracts[contract_instance]
+
+        price_data = contract_instance.get_price_data()
+        if state[1] > 1 and not self.core.stream_bars:  # streamed windows are received in order
+            price_data.sort_unique()
+        if state[2] is not None:
+            price_data.truncate(until=state[2])
+
+        if state[2] is not None and not price_data and not contract_instance.has_streamed():
+            contract_instance.release_price_data()
+            self.core.metrics.inc('contracts_failed', secType=contract_instance.get_secType())
+            if contract_instance.get_secType() == 'OPT':
+                self.core.contract_pool['OPT'].schedule(contract_instance, due=(datetime.now() + self.core.hist_failed_reschedule).timestamp())
+        else:
+            contract_instance.flush_price_data(final=True)
+
+        contract_instance.release_contract()
 
     def write_to_database(self):
         """
             Writes price data from the writable pool to the database.
 
-            This method continuously checks the writable pool for contract instances
-            with price data to be written to the database. It generates and passes on an INSERT query
-            for each contract instance and executes it to write the data to the database.
+            This method blocks on the writable pool for contract instances
+            with price data to be written to the storage backend (self.core.storage_backend).
+            Pool items are (contract, bars, last stored bar, final): one per contract, or with self.core.stream_bars
+            the chunks streamed while its requests are arriving, the last one final.
+            With self.core.writer_processes set, contracts are handed to the WriterPool, partitioned by table,
+            else they are written in this thread. Either way every write ends in acknowledge.
+            Once a streamed chunk of a contract failed, its later chunks are dropped: the watermark stays before the failed chunk,
+            so the next request of the contract receives their bars again.
 
             :input: self.core.writable_pool :popping
-            :output: self.db SQL class :pushing
+            :output: self.db SQL class :pushing | self.writers :submitting
             """
-        while not self.core.writable_pool:
-            sleep(10)
-
-        self.db = self.db(core=self.core, CC=self.ContractContainer)
+        self.db = self.db.shared(core=self.core, CC=self.ContractContainer)
+        if self.core.writer_processes:
+            self.writers = WriterPool(core=self.core, CC=self.ContractContainer, DB=type(self.db), on_ack=self.acknowledge)
 
         while True:
-            try:
-                contract_instance = self.core.writable_pool[0]
-                existing_dates = self.db.get_existing_dates(contract_container=contract_instance)
-
-                match contract_instance.get_secType():
-                    case 'STK':
-                        columns = 'date, h, l, o, c'
-                    case 'OPT':
-                        columns = 'date, identifier, callput, strike, h, l, o, c'
-                    case _:
-                        raise Exception(f'Invalid secType: {contract_instance.get_secType()}')
-
-                iq_header = f"""
-                            INSERT INTO [{contract_instance.get_database()}].[dbo].[{contract_instance.get_table()}] ({columns})
-                            VALUES
-                            """
-
-                iq_rows = []
-                for i, (dt, ohlc) in enumerate(contract_instance.get_price_data().items(), start=1):
-                    #TODO: Check if dt is already datetime object
-                    if not existing_dates or datetime.strptime(dt, "%Y%m%d %H:%M:%S") not in existing_dates:
-                        match contract_instance.get_secType():
-                            case 'STK':
-                                data_query = f"('{dt}', {ohlc['High']}, {ohlc['Low']}, {ohlc['Open']}, {ohlc['Close']})"
-                            case 'OPT':
-                                security_identifier = f'{contract_instance.get_symbol()}_{contract_instance.get_strike()}_{contract_instance.get_right()}_{contract_instance.get_expiry(output_str_format='%d%b%y')}'
-
-                                data_query = f"('{dt}', '{security_identifier}', '{contract_instance.get_right()}', {contract_instance.get_strike()}, {ohlc['High']}, {ohlc['Low']}, {ohlc['Open']}, {ohlc['Close']})"
-                            case _:
-                                raise Exception(f'Invalid secType: {contract_instance.get_secType()}')
-
-                        iq_rows.append(data_query)
-
-                if iq_header and iq_rows:
-                    if contract_instance.get_secType() == 'OPT':
-                        tprint(f'Writing #{len(iq_rows)} price data for {contract_instance.get_symbol()} {contract_instance.get_secType()} to database {contract_instance.get_table()} {contract_instance.get_right()} {contract_instance.get_strike()}.')
-                        #if len(iq_rows) == 0:
-
-                    else:
-                        tprint(f'Writing #{len(iq_rows)} price data for {contract_instance.get_symbol()} {contract_instance.get_secType()} to database {contract_instance.get_table()}.')
-
-                    for i in range(ceil(len(iq_rows) / self.core.insert_query_max_lines)):
-                        insert_query = iq_header + ','.join(str(x) for x in iq_rows[i * self.core.insert_query_max_lines:min(len(iq_rows), (i + 1) * self.core.insert_query_max_lines)]) + ';'
-                        self.db.write_price_data(query_string=insert_query)
-                else:
-                    if contract_instance.get_secType() == 'OPT':
-                        tprint(f'Writing no price data for {contract_instance.get_symbol()} {contract_instance.get_secType()} to database {contract_instance.get_table()} {contract_instance.get_right()} {contract_instance.get_strike()}.')
-                    else:
-                        tprint(f'Writing no price data for {contract_instance.get_symbol()} {contract_instance.get_secType()} to database {contract_instance.get_table()}.')
+            contract_instance, price_data, last_stored, final = self.core.writable_pool.get()
+
+            if self.writers is not None:
+                self.writers.submit(contract_instance=contract_instance, price_data=price_data, last_stored=last_stored, final=final)
+                continue
+
+            if self.streamed.get(contract_instance, (None, False))[1]:
+                tprint(f'Dropping {len(price_data)} streamed bars of {contract_instance.get_symbol()} {contract_instance.get_secType()} after a failed chunk.')
+                self.acknowledge(contract_instance, 0, None, 0., final=final)
+                continue
 
-                self.core.writable_pool.pop(0)
+            start = monotonic()
+            try:
+                written, last_update = store_price_data(core=self.core, db=self.db, contract_instance=contract_instance,
+                                                        price_data=price_data, last_stored=last_stored)
+                self.acknowledge(contract_instance, written, last_update, monotonic() - start, final=final)
+            except Exception as err:
+                self.acknowledge(contract_instance, 0, None, monotonic() - start, repr(err), final=final)
+
+    def acknowledge(self, contract_instance: 'ContractContainer', written: int, last_update: datetime | None, seconds: float, error: str = None,
+                    final: bool = True):
+        """
+        Completes the write of a contract: records it in self.core.metrics, advances its watermark and reschedules OPT contracts,
+        after self.core.hist_failed_reschedule if a write of the contract failed.
+        Called in order per table, by the writer thread or the WriterPool collector.
 
-            except IndexError as err:
-                #tprint(f'IndexError 987 {err}')
-                #tprint(f'Self.core.writable_pool length:{len(self.core.writable_pool)}')
-                while len(self.core.writable_pool) == 0:
-                    sleep(.1)
+        Chunks streamed ahead of the final write (final False) are only recorded. The final write commits the watermark
+        to the latest bar written, or, if a chunk failed, to the latest bar written before it; the chunks after a failed one
+        are dropped by the writer (write_to_database, writer_pool.writer_process).
 
+        :input: self.core.writable_pool :task_done
+        :output: self.core.contract_pool['OPT'] :scheduling
+        """
+        try:
+            self.core.metrics.observe('write_seconds', seconds, backend=type(self.db).__name__)
+            stream = self.streamed.pop(contract_instance, [None, False])  # [latest bar written, a chunk failed]
+            if error is not None:
+                self.core.metrics.inc('write_errors', secType=contract_instance.get_secType())
+                tprint(f'Writing price data for {contract_instance.get_symbol()} to {contract_instance.get_table()} failed: {error}')
+                stream[1] = True
+            elif written:
+                self.core.metrics.inc('bars_written', written, secType=contract_instance.get_secType())
+                if not stream[1]:
+                    stream[0] = last_update
+
+            if not final:
+                self.streamed[contract_instance] = stream
+                return
+
+            if stream[0] is not None:
+                self.core.watermarks.update(contract_instance, last_update=stream[0])
+
+            if contract_instance.get_secType() == 'OPT':
+                if stream[1]:
+                    due = datetime.now() + self.core.hist_failed_reschedule
+                else:
+                    due = contract_instance.get_next_due()
+                    if due is not None:
+                        # A just fetched contract is not due again before opt_min_refresh, even if its last bar is old or missing.
+                        due = max(due, datetime.now() + self.core.opt_min_refresh)
+                if due is not None:
+                    self.core.contract_pool['OPT'].schedule(contract_instance, due=due.timestamp())
+
+        finally:
+            if final:
+                contract_instance.release_price_data()
+            self.core.writable_pool.task_done()
 
     def connection_handler(self) -> bool:
-        if not self.tws_con.isConnected():
-            print('Disconnected 34567')
+        """
+        Reconnects every lost connection of self.tws_con, including its reader thread (TWSCon.start_connection).
+        Failed attempts are retried after self.core.reconnect_delay, doubled per attempt up to self.core.reconnect_max_delay.
+        Blocks the request window until all connections are up again.
+        """
+        for tws_con in self.tws_con:
+            if tws_con.isConnected():
+                continue
+            tprint(f'Connection of client ID {tws_con.client_id} lost, reconnecting...')
+            delay = self.core.reconnect_delay
             while True:
                 try:
-                    print(1)
-                    self.tws_con.connect(self.core.host_ip, self.core.api_port, self.core.client_id) # Reconnection fails here.
-                    print(2)
-                    sleep(10)
-                    if self.tws_con.isConnected():
-                        print(3)
-                        break
-                except:
-                    print(4)
+                    tws_con.start_connection()
+                except OSError as err:  # socket errors, ConnectionError included
+                    tprint(f'Reconnecting client ID {tws_con.client_id} failed: {err!r}')
+                if tws_con.isConnected():
+                    tprint(f'Reconnected client ID {tws_con.client_id}.')
+                    break
+                sleep(delay)
+                delay = min(delay * 2, self.core.reconnect_max_delay)
         return True
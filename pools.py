@@ -0,0 +1,166 @@
+from heapq import heapify, heappop, heappush
+from itertools import count
+from queue import Queue
+import random
+from threading import Event, Lock
+
+
+class ContractQueue(Queue):
+    """
+    Thread-safe FIFO pool of ContractContainer objects.
+
+    Based on queue.Queue (deque storage), so put/get are O(1), get blocks until an item is available and
+    put blocks while a bounded queue is full, which provides backpressure between pipeline stages.
+    Optionally sets signal on every put, to wake consumers that wait on an Event instead of the queue.
+    """
+    def __init__(self, maxsize: int = 0, signal: Event = None):
+        super().__init__(maxsize=maxsize)
+        self.signal = signal
+        self.max_depth: int = 0
+
+    def _put(self, item):
+        super()._put(item)
+        self.max_depth = max(self.max_depth, len(self.queue))
+        if self.signal is not None:
+            self.signal.set()
+
+    def extend(self, items: list, **kwargs):
+        """
+        Appends all items at once, ignoring maxsize. Meant for bulk loading the unbounded contract pools.
+        """
+        with self.not_empty:
+            self.queue.extend(items)
+            self.unfinished_tasks += len(items)
+            self.max_depth = max(self.max_depth, len(self.queue))
+            self.not_empty.notify_all()
+
+    def shuffle(self, **kwargs):
+        with self.mutex:
+            items = list(self.queue)
+            random.shuffle(items)
+            self.queue.clear()
+            self.queue.extend(items)
+
+    def remove(self, item, **kwargs) -> bool:
+        """
+        Removes an item from the queue. O(n), only meant for rare maintenance operations.
+
+        Returns:
+            bool: True if the item was found and removed.
+        """
+        with self.mutex:
+            try:
+                self.queue.remove(item)
+            except ValueError:
+                return False
+            self.unfinished_tasks -= 1
+            self.not_full.notify()
+            return True
+
+    def snapshot(self, **kwargs) -> list:
+        with self.mutex:
+            return list(self.queue)
+
+    def depth(self, **kwargs) -> int:
+        return self.qsize()
+
+    def __len__(self) -> int:
+        return self.qsize()
+
+    def __bool__(self) -> bool:
+        return self.qsize() > 0
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+
+class DueTimeScheduler:
+    """
+    Thread-safe priority queue of option ContractContainer objects ordered by the time they are due for a price refresh.
+
+    Picking the next due contract is O(log n); contracts which are not due yet stay untouched in the heap.
+    Contracts added in bulk by extend are not scored yet: they are due immediately and their real due time is computed
+    once by the consumer when popped (see pop_due). Ties are broken randomly if randomize is set, else in insertion order.
+    """
+    def __init__(self, randomize: bool = False):
+        self.heap: list[list] = []
+        self.entries: dict[int, list] = {}
+        self.randomize = randomize
+        self.counter = count()
+        self.lock = Lock()
+
+    def tiebreak(self) -> float:
+        return random.random() if self.randomize else next(self.counter)
+
+    def schedule(self, contract: 'ContractContainer', due: float = 0., scored: bool = True, **kwargs):
+        """
+        Schedules a contract at due (timestamp). Replaces an existing entry of the same contract.
+        """
+        with self.lock:
+            self.invalidate(contract)
+            entry = [due, self.tiebreak(), contract, scored]
+            self.entries[id(contract)] = entry
+            heappush(self.heap, entry)
+
+    def extend(self, contracts: list['ContractContainer'], **kwargs):
+        """
+        Adds unscored contracts, due immediately. O(n) heapify of the combined heap.
+        """
+        with self.lock:
+            for contract in contracts:
+                self.invalidate(contract)
+                entry = [0., self.tiebreak(), contract, False]
+                self.entries[id(contract)] = entry
+                self.heap.append(entry)
+            heapify(self.heap)
+
+    def pop_due(self, now: float, **kwargs) -> tuple['ContractContainer', bool] | None:
+        """
+        Pops the contract with the earliest due time if it is due at now (timestamp).
+
+        Returns:
+            tuple[ContractContainer, bool] | None: The contract and whether its due time was already computed, else None.
+        """
+        with self.lock:
+            self.drop_invalid()
+            if not self.heap or self.heap[0][0] > now:
+                return None
+            due, _, contract, scored = heappop(self.heap)
+            del self.entries[id(contract)]
+            return contract, scored
+
+    def next_due(self, **kwargs) -> float | None:
+        with self.lock:
+            self.drop_invalid()
+            return self.heap[0][0] if self.heap else None
+
+    def remove(self, contract: 'ContractContainer', **kwargs) -> bool:
+        with self.lock:
+            return self.invalidate(contract)
+
+    def invalidate(self, contract: 'ContractContainer') -> bool:
+        entry = self.entries.pop(id(contract), None)
+        if entry is None:
+            return False
+        entry[2] = None
+        return True
+
+    def drop_invalid(self):
+        while self.heap and self.heap[0][2] is None:
+            heappop(self.heap)
+
+    def snapshot(self, **kwargs) -> list:
+        with self.lock:
+            return [entry[2] for entry in self.entries.values()]
+
+    def depth(self, **kwargs) -> int:
+        return len(self.entries)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __bool__(self) -> bool:
+        return len(self.entries) > 0
+
+    def __iter__(self):
+        return iter(self.snapshot())
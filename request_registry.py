@@ -0,0 +1,57 @@
+from collections import Counter
+from threading import Lock
+from typing import Callable
+
+
+class RequestRegistry:
+    """
+    Callbacks of the open TWS requests: reqId -> bound method of the receiving container (ContractContainer, AsyncRequest).
+
+    The callbacks keep their container and its received bars alive, so an entry only lives from register
+    (ContractContainer.set_reqId_assign, AsyncTWS.register) until release. TWSCon releases a request on its end callback
+    (historicalDataEnd, contractDetailsEnd, securityDefinitionOptionParameterEnd) and on errors which complete it;
+    timed out requests are released by their owner (ContractContainer.release_request, AsyncTWS.release).
+    Callbacks arriving for a released reqId, e.g. bars of a cancelled request, find no entry and are dropped by TWSCon.
+    """
+    def __init__(self):
+        self.callbacks: dict[int, Callable] = {}
+        self.registered: int = 0  # requests registered since start
+        self.released: int = 0  # requests released since start
+        self.lock = Lock()
+
+    def register(self, reqId: int, callback: Callable, **kwargs):
+        with self.lock:
+            if reqId not in self.callbacks:
+                self.registered += 1
+            self.callbacks[reqId] = callback
+
+    def release(self, reqId: int, **kwargs) -> Callable | None:
+        """
+        Removes the entry of a request. Returns its callback, None if it was released before.
+        """
+        with self.lock:
+            callback = self.callbacks.pop(reqId, None)
+            if callback is not None:
+                self.released += 1
+        return callback
+
+    def get(self, reqId: int, **kwargs) -> Callable | None:
+        return self.callbacks.get(reqId)
+
+    def container(self, reqId: int, **kwargs) -> 'ContractContainer | None':
+        callback = self.callbacks.get(reqId)
+        return callback.__self__ if callback is not None else None
+
+    def live(self, **kwargs) -> dict[str, int]:
+        """
+        Returns the number of registered requests per reqType, e.g. as metrics gauge.
+        """
+        with self.lock:
+            items = list(self.callbacks.items())
+        return dict(Counter(callback.__self__.get_reqType(reqId) or 'none' for reqId, callback in items))
+
+    def __contains__(self, reqId: int) -> bool:
+        return reqId in self.callbacks
+
+    def __len__(self) -> int:
+        return len(self.callbacks)
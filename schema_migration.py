@@ -0,0 +1,147 @@
+"""
+Migrates existing price tables to the schema configured in Core (sql_schema_mode, sql_index_tables, sql_page_compression).
+
+    compact: legacy option tables are rebuilt with contract_key into the contract dimension table of their database
+             and a clustered primary key on (contract_key, date). Stock tables get a clustered index on date.
+    legacy:  heap tables get the clustered index of their layout if sql_index_tables is set.
+
+Every table is migrated in its own transaction, so an interrupted run can simply be restarted.
+Stop the scraper while migrating.
+
+Usage:
+    python -m schema_migration [--database Data_OPT_Jan25] [--dry-run]
+"""
+from argparse import ArgumentParser
+from datetime import datetime
+import pyodbc
+
+from contract_container import ContractContainer
+from core import Core, tprint
+from database_broker import DatabaseBroker
+
+
+class SchemaMigrator(DatabaseBroker):
+    """
+    DatabaseBroker with the catalog queries and DDL needed to migrate existing tables in place.
+    """
+    @DatabaseBroker.sql_query
+    def fetch_table_layouts(self, cursor: pyodbc.Cursor, db_name: str, **kwargs) -> dict[str: dict[str, tuple[set[str], bool]], str: bool]:
+        """
+        Fetches columns and clustered index state of all tables of a database.
+
+        Returns:
+            dict: A dictionary containing {table: (columns, has_clustered_index)} and a flag indicating if the operation was committed.
+        """
+        query = f"""
+                SELECT t.name, c.name, CASE WHEN EXISTS (
+                    SELECT 1 FROM [{db_name}].sys.indexes i WHERE i.object_id = t.object_id AND i.type = 1
+                    ) THEN 1 ELSE 0 END
+                FROM [{db_name}].sys.tables t
+                JOIN [{db_name}].sys.columns c ON c.object_id = t.object_id;
+                """
+        cursor.execute(query)
+
+        layouts = {}
+        for table, column, clustered in cursor.fetchall():
+            columns, _ = layouts.setdefault(table, (set(), bool(clustered)))
+            columns.add(column)
+
+        return {'data': layouts, 'commit': False}
+
+    @DatabaseBroker.sql_query
+    def add_clustered_index(self, cursor: pyodbc.Cursor, db_name: str, table_name: str, key: str, **kwargs) -> dict[str: None, str: bool]:
+        compression = ' WITH (DATA_COMPRESSION = PAGE)' if self.core.sql_page_compression else ''
+        cursor.execute(f'CREATE CLUSTERED INDEX [CIX_{table_name}] ON [{db_name}].[dbo].[{table_name}] ({key}){compression};')
+
+        return {'data': None, 'commit': True}
+
+    @DatabaseBroker.sql_query
+    def migrate_to_compact(self, cursor: pyodbc.Cursor, db_name: str, table_name: str, **kwargs) -> dict[str: int, str: bool]:
+        """
+        Rebuilds a legacy option table in the compact layout within one transaction.
+
+        Registers all contracts of the table in the dimension table, copies the price rows with their contract_key
+        into a new table (duplicate bars are dropped by its primary key) and replaces the legacy table with it.
+
+        Returns:
+            dict: A dictionary containing the number of copied rows and a flag indicating if the operation needs to be committed.
+        """
+        symbol, _, expiry = table_name.split('_')
+        expiry = datetime.strptime(expiry, '%d%b%y').date()
+        source = f'[{db_name}].[dbo].[{table_name}]'
+        target_name = f'{table_name}__compact'
+        dimension = f'[{db_name}].[dbo].[{self.core.sql_contract_table}]'
+
+        cursor.execute(f"IF OBJECT_ID('{db_name}.dbo.{self.core.sql_contract_table}') IS NULL {self.dimension_ddl(db_name=db_name)}")
+        cursor.execute(f"""
+                SET NOCOUNT ON;
+                INSERT INTO {dimension} (symbol, expiry, strike, callput)
+                SELECT DISTINCT ?, ?, s.strike, s.callput
+                FROM {source} s
+                WHERE s.strike IS NOT NULL AND s.callput IS NOT NULL AND NOT EXISTS (
+                    SELECT 1 FROM {dimension} d
+                    WHERE d.symbol = ? AND d.expiry = ? AND d.strike = s.strike AND d.callput = s.callput);
+                """, symbol, expiry, symbol, expiry)
+
+        cursor.execute(self.table_ddl(db_name=db_name, table_name=target_name, secType='OPT'))
+        cursor.execute(f"""
+                INSERT INTO [{db_name}].[dbo].[{target_name}] (contract_key, date, h, l, o, c)
+                SELECT d.contract_key, s.date, s.h, s.l, s.o, s.c
+                FROM {source} s
+                JOIN {dimension} d ON d.symbol = ? AND d.expiry = ? AND d.strike = s.strike AND d.callput = s.callput
+                WHERE s.date IS NOT NULL;
+                """, symbol, expiry)
+        copied = cursor.rowcount
+
+        cursor.execute(f"""
+                DROP TABLE {source};
+                EXEC [{db_name}].sys.sp_rename N'dbo.{target_name}', N'{table_name}';
+                EXEC [{db_name}].sys.sp_rename N'dbo.PK_{target_name}', N'PK_{table_name}', N'OBJECT';
+                """)
+
+        return {'data': copied, 'commit': True}
+
+    def run(self, databases: list[str] = None, dry_run: bool = False, **kwargs):
+        """
+        Migrates all tables of the given (default: all non system) databases which do not match the configured schema.
+        """
+        catalog = self.fetch_all_table_names(return_data=True)
+        compact = self.core.sql_schema_mode == 'compact'
+
+        for db_name in sorted(databases or catalog.keys()):
+            layouts = self.fetch_table_layouts(db_name=db_name)
+
+            for table_name, (columns, clustered) in sorted(layouts.items()):
+                if table_name == self.core.sql_contract_table or table_name.count('_') not in (1, 2):
+                    continue
+
+                if table_name.count('_') == 2 and compact and 'identifier' in columns:
+                    action = 'compact'
+                elif not clustered and (compact or self.core.sql_index_tables):
+                    action = 'index'
+                else:
+                    continue
+
+                tprint(f'{db_name}.{table_name}: {action}{' [dry run]' if dry_run else ''}')
+                if dry_run:
+                    continue
+
+                if action == 'compact':
+                    copied = self.migrate_to_compact(db_name=db_name, table_name=table_name)
+                    tprint(f'{db_name}.{table_name}: {copied} rows migrated.')
+                else:
+                    key = 'date' if table_name.count('_') == 1 else ('contract_key, date' if 'contract_key' in columns else 'strike, callput, date')
+                    self.add_clustered_index(db_name=db_name, table_name=table_name, key=key)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Migrate price tables to the configured schema mode.')
+    parser.add_argument('--database', action='append', help='Database to migrate, repeatable. Defaults to all.')
+    parser.add_argument('--dry-run', action='store_true', help='Only list the tables which would be migrated.')
+    args = parser.parse_args()
+
+    core = Core()
+    try:
+        SchemaMigrator(core=core, CC=ContractContainer).run(databases=args.database, dry_run=args.dry_run)
+    finally:
+        core.sql_pool.close_all()
@@ -0,0 +1,161 @@
+from datetime import datetime
+from threading import Lock
+from typing import Iterable
+
+
+def backend_class(core) -> type['StorageBackend']:
+    """
+    Returns the StorageBackend implementation selected by core.storage_backend.
+    Imported lazily, so a backend's dependencies (pyodbc, pyarrow) are only needed if it is used.
+    """
+    match core.storage_backend:
+        case 'sql':
+            from database_broker import DatabaseBroker
+            return DatabaseBroker
+        case 'parquet':
+            from parquet_broker import ParquetBroker
+            return ParquetBroker
+        case _:
+            raise KeyError(f'Storage backend not supported: {core.storage_backend}. Valid backends: sql, parquet')
+
+
+class StorageBackend:
+    """
+    Interface between the pipeline and the price history store.
+
+    Prices are stored per table: one table per stock (Data_STK / SYMBOL_STK) and one per option series
+    (Data_OPT_%b%y / SYMBOL_OPT_%d%b%y), as named by ContractContainer.get_database and get_table.
+    Implementations keep a catalog of existing tables in self.table_structure ({database: {tables}}).
+    """
+    _shared_lock = Lock()  # guards the creation of the shared broker per core
+
+    def __init__(self, core=None, CC=None):
+        if None in (core, CC):
+            raise Exception(f'<{type(self).__name__} INIT> All parameters must be specified.')
+
+        self.core = core
+        self.table_structure: dict[str, set[str]] = core.table_structure  # catalog shared by all brokers of a core
+        self.ContractContainer = CC
+
+    @classmethod
+    def shared(cls, core, CC=None) -> 'StorageBackend':
+        """
+        Returns one broker per core, shared by all ContractContainer instances.
+        Created on first use under a lock, as the request thread, the writer thread and the TWS reader threads may ask at once.
+        """
+        if core.db_broker is None:
+            with cls._shared_lock:
+                if core.db_broker is None:
+                    core.db_broker = cls(core=core, CC=CC)
+        return core.db_broker
+
+    def fetch_all_table_names(self, return_data: bool = False, **kwargs) -> dict[str, set[str]] | None:
+        """
+        (Re)loads the catalog of all tables into self.table_structure. Returns it if return_data is set.
+        """
+        raise NotImplementedError
+
+    def check_table_exists(self, contract_container: "ContractContainer", create_missing: bool = True, **kwargs) -> bool:
+        """
+         Check if a table exists for a given contract.
+         Only a lookup in the cached catalog, missing tables are created through provision_tables.
+
+         Args:
+             contract_container (ContractContainer): The contract object.
+             create_missing (bool, optional): Whether to create the table if it doesn't exist. Defaults to True.
+
+         Returns:
+             bool: True if the table exists (or was created).
+         """
+        if not self.table_structure:
+            self.fetch_all_table_names()
+
+        if contract_container.get_table() in self.table_structure.get(contract_container.get_database(), ()):
+            return True
+
+        if create_missing:
+            self.provision_tables(contract_containers=[contract_container])
+            return True
+
+        return False
+
+    def provision_tables(self, contract_containers: "Iterable[ContractContainer]", **kwargs) -> int:
+        """
+        Creates all missing tables of the given contracts and adds them to the catalog.
+
+        Returns:
+            int: Number of created tables.
+        """
+        raise NotImplementedError
+
+    def missing_tables(self, contract_containers: "Iterable[ContractContainer]", **kwargs) -> dict[tuple[str, str], str]:
+        """
+        Returns {(database, table): secType} of all tables of the given contracts missing in the catalog.
+        """
+        if not self.table_structure:
+            self.fetch_all_table_names()
+
+        missing = {}
+        for contract_container in contract_containers:
+            database_name, table_name = contract_container.get_database(), contract_container.get_table()
+            if table_name not in self.table_structure.get(database_name, ()):
+                missing.setdefault((database_name, table_name), contract_container.get_secType())
+        return missing
+
+    def get_last_update(self, contract_container: "ContractContainer", **kwargs) -> datetime | None:
+        """
+        Returns the latest stored bar date of a contract, None if nothing is stored.
+        """
+        raise NotImplementedError
+
+    def get_table_watermarks(self, contract_container: "ContractContainer", **kwargs) -> list[tuple]:
+        """
+        Returns (strike, callput, last_update) of every contract stored in the table of the given contract.
+        Strike and callput are None for STK tables.
+        """
+        raise NotImplementedError
+
+    def get_last_price(self, stk_symbol: str, **kwargs) -> float | None:
+        """
+        Returns the latest stored close of a stock.
+        """
+        raise NotImplementedError
+
+    def get_existing_dates(self, contract_container: "ContractContainer" = None, start: datetime = None, end: datetime = None, **kwargs) -> set[datetime]:
+        """
+        Returns the stored bar dates of a contract, optionally limited to the window [start, end].
+        """
+        raise NotImplementedError
+
+    def price_columns(self, secType: str) -> list[str]:
+        """
+        Returns the column order of the rows passed to write_price_rows.
+        """
+        raise NotImplementedError
+
+    def row_prefix(self, contract_container: "ContractContainer", **kwargs) -> tuple:
+        """
+        Returns the contract columns written between date and the prices of every row, see price_columns.
+        """
+        raise NotImplementedError
+
+    def write_price_rows(self, contract_container: "ContractContainer", rows: list[tuple], **kwargs) -> int:
+        """
+        Stores price rows of a contract, ordered as price_columns.
+
+        Returns:
+            int: Number of written rows.
+        """
+        raise NotImplementedError
+
+    def flush(self, **kwargs):
+        """
+        Persists rows buffered by the backend. No-op for backends which write through.
+        """
+        pass
+
+    def close(self, **kwargs):
+        """
+        Flushes and releases the backend's resources.
+        """
+        self.flush()
@@ -0,0 +1,29 @@
+import unittest
+from datetime import datetime
+
+from bar_buffer import BarBuffer, bar_timestamp, to_datetime, to_timestamp
+
+
+class BarTimestampTest(unittest.TestCase):
+    def test_single_space(self):
+        self.assertEqual(to_datetime(bar_timestamp('20240105 09:30:00')), datetime(2024, 1, 5, 9, 30))
+
+    def test_two_spaces(self):
+        self.assertEqual(to_datetime(bar_timestamp('20240105  09:30:00')), datetime(2024, 1, 5, 9, 30))
+
+    def test_timezone_suffix(self):
+        self.assertEqual(to_datetime(bar_timestamp('20240105 15:45:30 US/Eastern')), datetime(2024, 1, 5, 15, 45, 30))
+
+    def test_daily_bar(self):
+        self.assertEqual(bar_timestamp('20240105'), to_timestamp(datetime(2024, 1, 5)))
+
+    def test_buffer_append(self):
+        bars = BarBuffer(chunk=2)
+        bars.append('20240105  09:30:00', 1., 1.1, .9, 1.)
+        bars.append('20240104  16:00:00 US/Eastern', 1., 1.1, .9, 1.)
+        self.assertEqual(bars.first(), datetime(2024, 1, 4, 16))
+        self.assertEqual(bars.last(), datetime(2024, 1, 5, 9, 30))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,55 +1,187 @@
 from ibapi.client import EClient
 from ibapi.wrapper import EWrapper
 import threading
+from typing import Iterator
 
 import time
 
 from core import tprint
 
+RETRYABLE_ERRORS: set[str] = {'pacing', 'cancelled', 'connection'}  # error classes worth sending the request again
+
+
+def classify_error(errorCode: int, errorString: str) -> str | None:
+    """
+    Classifies a TWS error message of a request.
+
+    Returns:
+        str | None: 'no_data' (empty window), 'pacing' (pacing violation), 'cancelled' (HMDS query cancelled or timed out),
+            'connection' (connectivity lost), 'invalid' (no security definition, rejected request) or None for
+            informational messages, e.g. market data farm status.
+    """
+    match errorCode:
+        case 162 if 'returned no data' in errorString:
+            return 'no_data'
+        case 162 | 420 if 'pacing violation' in errorString.lower():
+            return 'pacing'
+        case 162 | 366:
+            return 'cancelled'
+        case 502 | 504 | 1100 | 1300 | 2105 | 10182:
+            return 'connection'
+        case 200 | 203 | 321 | 354 | 10090 | 10168:
+            return 'invalid'
+        case _:
+            return None
+
+
 class TWSCon(EWrapper, EClient):
 
-    def __init__(self, core):
+    def __init__(self, core, client_id: int = None):
         super().__init__()
         EClient.__init__(self, wrapper=self)
 
         self.core = core
         self.core.no_contract = False
-
-        self.connect(core.host_ip, core.api_port, core.client_id)
-        self.t: threading.Thread = threading.Thread(target=self.run, daemon=True)
+        self.client_id: int = client_id if client_id is not None else core.client_id
+        self.set_reqId_space(shard=0, shards=1)
+
+        self.t: threading.Thread | None = None
+        self.start_connection()
+
+    def start_connection(self, **kwargs):
+        """
+        Connects to TWS and starts the reader thread (EClient.run), which ends when the connection is lost.
+        Used for the initial connect and by PipelineHandler.connection_handler to reconnect.
+        """
+        if self.t is not None and self.t.is_alive():
+            self.t.join(timeout=5)
+        self.connect(self.core.host_ip, self.core.api_port, self.client_id)
+        self.t = threading.Thread(target=self.run, daemon=True)
         self.t.start()
         time.sleep(1)
 
+    def set_reqId_space(self, shard: int, shards: int, **kwargs):
+        """
+        Restricts this connection to the reqIds base + shard + k * shards, so the connections of a TWSRouter never share a reqId
+        and callbacks resolve through the shared core.reqId_hashmap. Discovery requests start at core.reqId_1, historical data at core.reqId_2.
+        """
+        self.reqId_step: int = shards
+        self.reqId_1: int = self.core.reqId_1 + shard
+        self.reqId_2: int = self.core.reqId_2 + shard
+        self.reqId_lock = threading.Lock()  # pipeline threads and the AsyncTWS event loop draw from the same space
+
+    def next_reqId(self, historical: bool = False, **kwargs) -> int:
+        with self.reqId_lock:
+            if historical:
+                reqId, self.reqId_2 = self.reqId_2, self.reqId_2 + self.reqId_step
+            else:
+                reqId, self.reqId_1 = self.reqId_1, self.reqId_1 + self.reqId_step
+        return reqId
+
     def connectAck(self):
-        tprint('Connected.')
+        tprint(f'Connected (client ID {self.client_id}).')
 
     def connectionClosed(self):
-        tprint('Disconnected.')
+        tprint(f'Disconnected (client ID {self.client_id}).')
 
     def error(self, reqId, errorCode, errorString):
         #print(errorCode, errorString)
-        if errorCode in [162, 200]:
-            self.core.reqId_hashmap[reqId].__self__.set_error_flag(flag=True)
+        contract_container = self.core.reqId_hashmap.container(reqId)
+        reqType = contract_container.get_reqType(reqId) if contract_container is not None else 'none'  # connectivity and farm status messages carry reqId -1
+        error_class = classify_error(errorCode, errorString)
+        self.core.metrics.inc('tws_errors', reqType=reqType, code=errorCode, error_class=error_class or 'info')
+
+        if error_class is not None and contract_container is not None:
+            if error_class != 'no_data':  # empty window, e.g. a chunk before the contract was listed
+                contract_container.set_error_flag(flag=True)
+                contract_container.set_request_failed(reqId, error_class=error_class)
+            self.core.reqId_hashmap.release(reqId)
+            contract_container.set_request_done(reqId)
+
+    def late_callback(self, callback: str):
+        """
+        Counts a callback of a request which is released already, e.g. a bar of a timed out and cancelled request.
+        Raising instead would end the reader thread and with it the connection.
+        """
+        self.core.metrics.inc('late_callbacks', callback=callback)
 
     def historicalData(self, reqId, bar):
-        if reqId not in self.core.reqId_hashmap.keys():
-            raise KeyError('ReqId not assigned to an security class instance.')
+        callback = self.core.reqId_hashmap.get(reqId)
+        if callback is None:
+            return self.late_callback('historicalData')
 
-        self.core.reqId_hashmap[reqId]({bar.date: {'Open': bar.open, 'High': bar.high, 'Low': bar.low, 'Close': bar.close}})
+        callback(bar.date, bar.open, bar.high, bar.low, bar.close)
 
     def historicalDataEnd(self, reqId: int, start: str, end: str):
         super().historicalDataEnd(reqId, start, end)
-        self.core.reqId_hashmap[reqId].__self__.set_historical_data_end(flag=True)
+        callback = self.core.reqId_hashmap.release(reqId)
+        if callback is None:
+            return self.late_callback('historicalDataEnd')
+
+        callback.__self__.set_historical_data_end(flag=True)
+        callback.__self__.set_request_done(reqId)
 
     def securityDefinitionOptionParameter(self, reqId, exchange, underlyingConId, tradingClass, multiplier, expirations, strikes):
-        if reqId not in self.core.reqId_hashmap.keys():
-            raise KeyError('ReqId not assigned to an security class instance.')
+        callback = self.core.reqId_hashmap.get(reqId)
+        if callback is None:
+            return self.late_callback('securityDefinitionOptionParameter')
+
+        callback(expiries=list(expirations) or [], strikes=list(strikes) or [])
 
-        self.core.reqId_hashmap[reqId](expiries=list(expirations) or [], strikes=list(strikes) or [])
+    def securityDefinitionOptionParameterEnd(self, reqId: int):
+        callback = self.core.reqId_hashmap.release(reqId)
+        if callback is not None:
+            callback.__self__.set_request_done(reqId)
 
     def contractDetails(self, reqId: int, contractDetails):
-        if reqId not in self.core.reqId_hashmap.keys():
-            raise KeyError('ReqId not assigned to an security class instance.')
+        callback = self.core.reqId_hashmap.get(reqId)
+        if callback is None:
+            return self.late_callback('contractDetails')
 
-        self.core.reqId_hashmap[reqId](contractDetails.contract.conId)
+        callback(contractDetails.contract.conId, contract=contractDetails.contract)
 
+    def contractDetailsEnd(self, reqId: int):
+        callback = self.core.reqId_hashmap.release(reqId)
+        if callback is not None:
+            callback.__self__.set_request_done(reqId)
+
+
+class TWSRouter:
+    """
+    Set of TWS connections, one per client ID in core.client_ids, each with its own socket, reader thread and reqId space.
+
+    Underlyings are partitioned across the connections: an underlying and all its options are assigned to one connection
+    on first use, round robin, so each connection carries an even share of the symbols and its own pacing budget.
+    Callbacks need no routing table, as the reqId spaces are disjoint and every connection resolves them through core.reqId_hashmap.
+    """
+    def __init__(self, core=None, TWS: type[TWSCon] = TWSCon, **kwargs):
+        if core is None:
+            raise Exception('<TWSRouter INIT> All parameters must be specified.')
+
+        self.core = core
+        self.connections: list[TWSCon] = [TWS(core, client_id=client_id, **kwargs) for client_id in core.client_ids]
+        for shard, tws_con in enumerate(self.connections):
+            tws_con.set_reqId_space(shard=shard, shards=len(self.connections))
+
+        self.shards: dict[str, TWSCon] = {}  # underlying symbol: assigned connection
+        self.lock = threading.Lock()
+
+    def route(self, contract_container: "ContractContainer", **kwargs) -> TWSCon:
+        """
+        Returns the connection of a contract's underlying.
+        """
+        symbol = contract_container.get_symbol()
+        tws_con = self.shards.get(symbol)
+        if tws_con is None:
+            with self.lock:
+                tws_con = self.shards.setdefault(symbol, self.connections[len(self.shards) % len(self.connections)])
+        return tws_con
+
+    def isConnected(self) -> bool:
+        return all(tws_con.isConnected() for tws_con in self.connections)
+
+    def __iter__(self) -> Iterator[TWSCon]:
+        return iter(self.connections)
+
+    def __len__(self) -> int:
+        return len(self.connections)
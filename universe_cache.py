@@ -0,0 +1,70 @@
+from datetime import datetime, timedelta
+import os
+import pickle
+
+from core import tprint
+
+
+class UniverseCache:
+    """
+    Versioned on-disk cache of the contract universe: conId, option expiries and strikes per underlying symbol.
+
+    Entries older than ttl are stale and get refreshed from TWS, fresh entries skip chain discovery on startup.
+    A cache file of another version is ignored and rebuilt.
+    """
+    version: int = 1
+
+    def __init__(self, path: str = None, ttl: timedelta = None):
+        if None in (path, ttl):
+            raise Exception('<UniverseCache INIT> All parameters must be specified.')
+
+        self.path = path
+        self.ttl = ttl
+
+        self.symbols: dict[str, dict] = {}
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, 'rb') as file:
+                data = pickle.load(file)
+        except (OSError, pickle.UnpicklingError, EOFError) as err:
+            tprint(f'Contract universe cache unreadable, rebuilding: {err}')
+            return
+
+        if not isinstance(data, dict) or data.get('version') != self.version:
+            tprint('Contract universe cache version changed, rebuilding.')
+            return
+
+        self.symbols = data['symbols']
+
+    def save(self):
+        """
+        Writes the cache atomically, so an interrupted write never leaves a corrupt cache file behind.
+        """
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'wb') as file:
+            pickle.dump({'version': self.version, 'symbols': self.symbols}, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+
+    def get(self, symbol: str, **kwargs) -> dict | None:
+        """
+        Returns the cached entry of a symbol, None if it is missing or stale.
+        Expiries in the past are dropped from the returned entry.
+
+        Returns:
+            dict | None: {'conId': int, 'expiries': list[str], 'strikes': list[float], 'alias': str | None,
+                          'listed_strikes': dict[str, list[float]], 'updated': datetime}
+        """
+        entry = self.symbols.get(symbol)
+        if entry is None or datetime.now() - entry['updated'] > self.ttl:
+            return None
+
+        today = datetime.today().strftime('%Y%m%d')
+        return {**entry, 'expiries': [x for x in entry['expiries'] if x >= today]}
+
+    def put(self, symbol: str, conId: int, expiries: list[str], strikes: list[float], alias: str = None, listed_strikes: dict[str, set[float]] = None, **kwargs):
+        self.symbols[symbol] = {'conId': conId, 'expiries': list(expiries), 'strikes': list(strikes), 'alias': alias,
+                                'listed_strikes': {k: sorted(v) for k, v in (listed_strikes or {}).items()}, 'updated': datetime.now()}
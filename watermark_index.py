@@ -0,0 +1,53 @@
+from datetime import datetime
+from threading import Lock
+
+
+class WatermarkIndex:
+    """
+    In-memory index of the latest stored bar per contract.
+
+    Keys are (symbol, expiry, strike, right); stock contracts use (symbol, None, None, None).
+    Watermarks are loaded in bulk, one grouped query per table, and updated in place after each successful write.
+    """
+    def __init__(self):
+        self.watermarks: dict[tuple, datetime] = {}
+        self.loaded_tables: set[tuple[str, str]] = set()
+        self.lock = Lock()
+
+    @staticmethod
+    def key(contract_container: 'ContractContainer') -> tuple:
+        if contract_container.get_secType() == 'OPT':
+            return (contract_container.get_symbol(), contract_container.get_expiry(), float(contract_container.get_strike()), contract_container.get_right())
+        return (contract_container.get_symbol(), None, None, None)
+
+    def is_loaded(self, contract_container: 'ContractContainer') -> bool:
+        return (contract_container.get_database(), contract_container.get_table()) in self.loaded_tables
+
+    def load(self, contract_container: 'ContractContainer', rows: list[tuple], **kwargs):
+        """
+        Fills the index with the watermarks of the table the contract is stored in.
+
+        Args:
+            contract_container (ContractContainer): Any contract of the loaded table.
+            rows (list[tuple]): (strike, right, last_update) per contract of the table. Strike and right are None for STK.
+        """
+        symbol = contract_container.get_symbol()
+        expiry = contract_container.get_expiry() if contract_container.get_secType() == 'OPT' else None
+
+        with self.lock:
+            for strike, right, last_update in rows:
+                if last_update is None:
+                    continue
+                key = (symbol, expiry, float(strike) if strike is not None else None, right)
+                if key not in self.watermarks or self.watermarks[key] < last_update:
+                    self.watermarks[key] = last_update
+            self.loaded_tables.add((contract_container.get_database(), contract_container.get_table()))
+
+    def get(self, contract_container: 'ContractContainer') -> datetime | None:
+        return self.watermarks.get(self.key(contract_container))
+
+    def update(self, contract_container: 'ContractContainer', last_update: datetime, **kwargs):
+        key = self.key(contract_container)
+        with self.lock:
+            if key not in self.watermarks or self.watermarks[key] < last_update:
+                self.watermarks[key] = last_update
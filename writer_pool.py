@@ -0,0 +1,158 @@
+import atexit
+from datetime import datetime
+from itertools import count
+from multiprocessing import get_context
+from queue import Empty
+from threading import Lock, Thread
+from time import monotonic
+from typing import Callable
+from zlib import crc32
+
+from bar_buffer import BarBuffer
+from core import Core, tprint
+
+
+def store_price_data(core, db: 'StorageBackend', contract_instance: 'ContractContainer', price_data: BarBuffer,
+                     last_stored: datetime = None, **kwargs) -> tuple[int, datetime | None]:
+    """
+    Writes the received bars of a contract which are not stored yet.
+
+    Bars after last_stored are always new. Bars up to last_stored are only kept in exact check mode (core.dedup_exact_check),
+    if the stored dates of the overlapping window do not contain them.
+
+    Args:
+        core (Core): Settings of the calling process.
+        db (StorageBackend): Backend of the calling process.
+        contract_instance (ContractContainer): The contract the bars belong to.
+        price_data (BarBuffer): The received bars.
+        last_stored (datetime, optional): Latest bar stored for this contract (watermark).
+
+    Returns:
+        tuple[int, datetime | None]: Number of written rows and the latest written bar.
+    """
+    existing_dates = None
+    if core.dedup_exact_check and last_stored and price_data:
+        first_bar = price_data.first()
+        if first_bar <= last_stored:
+            existing_dates = db.get_existing_dates(contract_container=contract_instance, start=first_bar, end=last_stored)
+
+    rows = price_data.rows(prefix=db.row_prefix(contract_container=contract_instance), last_stored=last_stored,
+                           existing_dates=existing_dates) if price_data else []
+
+    if contract_instance.get_secType() == 'OPT':
+        target = f'{contract_instance.get_table()} {contract_instance.get_right()} {contract_instance.get_strike()}'
+    else:
+        target = contract_instance.get_table()
+
+    if not rows:
+        tprint(f'Writing no price data for {contract_instance.get_symbol()} {contract_instance.get_secType()} to database {target}.')
+        return 0, None
+
+    tprint(f'Writing #{len(rows)} price data for {contract_instance.get_symbol()} {contract_instance.get_secType()} to database {target}.')
+    db.write_price_rows(contract_container=contract_instance, rows=rows)
+    return len(rows), max(row[0] for row in rows)
+
+
+def writer_process(settings: dict, DB: type, CC: type, jobs, acks):
+    """
+    Main loop of a writer process. Builds its own Core from the parent's settings and its own backend (connection pool,
+    parquet buffers), writes the jobs of its partition in order and acknowledges each one on acks.
+    Buffered backends are flushed whenever no job arrived for core.parquet_flush_interval seconds and on shutdown (job None).
+    After a streamed chunk of a contract failed, its later chunks are dropped up to the final one (see PipelineHandler.acknowledge).
+    """
+    core = Core()
+    vars(core).update(settings)
+    db = DB.shared(core=core, CC=CC)
+    failed: set[tuple] = set()  # contracts with a failed streamed chunk
+
+    while True:
+        try:
+            job = jobs.get(timeout=core.parquet_flush_interval)
+        except Empty:
+            db.flush()
+            continue
+        if job is None:
+            break
+
+        seq, spec, price_data, last_stored, final = job
+        key = tuple(spec.values())
+        if key in failed:
+            tprint(f'Dropping {len(price_data)} streamed bars of {spec["symbol"]} {spec["secType"]} after a failed chunk.')
+            if final:
+                failed.discard(key)
+            acks.put((seq, 0, None, None))
+            continue
+        try:
+            written, last_update = store_price_data(core=core, db=db, contract_instance=CC(core, **spec), price_data=price_data,
+                                                    last_stored=last_stored)
+            acks.put((seq, written, last_update, None))
+        except Exception as err:
+            if not final:
+                failed.add(key)
+            acks.put((seq, 0, None, repr(err)))
+
+    db.close()
+
+
+class WriterPool:
+    """
+    Pool of writer processes, so row building and serialization of several tables run in parallel and outside the GIL
+    of the scraper process.
+
+    Contracts are partitioned by database and table (crc32 of the name), so every table is written by exactly one process
+    and no two writers contend on one table. Each process has a bounded job queue and writes it in submission order,
+    so acknowledgements of a table arrive in order. They are passed to on_ack by one collector thread:
+    on_ack(contract_instance, written rows, latest written bar, seconds from submit to ack, error or None, final).
+
+    The processes are started with the spawn method and get a copy of the scalar settings of core (Core.settings).
+    """
+    def __init__(self, core=None, CC=None, DB=None, on_ack: Callable = None):
+        if None in (core, CC, DB, on_ack):
+            raise Exception('<WriterPool INIT> All parameters must be specified.')
+
+        self.core = core
+        self.on_ack = on_ack
+
+        context = get_context('spawn')
+        self.jobs = [context.Queue(maxsize=core.writer_queue_length) for _ in range(core.writer_processes)]
+        self.acks = context.Queue()
+        self.processes = [context.Process(target=writer_process, args=(core.settings(), DB, CC, jobs, self.acks), daemon=True)
+                          for jobs in self.jobs]
+        for process in self.processes:
+            process.start()
+
+        self.pending: dict[int, tuple['ContractContainer', float, bool]] = {}  # seq: (contract, monotonic submit time, final)
+        self.seq = count()
+        self.lock = Lock()
+
+        Thread(target=self.collect_acks, daemon=True).start()
+        atexit.register(self.close)
+
+    def partition(self, contract_instance: 'ContractContainer', **kwargs) -> int:
+        return crc32(f'{contract_instance.get_database()}.{contract_instance.get_table()}'.encode()) % len(self.processes)
+
+    def submit(self, contract_instance: 'ContractContainer', price_data: BarBuffer, last_stored: datetime = None, final: bool = True, **kwargs):
+        """
+        Queues received bars of a contract (all of them, or a streamed chunk if not final) to the writer of its table.
+        Blocks while that writer's queue is full.
+        """
+        seq = next(self.seq)
+        with self.lock:
+            self.pending[seq] = (contract_instance, monotonic(), final)
+        self.jobs[self.partition(contract_instance)].put((seq, contract_instance.get_spec(), price_data, last_stored, final))
+
+    def collect_acks(self):
+        while True:
+            seq, written, last_update, error = self.acks.get()
+            with self.lock:
+                contract_instance, submitted, final = self.pending.pop(seq)
+            self.on_ack(contract_instance, written, last_update, monotonic() - submitted, error, final)
+
+    def close(self, **kwargs):
+        """
+        Lets every writer finish its queue, flush and exit.
+        """
+        for jobs in self.jobs:
+            jobs.put(None)
+        for process in self.processes:
+            process.join(timeout=60)